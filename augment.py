@@ -0,0 +1,179 @@
+'''
+
+On-the-fly augmentation of (batch, H, W, C) image and mask batches. Every
+sample gets its own random flip, 90 degree rotation, small affine transform
+and elastic warp, combined into a single resampling of the batch (bilinear
+for images, nearest for masks, so both see the same geometry), followed by
+per-channel intensity jitter and gamma on the images.
+
+'''
+
+import time
+import threading
+import numpy as np
+
+def _upsample_weights(coarse, size):
+
+	# (size, coarse) bilinear interpolation matrix spanning the whole axis
+	centers = np.linspace(0, coarse - 1, size)
+	lower = np.minimum(np.floor(centers).astype(int), coarse - 2)
+	weights = np.zeros((size, coarse))
+	weights[np.arange(size), lower] = 1 - (centers - lower)
+	weights[np.arange(size), lower + 1] = centers - lower
+
+	return weights
+
+class Augmenter(object):
+	"""
+	Callable applying random augmentations to a batch: imgs, msks = augmenter(imgs, msks).
+	---
+	flip: mirror half of the samples left-right
+	rotate90: rotate by a random multiple of 90 degrees (square slices only)
+	max_angle, max_scale, max_shift: range of the random rotation (degrees),
+	zoom (fraction) and translation (fraction of the slice size)
+	elastic_alpha: largest elastic displacement in pixels, 0 to disable
+	elastic_grid: control points per axis of the smooth displacement field
+	intensity: range of the per-channel random scale and offset
+	gamma: range of the log of the per-channel random gamma
+	seed: base seed; batches augmented with a seq number are reproducible
+	whichever worker or thread augments them
+	channels_first: batches are laid out like ChannelView(channels_first=True)
+
+	seconds and batches accumulate the time spent, see cost(); they are
+	updated under a lock, so one Augmenter can be called from several threads.
+	"""
+
+	def __init__(self, flip=True, rotate90=True, max_angle=10.0, max_scale=0.1, max_shift=0.05,
+				 elastic_alpha=2.0, elastic_grid=5, intensity=0.1, gamma=0.2, seed=816,
+				 channels_first=False):
+
+		self.flip = flip
+		self.rotate90 = rotate90
+		self.max_angle = max_angle
+		self.max_scale = max_scale
+		self.max_shift = max_shift
+		self.elastic_alpha = elastic_alpha
+		self.elastic_grid = elastic_grid
+		self.intensity = intensity
+		self.gamma = gamma
+		self.seed = seed
+		self.channels_first = channels_first
+		self._rng = np.random.RandomState(seed)
+		self.seconds = 0.0
+		self.batches = 0
+		self._lock = threading.Lock()
+
+	def __getstate__(self):
+
+		# Locks cannot be pickled; worker processes get a fresh one
+		state = dict(self.__dict__)
+		del state["_lock"]
+		return state
+
+	def __setstate__(self, state):
+
+		self.__dict__.update(state)
+		self._lock = threading.Lock()
+
+	def record(self, seconds, batches=1):
+		"""
+		Adds time spent augmenting, e.g. by a worker process, to the counters.
+		"""
+
+		with self._lock:
+			self.seconds += seconds
+			self.batches += batches
+
+	def cost(self):
+		"""
+		Returns the average augmentation time per batch in seconds.
+		"""
+
+		return self.seconds / max(self.batches, 1)
+
+	def _coordinates(self, rng, batch, height, width):
+
+		# Input (row, column) sampled by every output pixel, as one 2x2 matrix
+		# and shift per sample about the slice center
+		angle = np.deg2rad(rng.uniform(-self.max_angle, self.max_angle, batch))
+		if self.rotate90 and height == width:
+			angle += rng.randint(4, size=batch) * np.pi / 2
+		scale = 1.0 / rng.uniform(1 - self.max_scale, 1 + self.max_scale, batch)
+		cos, sin = np.cos(angle) * scale, np.sin(angle) * scale
+		mirror = np.where(rng.rand(batch) < 0.5, -1.0, 1.0) if self.flip else np.ones(batch)
+		shift = rng.uniform(-self.max_shift, self.max_shift, (2, batch, 1, 1)) * [[[[height]]], [[[width]]]]
+
+		# Single precision is ample for pixel coordinates and halves the work
+		center_row, center_col = (height - 1) / 2.0, (width - 1) / 2.0
+		rows = (np.arange(height) - center_row).astype(np.float32)[np.newaxis,:,np.newaxis]
+		cols = (np.arange(width) - center_col).astype(np.float32)[np.newaxis,np.newaxis,:]
+		mirror = mirror.astype(np.float32)[:,np.newaxis,np.newaxis]
+		cos = cos.astype(np.float32)[:,np.newaxis,np.newaxis]
+		sin = sin.astype(np.float32)[:,np.newaxis,np.newaxis]
+		shift = shift.astype(np.float32)
+		src_rows = (cos*rows + (center_row + shift[0])) - (sin*mirror)*cols
+		src_cols = (sin*rows + (center_col + shift[1])) + (cos*mirror)*cols
+
+		if self.elastic_alpha > 0:
+			# Smooth random displacements: noise on a coarse grid, interpolated
+			# to every pixel with two matrix products
+			noise = rng.uniform(-1, 1, (2, batch, self.elastic_grid, self.elastic_grid))
+			field = np.matmul(np.matmul(_upsample_weights(self.elastic_grid, height), noise),
+							  _upsample_weights(self.elastic_grid, width).T)
+			field = (self.elastic_alpha * field).astype(np.float32)
+			src_rows += field[0]
+			src_cols += field[1]
+
+		return np.clip(src_rows, 0, height - 1, out=src_rows), np.clip(src_cols, 0, width - 1, out=src_cols)
+
+	def __call__(self, imgs, msks, seq=None):
+
+		start_time = time.time()
+		rng = np.random.RandomState([self.seed, seq]) if seq is not None and self.seed is not None else self._rng
+
+		imgs = np.asarray(imgs, dtype=np.float32)
+		msks = np.asarray(msks)
+		if self.channels_first:
+			imgs, msks = np.swapaxes(imgs, 1, -1), np.swapaxes(msks, 1, -1)
+		batch, height, width, channels = imgs.shape
+
+		# Positions outside the slice repeat its edge (coordinates are clamped).
+		# Pixels are gathered by their flat index into the whole batch.
+		src_rows, src_cols = self._coordinates(rng, batch, height, width)
+		offsets = (np.arange(batch) * height * width)[:,np.newaxis,np.newaxis]
+		flat_imgs = imgs.reshape(-1, channels)
+		flat_msks = msks.reshape(-1, msks.shape[-1])
+
+		top, left = np.floor(src_rows).astype(np.intp), np.floor(src_cols).astype(np.intp)
+		down = (src_rows - top)[...,np.newaxis]
+		across = (src_cols - left)[...,np.newaxis]
+		top_left = offsets + top*width + left
+		right = (left < width - 1).astype(np.intp)
+		below = (top < height - 1) * width
+
+		out_imgs = np.take(flat_imgs, top_left, axis=0)
+		out_imgs += (np.take(flat_imgs, top_left + right, axis=0) - out_imgs) * across
+		bottom = np.take(flat_imgs, top_left + below, axis=0)
+		bottom += (np.take(flat_imgs, top_left + below + right, axis=0) - bottom) * across
+		out_imgs += (bottom - out_imgs) * down
+
+		nearest = offsets + np.rint(src_rows).astype(np.intp)*width + np.rint(src_cols).astype(np.intp)
+		out_msks = np.take(flat_msks, nearest, axis=0)
+
+		if self.gamma > 0:
+			# Gamma on each channel rescaled to [0, 1], then scaled back
+			low = out_imgs.min(axis=(1,2), keepdims=True)
+			span = np.maximum(out_imgs.max(axis=(1,2), keepdims=True) - low, 1e-6)
+			gamma = np.exp(rng.uniform(-self.gamma, self.gamma, (batch, 1, 1, channels))).astype(np.float32)
+			out_imgs = ((out_imgs - low) / span) ** gamma * span + low
+
+		if self.intensity > 0:
+			out_imgs *= rng.uniform(1 - self.intensity, 1 + self.intensity, (batch, 1, 1, channels)).astype(np.float32)
+			out_imgs += rng.uniform(-self.intensity, self.intensity, (batch, 1, 1, channels)).astype(np.float32)
+
+		if self.channels_first:
+			out_imgs, out_msks = np.swapaxes(out_imgs, 1, -1), np.swapaxes(out_msks, 1, -1)
+
+		self.record(time.time() - start_time)
+
+		return out_imgs, out_msks
@@ -0,0 +1,178 @@
+'''
+
+Autotuner of the threading knobs of train.py: intra-op threads (and
+OMP_NUM_THREADS), inter-op threads, KMP_BLOCKTIME, KMP_AFFINITY and the
+batch size. Each candidate runs a short timed training burst in its own
+train.py subprocess, since the OpenMP settings are fixed once TensorFlow is
+loaded. The knobs are tuned one at a time, each keeping the best value found
+so far for the others. The best configuration is saved per host fingerprint
+(CPU model, core counts and NUMA layout) to autotune.json, which train.py
+loads automatically on a matching host.
+
+Usage: python autotune.py [--burst_steps 20] [--rounds 1] [train.py flags, e.g. --use_upsampling]
+
+'''
+
+import os
+import re
+import sys
+import glob
+import json
+import time
+import argparse
+import subprocess
+
+AUTOTUNE_FILE = os.path.join(os.path.dirname(os.path.abspath(__file__)), "autotune.json")
+TRAIN_SCRIPT = os.path.join(os.path.dirname(os.path.abspath(__file__)), "train.py")
+
+# The tuned train.py flags, in the order they are tuned
+KNOBS = ["num_threads", "num_inter_threads", "blocktime", "kmp_affinity", "batch_size"]
+
+def host_fingerprint():
+	"""
+	Returns the CPU model, physical and logical core counts and the CPU list
+	of each NUMA node of this host.
+	"""
+
+	import psutil
+
+	cpu = "unknown"
+	if os.path.isfile("/proc/cpuinfo"):
+		with open("/proc/cpuinfo") as f:
+			for line in f:
+				if line.startswith("model name"):
+					cpu = line.split(":", 1)[1].strip()
+					break
+
+	numa = []
+	for node in sorted(glob.glob("/sys/devices/system/node/node[0-9]*"),
+					   key=lambda path: int(re.sub(r"\D", "", os.path.basename(path)))):
+		with open(os.path.join(node, "cpulist")) as f:
+			numa.append(f.read().strip())
+
+	return {"cpu": cpu, "cores": psutil.cpu_count(logical=False),
+			"threads": psutil.cpu_count(logical=True), "numa": numa}
+
+def fingerprint_key(fingerprint):
+	return "{cpu} | {cores} cores | {threads} threads | numa {numa}".format(
+		cpu=fingerprint["cpu"], cores=fingerprint["cores"], threads=fingerprint["threads"],
+		numa=";".join(fingerprint["numa"]) or "-")
+
+def load_config(filename=AUTOTUNE_FILE):
+	"""
+	Returns the tuned {flag: value} configuration of this host, None if it
+	has not been tuned.
+	"""
+
+	if not os.path.isfile(filename):
+		return None
+
+	with open(filename) as f:
+		entry = json.load(f).get(fingerprint_key(host_fingerprint()))
+
+	return entry["config"] if entry else None
+
+def save_config(config, images_per_sec, filename=AUTOTUNE_FILE):
+
+	tuned = {}
+	if os.path.isfile(filename):
+		with open(filename) as f:
+			tuned = json.load(f)
+
+	fingerprint = host_fingerprint()
+	tuned[fingerprint_key(fingerprint)] = {"fingerprint": fingerprint, "config": config,
+										   "images_per_sec": images_per_sec,
+										   "tuned": time.strftime("%Y-%m-%d %H:%M:%S")}
+
+	# Write a new file, then move it over the old one
+	with open(filename + ".tmp", "w") as f:
+		json.dump(tuned, f, indent=2, sort_keys=True)
+	os.rename(filename + ".tmp", filename)
+
+def search_space(fingerprint):
+	"""
+	Returns the candidate values of each knob on this host.
+	"""
+
+	cores, threads = fingerprint["cores"], fingerprint["threads"]
+	intra = set([cores, max(cores - 2, 1), max(cores // 2, 1), max(cores // 4, 1), threads])
+
+	return {"num_threads": sorted(intra),
+			"num_inter_threads": [1, 2, 4],
+			"blocktime": [0, 1, 30],
+			"kmp_affinity": ["compact,1,0,granularity=thread", "granularity=fine,compact,1,0",
+							 "granularity=fine,scatter"],
+			"batch_size": [64, 128, 256]}
+
+def burst(config, burst_steps, train_args=()):
+	"""
+	Returns the training images/sec of a burst of train.py with the config,
+	0 if the burst failed.
+	"""
+
+	command = [sys.executable, TRAIN_SCRIPT, "--no_autotune", "--burst_steps", str(burst_steps)]
+	for knob in KNOBS:
+		command += ["--" + knob, str(config[knob])]
+	command += list(train_args)
+
+	process = subprocess.Popen(command, stdout=subprocess.PIPE, stderr=subprocess.STDOUT,
+							   universal_newlines=True)
+	output = process.communicate()[0]
+	match = re.search(r"Burst throughput: ([\d.]+) images/sec", output)
+	if process.returncode != 0 or match is None:
+		print("Burst failed with {}:\n{}".format(config, "\n".join(output.splitlines()[-10:])))
+		return 0.0
+
+	return float(match.group(1))
+
+def autotune(burst_steps=20, rounds=1, train_args=(), start=None):
+	"""
+	Tunes the knobs one at a time over the search space, for the given
+	rounds, and returns the best (config, images/sec).
+	---
+	start: the initial config, train.py's defaults if None
+	"""
+
+	fingerprint = host_fingerprint()
+	space = search_space(fingerprint)
+	best = start or {"num_threads": max(fingerprint["cores"] - 2, 1), "num_inter_threads": 2,
+					 "blocktime": 0, "kmp_affinity": space["kmp_affinity"][0], "batch_size": 128}
+	print("Tuning {}".format(fingerprint_key(fingerprint)))
+
+	measured = {}
+	def measure(config):
+		key = tuple(config[knob] for knob in KNOBS)
+		if key not in measured:
+			measured[key] = burst(config, burst_steps, train_args)
+			print("{:>10.1f} images/sec: {}".format(measured[key], config))
+		return measured[key]
+
+	best_rate = measure(best)
+	for round in range(rounds):
+		for knob in KNOBS:
+			for value in space[knob]:
+				config = dict(best, **{knob: value})
+				rate = measure(config)
+				if rate > best_rate:
+					best, best_rate = config, rate
+
+	return best, best_rate
+
+if __name__ == "__main__":
+
+	parser = argparse.ArgumentParser()
+	parser.add_argument("--burst_steps", type=int, default=20,
+						help="the timed training steps of each burst")
+	parser.add_argument("--rounds", type=int, default=1,
+						help="the passes over all the knobs")
+	parser.add_argument("--autotune_file", default=AUTOTUNE_FILE,
+						help="the file the tuned configurations are saved to")
+	args, train_args = parser.parse_known_args()
+
+	config, images_per_sec = autotune(args.burst_steps, args.rounds, train_args)
+	if images_per_sec > 0:
+		save_config(config, images_per_sec, args.autotune_file)
+		print("Best: {:.1f} images/sec with {}, saved to {}".format(images_per_sec, config,
+																	 args.autotune_file))
+	else:
+		print("Every burst failed, nothing saved")
@@ -0,0 +1,118 @@
+'''
+
+Micro-benchmark of the per-subject parsing step in converter.py.
+Compares the vectorized parse_segments / parse_images / stack_img_slices
+(with streaming per-modality statistics) against the original slice-by-slice
+implementations on a synthetic 240x240x155 BraTS-sized volume, stored in
+the Fortran order of NIfTI files, and times the stacking step on its own.
+
+Usage: python benchmarks/bench_parse.py --repeats 5
+
+'''
+
+import os
+import sys
+import argparse
+import timeit
+import numpy as np
+import numpy.ma as ma
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+import converter
+
+def legacy_parse_segments(seg):
+
+	msks_parsed = []
+	for slice in range(seg.shape[-1]):
+		curr = seg[:,:,slice]
+		GD = ma.masked_not_equal(curr,4).filled(fill_value=0)
+		edema = ma.masked_not_equal(curr,2).filled(fill_value=0)
+		necrotic = ma.masked_not_equal(curr,1).filled(fill_value=0)
+		none = ma.masked_not_equal(curr,0).filled(fill_value=0)
+
+		msks_parsed.append(np.dstack((none,necrotic,edema,GD)))
+
+	mask = np.asarray(msks_parsed)
+	mask[mask > 0] = 1
+
+	return mask
+
+def legacy_parse_images(img):
+
+	slices = []
+	for slice in range(img.shape[-1]):
+		curr = img[:,:,slice]
+		slices.append(curr)
+
+	return np.asarray(slices)
+
+def legacy_stack_img_slices(mode_track, stack_order):
+
+	full_brain = []
+	for slice in range(len(mode_track['t1'])):
+		current_slice = []
+		for mode in stack_order:
+			current_slice.append(mode_track[mode][slice,:,:])
+		full_brain.append(np.dstack(current_slice))
+
+	stack = np.asarray(full_brain)
+	stack = (stack - np.mean(stack))/(np.std(stack))
+
+	return stack
+
+def legacy_subject(seg, vols):
+
+	msks = legacy_parse_segments(seg)
+	mode_track = {mode: legacy_parse_images(vols[mode]) for mode in converter.img_modes}
+	imgs = legacy_stack_img_slices(mode_track, converter.img_modes)
+
+	return imgs, msks
+
+def vectorized_subject(seg, vols):
+
+	msks = converter.parse_segments(converter.parse_images(seg))
+	mode_track = {mode: converter.parse_images(vols[mode]) for mode in converter.img_modes}
+	stats = [converter.volume_stats(mode_track[mode]) for mode in converter.img_modes]
+	imgs = converter.stack_img_slices(mode_track, converter.img_modes, stats)
+
+	return imgs, msks
+
+if __name__ == "__main__":
+
+	parser = argparse.ArgumentParser()
+	parser.add_argument("--repeats", type=int, default=5,
+						help="the number of timed runs per implementation")
+	args = parser.parse_args()
+
+	rng = np.random.RandomState(816)
+	shape = (240, 240, 155)
+	seg = rng.choice(np.array([0,0,0,0,1,2,4], dtype=np.uint8), size=shape)
+	vols = {mode: np.asfortranarray(rng.randint(0, 2000, size=shape).astype(np.int16))
+			for mode in converter.img_modes}
+
+	old_imgs, old_msks = legacy_subject(seg, vols)
+	new_imgs, new_msks = vectorized_subject(seg, vols)
+	assert np.array_equal(old_msks, new_msks), "Masks differ between implementations"
+
+	# The legacy code normalized all modalities together, the converter now
+	# normalizes each one by its own statistics
+	for channel, mode in enumerate(converter.img_modes):
+		expected = (np.transpose(vols[mode], (2,0,1)) - vols[mode].mean()) / vols[mode].std()
+		assert np.allclose(new_imgs[...,channel], expected), "Images differ between implementations"
+
+	times = {}
+	for name, subject in [("legacy", legacy_subject), ("vectorized", vectorized_subject)]:
+		times[name] = min(timeit.repeat(lambda: subject(seg, vols),
+										repeat=args.repeats, number=1))
+		print("{:>10}: {:.3f} s per subject".format(name, times[name]))
+
+	print("Speedup: {:.1f}x".format(times["legacy"] / times["vectorized"]))
+
+	mode_track = {mode: converter.parse_images(vols[mode]) for mode in converter.img_modes}
+	stats = [converter.volume_stats(mode_track[mode]) for mode in converter.img_modes]
+	for name, stack in [("legacy", lambda: legacy_stack_img_slices(mode_track, converter.img_modes)),
+						("vectorized", lambda: converter.stack_img_slices(mode_track, converter.img_modes, stats))]:
+		times[name] = min(timeit.repeat(stack, repeat=args.repeats, number=1))
+		print("{:>10}: {:.3f} s per stack".format(name, times[name]))
+
+	print("Stacking speedup: {:.1f}x".format(times["legacy"] / times["vectorized"]))
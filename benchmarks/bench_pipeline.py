@@ -0,0 +1,86 @@
+'''
+
+Throughput of the training input pipelines in pipeline.py. Reads shuffled
+batches of a converted dataset through the synchronous numpy pipeline, the
+tf.data pipeline and the shared-memory loader processes while a simulated
+training step (--step_time seconds, spent outside the GIL like a TensorFlow
+op) runs on the same thread, so the benefit of reading ahead shows directly.
+
+Usage: python benchmarks/bench_pipeline.py --data_path <OUT_PATH> --mode 1
+
+'''
+
+import os
+import sys
+import time
+import argparse
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+from preprocess import load_data, update_channels, load_mode_data
+from pipeline import numpy_batches, tfdata_batches, steps_per_epoch, SharedBatchLoader, numa_node_cpus
+
+def throughput(batches, steps, step_time):
+
+	next(batches)  # start up the pipeline outside the timing
+	start_time = time.time()
+	images = 0
+	for step in range(steps):
+		imgs, msks = next(batches)
+		images += len(imgs)
+		time.sleep(step_time)
+
+	return images / (time.time() - start_time)
+
+if __name__ == "__main__":
+
+	parser = argparse.ArgumentParser()
+	parser.add_argument("--data_path", required=True,
+						help="the directory of the converted dataset")
+	parser.add_argument("--mode", type=int, default=1,
+						help="the MODE whose channels are read")
+	parser.add_argument("--batch_size", type=int, default=128,
+						help="the batch size")
+	parser.add_argument("--steps", type=int, default=0,
+						help="the batches read per pipeline, one epoch by default")
+	parser.add_argument("--step_time", type=float, default=0.0,
+						help="the simulated training time per batch in seconds")
+	parser.add_argument("--pipeline_threads", type=int, default=4,
+						help="the parallel batch reads of the tf.data pipeline")
+	parser.add_argument("--loader_workers", type=int, default=4,
+						help="the number of batch loader processes")
+	parser.add_argument("--loader_numa_node", type=int, default=None,
+						help="pin the batch loader processes to the CPUs of this NUMA node")
+	parser.add_argument("--no_cache", action="store_true", default=False,
+						help="select the mode channels while reading instead of from the cache")
+	args = parser.parse_args()
+
+	if args.no_cache:
+		imgs, msks = update_channels(*load_data(args.data_path, "_train"), input_no=1,
+									 output_no=1, mode=args.mode)
+	else:
+		imgs, msks = load_mode_data(args.data_path, "_train", 1, 1, args.mode)
+	steps = args.steps or steps_per_epoch(len(imgs), args.batch_size)
+
+	pipelines = [("numpy", lambda: numpy_batches(imgs, msks, args.batch_size))]
+	session = None
+	try:
+		from tf_compat import tf_v1
+		session = tf_v1().Session()
+		pipelines.append(("tfdata", lambda: tfdata_batches(imgs, msks, args.batch_size,
+															 num_parallel_calls=args.pipeline_threads,
+															 session=session)))
+	except ImportError:
+		print("TensorFlow is not installed, skipping the tf.data pipeline")
+
+	cpus = numa_node_cpus(args.loader_numa_node) if args.loader_numa_node is not None else None
+	loader = SharedBatchLoader(imgs, msks, args.batch_size, args.loader_workers, cpus=cpus)
+	pipelines.append(("loader", lambda: iter(loader)))
+
+	rates = {}
+	for name, batches in pipelines:
+		rates[name] = throughput(batches(), steps, args.step_time)
+		print("{:>6}: {:.1f} images/sec ({:.2f}x numpy)".format(name, rates[name],
+																 rates[name] / rates["numpy"]))
+	loader.close()
+	if session is not None:
+		session.close()
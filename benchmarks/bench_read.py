@@ -0,0 +1,102 @@
+'''
+
+Read benchmark of the converted dataset containers. Writes the same synthetic
+image array as a raw .npy file and as HDF5 files with each available codec,
+then compares file sizes and the throughput of sequential and shuffled batch
+reads through preprocess.open_array.
+
+Synthetic images are smoothed noise over a blank background, so compression
+ratios are only indicative; run with --data_path on a converted dataset
+(e.g. converter.py --container hdf5) to measure the real files.
+
+Usage: python benchmarks/bench_read.py --slices 2048 --batch_size 128
+
+'''
+
+import os
+import sys
+import time
+import shutil
+import argparse
+import tempfile
+import numpy as np
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+from npy_writer import NpyAppendWriter
+from h5_store import H5AppendWriter, compression_options
+from preprocess import open_array, array_files
+
+def synthetic_images(slices, size, dtype, seed=816):
+
+	rng = np.random.RandomState(seed)
+	yy, xx = np.mgrid[:size, :size]
+	brain = ((yy - size/2.)**2 + (xx - size/2.)**2) < (size*0.4)**2
+	for start in range(0, slices, 64):
+		rows = min(64, slices - start)
+		imgs = rng.normal(size=(rows, size, size, 4)).cumsum(axis=1) / 8.
+		imgs[:, ~brain] = 0
+		yield imgs.astype(dtype)
+
+def read_throughput(array, batch_size, shuffle, seed=816):
+
+	rows = np.arange(len(array))
+	if shuffle:
+		rows = np.random.RandomState(seed).permutation(rows)
+
+	start_time = time.time()
+	nbytes = 0
+	for start in range(0, len(rows), batch_size):
+		batch = np.asarray(array[np.sort(rows[start:start+batch_size])])
+		nbytes += batch.nbytes
+
+	return nbytes / (time.time() - start_time) / 2.**20
+
+if __name__ == "__main__":
+
+	parser = argparse.ArgumentParser()
+	parser.add_argument("--data_path", default=None,
+						help="benchmark the arrays of a converted dataset instead of synthetic data")
+	parser.add_argument("--slices", type=int, default=2048,
+						help="the number of synthetic slices")
+	parser.add_argument("--size", type=int, default=128,
+						help="the height and width of the synthetic slices")
+	parser.add_argument("--dtype", default="float32",
+						help="the storage type of the synthetic images")
+	parser.add_argument("--batch_size", type=int, default=128,
+						help="the number of slices per read")
+	args = parser.parse_args()
+
+	tmp_dir = None
+	if args.data_path is not None:
+		files = {"dataset": array_files(args.data_path)[0]}
+	else:
+		tmp_dir = tempfile.mkdtemp()
+		files = {"npy": os.path.join(tmp_dir, "imgs.npy")}
+		with NpyAppendWriter(files["npy"], args.dtype) as writer:
+			for chunk in synthetic_images(args.slices, args.size, args.dtype):
+				writer.append(chunk)
+
+		codecs = ["gzip", "none"]
+		try:
+			compression_options("blosc")
+			codecs.insert(0, "blosc")
+		except ImportError:
+			print("hdf5plugin is not installed, skipping Blosc/LZ4")
+
+		for codec in codecs:
+			files["hdf5-"+codec] = os.path.join(tmp_dir, "imgs_{}.h5".format(codec))
+			with H5AppendWriter(files["hdf5-"+codec], args.dtype, codec=codec) as writer:
+				for chunk in synthetic_images(args.slices, args.size, args.dtype):
+					writer.append(chunk)
+
+	try:
+		print("{:>12} {:>10} {:>16} {:>16}".format("container", "size MB", "sequential MB/s", "shuffled MB/s"))
+		for name, fn in sorted(files.items()):
+			array = open_array(fn)
+			sequential = read_throughput(array, args.batch_size, shuffle=False)
+			shuffled = read_throughput(array, args.batch_size, shuffle=True)
+			print("{:>12} {:>10.1f} {:>16.1f} {:>16.1f}".format(name, os.path.getsize(fn) / 2.**20,
+																	sequential, shuffled))
+	finally:
+		if tmp_dir is not None:
+			shutil.rmtree(tmp_dir)
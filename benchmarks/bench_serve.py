@@ -0,0 +1,130 @@
+'''
+
+Load generator of serve.py. For each concurrency level, that many client
+threads post requests of --slices slices to /slices back to back for
+--duration seconds, and the client-side latency percentiles and throughput
+are printed, with the mean batch size the server's dynamic batching formed
+under that load (from /stats). The slices are random test slices of a
+converted dataset with --data_path, or noise of the model's input shape.
+
+Usage: python benchmarks/bench_serve.py --url http://127.0.0.1:8500 --concurrency 1,2,4,8,16
+
+'''
+
+import io
+import os
+import sys
+import json
+import time
+import argparse
+import threading
+import numpy as np
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+
+try:
+	from urllib.request import urlopen, Request
+except ImportError:
+	from urllib2 import urlopen, Request
+
+def post_slices(url, body):
+
+	request = Request(url + "/slices", data=body, headers={"Content-Type": "application/octet-stream"})
+	response = urlopen(request)
+	try:
+		return response.read()
+	finally:
+		response.close()
+
+def get_stats(url):
+
+	response = urlopen(url + "/stats")
+	try:
+		return json.loads(response.read().decode("utf-8"))
+	finally:
+		response.close()
+
+def npy_bytes(array):
+
+	out = io.BytesIO()
+	np.save(out, array)
+	return out.getvalue()
+
+def load_level(url, bodies, concurrency, duration):
+	"""
+	Runs concurrency client threads for duration seconds and returns the
+	latency of every request and the seconds they ran for.
+	"""
+
+	latencies = [[] for client in range(concurrency)]
+	errors = []
+	deadline = time.time() + duration
+
+	def client(number):
+		rng = np.random.RandomState(number)
+		while time.time() < deadline:
+			body = bodies[rng.randint(len(bodies))]
+			start_time = time.time()
+			try:
+				post_slices(url, body)
+			except Exception as error:
+				errors.append(error)
+				return
+			latencies[number].append(time.time() - start_time)
+
+	start_time = time.time()
+	threads = [threading.Thread(target=client, args=(number,)) for number in range(concurrency)]
+	for thread in threads:
+		thread.start()
+	for thread in threads:
+		thread.join()
+	if errors:
+		raise errors[0]
+
+	return np.concatenate([np.asarray(client_latencies) for client_latencies in latencies]), \
+		   time.time() - start_time
+
+if __name__ == "__main__":
+
+	parser = argparse.ArgumentParser()
+	parser.add_argument("--url", default="http://127.0.0.1:8500",
+						help="the address of serve.py")
+	parser.add_argument("--concurrency", default="1,2,4,8,16",
+						help="the comma separated numbers of concurrent clients")
+	parser.add_argument("--duration", type=float, default=10,
+						help="the seconds each concurrency level runs")
+	parser.add_argument("--slices", type=int, default=1,
+						help="the slices per request")
+	parser.add_argument("--data_path", default=None,
+						help="post test slices of this converted dataset instead of noise")
+	parser.add_argument("--mode", type=int, default=1,
+						help="the MODE of the test slices")
+	parser.add_argument("--shape", default="128,128,1",
+						help="the slice shape of the noise")
+	args = parser.parse_args()
+
+	if args.data_path is not None:
+		from preprocess import load_mode_data
+		import settings
+
+		imgs = load_mode_data(args.data_path, "_test", settings.IN_CHANNEL_NO,
+							  settings.OUT_CHANNEL_NO, args.mode)[0]
+		rows = np.sort(np.random.RandomState(816).choice(len(imgs), 64 * args.slices))
+		samples = np.asarray(imgs[rows], dtype=np.float32)
+	else:
+		shape = tuple(int(dim) for dim in args.shape.split(","))
+		samples = np.random.RandomState(816).normal(size=(64 * args.slices,) + shape).astype(np.float32)
+	bodies = [npy_bytes(samples[start:start+args.slices]) for start in range(0, len(samples), args.slices)]
+
+	post_slices(args.url, bodies[0])  # make sure the server is up
+	print("{:>11} {:>9} {:>9} {:>9} {:>9} {:>13} {:>10}".format("concurrency", "requests", "p50 ms",
+		  "p90 ms", "p99 ms", "images/sec", "mean batch"))
+	for concurrency in [int(level) for level in args.concurrency.split(",")]:
+		before = get_stats(args.url)["batches"]
+		latencies, seconds = load_level(args.url, bodies, concurrency, args.duration)
+		after = get_stats(args.url)["batches"]
+		batches = after["batches"] - before["batches"]
+		p50, p90, p99 = np.percentile(latencies * 1000, [50, 90, 99])
+		print("{:>11} {:>9} {:>9.1f} {:>9.1f} {:>9.1f} {:>13.1f} {:>10.1f}".format(concurrency,
+			  len(latencies), p50, p90, p99, len(latencies) * args.slices / seconds,
+			  (after["slices"] - before["slices"]) / float(batches) if batches else 0.0))
@@ -1,68 +1,129 @@
 import os
+import argparse
+import functools
+import json
+import zlib
+import multiprocessing
 import nibabel as nib
-import numpy.ma as ma
 import settings_dist
 import numpy as np
 from tqdm import tqdm
+from npy_writer import NpyAppendWriter
+from h5_store import H5AppendWriter
+from preprocess import pack_masks, save_dataset_info, save_normalization, RunningStats, \
+	INDEX_DTYPE, SUBJECT_DTYPE, TUMOR_LABELS
 
 root_dir = '/home/bduser/data_test/MICCAI_BraTS17_Data_Training'  # Replace with your BraTS data directory
 resize = 128  # Final dimension (square), set resize = 0 if no resizing is desired
+resample = "area"  # Resize images by "area" averaging or "bilinear" interpolation, or "crop" the center as before
+msk_resample = "majority"  # Resize masks to the "majority" label of each output pixel or the "nearest" label
 rotate = 3  # Number of counter-clockwise, 90 degree rotations
 save_path = settings_dist.OUT_PATH
 train_test_split = 0.85
 save_interval = 25
+img_dtype = "float32"  # Storage type of the normalized images (float16, float32 or float64)
+msk_format = "uint8"  # "uint8" one-hot channels or "packed" (all label channels in one byte)
+normalize = "subject"  # Normalize each modality per "subject", or store raw images and normalize by "global" dataset statistics when loading
+container = "npy"  # Store images and masks as plain "npy" files or chunked, compressed "hdf5" files
 
-def parse_segments(seg):
-	
-	# Each channel corresponds to a different region of the tumor, decouple and stack these
-	
-	msks_parsed = []
-	for slice in range(seg.shape[-1]):
-		curr = seg[:,:,slice]
-		GD = ma.masked_not_equal(curr,4).filled(fill_value=0)
-		edema = ma.masked_not_equal(curr,2).filled(fill_value=0)
-		necrotic = ma.masked_not_equal(curr,1).filled(fill_value=0)
-		none = ma.masked_not_equal(curr,0).filled(fill_value=0)
-
-		msks_parsed.append(np.dstack((none,necrotic,edema,GD)))
-	
-	# Replace all tumorous areas with 1 (previously marked as 1, 2 or 4)
-	mask = np.asarray(msks_parsed)
-	mask[mask > 0] = 1
+def parse_segments(seg, out=None):
+
+	# Each channel corresponds to a different region of the tumor, decouple and stack these.
+	# seg is the (slices, H, W) label volume from parse_images (and resize_data,
+	# so only the cropped region is expanded). A single label-equality broadcast
+	# fills the (slices, H, W, 4) mask with 1 wherever the voxel carries that label.
+	# The first ("none") channel has always been stored empty; mode 1 relies on
+	# summing all four channels, so it is kept that way.
+	mask = np.empty(seg.shape + (4,), dtype=np.uint8) if out is None else out
+	mask[...,0] = 0
+	np.equal(seg[...,np.newaxis], np.array([1,2,4], dtype=seg.dtype), out=mask[...,1:])
 
 	return mask
 
 def parse_images(img):
-	
-	slices = []
-	for slice in range(img.shape[-1]):
-		curr = img[:,:,slice]
-		slices.append(curr)
-	
-	return np.asarray(slices)
-
-def stack_img_slices(mode_track, stack_order):
-	
-	# Put final image channels in the order listed in stack_order
-	
-	full_brain = []
-	for slice in range(len(mode_track['t1'])):
-		current_slice = []
-		for mode in stack_order:
-			current_slice.append(mode_track[mode][slice,:,:])
-		full_brain.append(np.dstack(current_slice))
-	
-	# Normalize stacked images (inference will not work if this is not performed)
-	stack = np.asarray(full_brain)
-	stack = (stack - np.mean(stack))/(np.std(stack))
+
+	# (H, W, slices) -> (slices, H, W) view; no per-slice copies
+	return np.transpose(img, (2,0,1))
+
+def volume_stats(volume, block_slices=16):
+
+	# Streams over the raw (slices, H, W) volume a few slices at a time
+	stats = RunningStats()
+	for start in range(0, len(volume), block_slices):
+		stats.update(volume[start:start+block_slices])
+
+	return stats
+
+def stack_img_slices(mode_track, stack_order, stats=None, keep=None, out=None, dtype=np.float64):
+
+	# Put final image channels in the order listed in stack_order, normalizing
+	# each modality by its statistics on the way in (inference will not work if
+	# this is not performed). Without stats the raw intensities are stacked.
+	# keep: boolean mask of the slices to stack, all of them by default
+	# out: array to stack into, a new one of dtype by default
+	# Each slice is normalized in float64 in a one-slice buffer that stays in
+	# cache and then stored in out, converting it to out's type on the way, so
+	# the interleaved channels of out are written once.
+	first = mode_track[stack_order[0]]
+	rows = np.arange(len(first)) if keep is None else np.flatnonzero(keep)
+	shape = (len(rows),) + first.shape[1:] + (len(stack_order),)
+	stack = np.empty(shape, dtype=dtype) if out is None else out
+	buffer = np.empty(shape[1:], dtype=np.float64)
+	for position, row in enumerate(rows):
+		for channel, mode in enumerate(stack_order):
+			if stats is None:
+				buffer[...,channel] = mode_track[mode][row]
+			else:
+				np.subtract(mode_track[mode][row], stats[channel].mean, out=buffer[...,channel])
+				buffer[...,channel] /= stats[channel].std or 1.0
+		stack[position] = buffer
 
 	return stack
 
+# Raw volumes are decompressed into buffers that each process reuses for every
+# subject it converts, so reading allocates nothing once the largest volume
+# has been seen
+_buffers = {}
+
+def reusable_array(key, shape, dtype, order="C"):
+
+	# Array backed by the process-wide buffer for key, grown only when too small.
+	# Its contents are overwritten by the next call for the same key.
+	nbytes = int(np.prod(shape)) * np.dtype(dtype).itemsize
+	if key not in _buffers or len(_buffers[key]) < nbytes:
+		_buffers[key] = bytearray(nbytes)
+
+	return np.ndarray(shape, dtype, buffer=_buffers[key], order=order)
+
+def read_volume(path, key):
+
+	# Decompresses the voxels of a NIfTI file straight into the reusable buffer
+	# for key, without the intermediate arrays of np.array(img.dataobj). Scaled
+	# or unusual files fall back to nibabel.
+	proxy = nib.load(path).dataobj
+	if (not isinstance(proxy, nib.arrayproxy.ArrayProxy) or proxy.order != "F"
+			or proxy.slope != 1 or proxy.inter != 0):
+		return np.asanyarray(proxy)
+
+	volume = reusable_array(key, proxy.shape, proxy.dtype, order="F")
+	view = memoryview(_buffers[key])[:volume.nbytes]
+	with nib.openers.ImageOpener(proxy.file_like) as f:
+		f.seek(proxy.offset)
+		filled = 0
+		while filled < len(view):
+			count = f.readinto(view[filled:])
+			if not count:
+				raise IOError("{} is truncated".format(path))
+			filled += count
+
+	return volume
+
 def resize_data(dataset, new_size):
 
-	# Test/Train images must be the same size
+	# Test/Train images must be the same size. Cropping and rotating only change
+	# the strides, so the result is a view of dataset.
 
-	start_index = (dataset.shape[1] - new_size)/2
+	start_index = max(dataset.shape[1] - new_size, 0)//2 if new_size else 0
 	end_index = dataset.shape[1] - start_index
 
 	if rotate != 0:
@@ -72,99 +133,483 @@ def resize_data(dataset, new_size):
 
 	return resized
 
-def save_data(imgs_all, msks_all, split, save_path):
-	
-	imgs_all = np.asarray(imgs_all)
-	msks_all = np.asarray(msks_all)
-
-	# Split entire dataset into train/test sets
-	train_size = int(msks_all.shape[0]*split)
-	new_imgs_train = imgs_all[0:train_size,:,:,:]
-	new_msks_train = msks_all[0:train_size,:,:,:]
-	new_imgs_test = imgs_all[train_size:,:,:,:]
-	new_msks_test = msks_all[train_size:,:,:,:]
-
-	if os.path.isfile("{}imgs_train.npy".format(save_path)):
-
-		# Open one file at a time (these will be large) and clear buffer immediately after concatenate/save
-		
-		imgs_train = np.load("{}imgs_train.npy".format(save_path))
-		np.save("{}imgs_train.npy".format(save_path), np.concatenate((imgs_train,new_imgs_train), axis = 0))
-		imgs_train = []
-		
-		msks_train = np.load("{}msks_train.npy".format(save_path))
-		np.save("{}msks_train.npy".format(save_path), np.concatenate((msks_train,new_msks_train), axis = 0))
-		msks_train = []
-		
-		imgs_test = np.load("{}imgs_test.npy".format(save_path))
-		np.save("{}imgs_test.npy".format(save_path), np.concatenate((imgs_test,new_imgs_test), axis = 0))
-		imgs_test = []
-		
-		msks_test = np.load("{}msks_test.npy".format(save_path))
-		np.save("{}msks_test.npy".format(save_path), np.concatenate((msks_test,new_msks_test), axis = 0))
-		msks_test = []
+def stored_spacing(zooms, shape, size, resample=resample):
+
+	# (z, y, x) size in mm of the stored voxels of an (H, W, slices) volume of
+	# the given voxel size (the zooms of its NIfTI header), cropped or
+	# resampled to size and rotated by resize_data
+	rows, cols = float(zooms[0]), float(zooms[1])
+	if resample != "crop":
+		rows, cols = rows * shape[0] / size, cols * shape[1] / size
+	if rotate % 2:
+		rows, cols = cols, rows
+
+	return (float(zooms[2]), rows, cols)
+
+def resample_weights(old_size, new_size, method="area"):
+
+	# (new_size, old_size) matrix that resamples one axis of a slice. "area"
+	# averages the input pixels each output pixel covers (by the fraction
+	# covered), "bilinear" interpolates between the two nearest pixel centers.
+	scale = float(old_size) / new_size
+	if method == "area":
+		edges = np.arange(new_size + 1) * scale
+		pixels = np.arange(old_size)
+		weights = np.clip(np.minimum(edges[1:,np.newaxis], pixels + 1) -
+						  np.maximum(edges[:-1,np.newaxis], pixels), 0, None)
+	elif method == "bilinear":
+		centers = np.clip((np.arange(new_size) + 0.5) * scale - 0.5, 0, old_size - 1)
+		lower = np.floor(centers).astype(int)
+		upper = np.minimum(lower + 1, old_size - 1)
+		weights = np.zeros((new_size, old_size))
+		np.add.at(weights, (np.arange(new_size), lower), 1 - (centers - lower))
+		np.add.at(weights, (np.arange(new_size), upper), centers - lower)
+	else:
+		raise ValueError("Unknown resampling method {}".format(method))
+
+	return weights / weights.sum(axis=1, keepdims=True)
+
+def resample_volume(volume, new_size, method="area", key=None):
+
+	# Resizes every (H, W) slice of a (slices, H, W) volume to new_size x new_size
+	# with two matrix products over the whole volume. Masks are resampled as
+	# label volumes: "nearest" picks the closest input label and "majority" the
+	# label covering most of the output pixel's area.
+	# key: returns float results in reusable buffers named after key
+	if not new_size or volume.shape[1:] == (new_size, new_size):
+		return volume
+
+	if method == "nearest":
+		rows = ((np.arange(new_size) + 0.5) * volume.shape[1] / new_size).astype(int)
+		cols = ((np.arange(new_size) + 0.5) * volume.shape[2] / new_size).astype(int)
+		return volume[:, rows[:,np.newaxis], cols]
+
+	if method == "majority":
+		# Area covered by each tumor label, the background covers the rest.
+		# Single precision is plenty to pick the largest.
+		rows = resample_weights(volume.shape[1], new_size).astype(np.float32)
+		cols = resample_weights(volume.shape[2], new_size).astype(np.float32)
+		fractions = np.empty((len(volume), new_size, new_size, len(TUMOR_LABELS) + 1), dtype=np.float32)
+		for channel, label in enumerate(TUMOR_LABELS, 1):
+			covered = np.tensordot((volume == label).astype(np.float32), rows, axes=(1, 1))
+			fractions[...,channel] = np.tensordot(covered, cols, axes=(1, 1))
+		fractions[...,0] = 1 - fractions[...,1:].sum(axis=-1)
+		return np.asarray((0,) + TUMOR_LABELS, dtype=volume.dtype)[fractions.argmax(axis=-1)]
+
+	rows = resample_weights(volume.shape[1], new_size, method)
+	cols = resample_weights(volume.shape[2], new_size, method)
+	if key is None:
+		return np.matmul(np.matmul(rows, volume), cols.T)
+
+	partial = reusable_array(key + "_rows", (len(volume), new_size, volume.shape[2]), np.float64)
+	out = reusable_array(key, (len(volume), new_size, new_size), np.float64)
+	np.matmul(rows, volume, out=partial)
+	np.matmul(partial, cols.T, out=out)
+
+	return out
+
+def load_manifest(save_path):
+
+	fn = "{}conversion_manifest.json".format(save_path)
+	if not os.path.isfile(fn):
+		return None
+
+	with open(fn) as f:
+		return json.load(f)
+
+def save_manifest(save_path, manifest):
+
+	# Write then rename so an interrupted run never leaves a partial manifest
+	fn = "{}conversion_manifest.json".format(save_path)
+	with open(fn + ".tmp", "w") as f:
+		json.dump(manifest, f, indent=2, sort_keys=True)
+	os.rename(fn + ".tmp", fn)
+
+def open_writers(save_path, img_dtype=img_dtype, msk_format=msk_format, rows=None,
+				 normalize=normalize, container=container):
+
+	# rows: committed row count per output file when resuming, None to start over
+
+	save_dataset_info(save_path, {"img_dtype": np.dtype(img_dtype).name,
+								  "msk_format": msk_format,
+								  "msk_channels": 4,
+								  "normalize": normalize,
+								  "container": container})
+
+	dtypes = {"imgs": img_dtype, "msks": np.uint8, "index": INDEX_DTYPE, "subjects": SUBJECT_DTYPE}
+	writers = {}
+	for prefix in ["_train", "_test"]:
+		for name, dtype in dtypes.items():
+			# The small index and subjects tables stay .npy in either container;
+			# HDF5 arrays get one slice per chunk for shuffled batch reads
+			if container == "hdf5" and name in ["imgs", "msks"]:
+				writers[name+prefix] = H5AppendWriter("{}{}{}.h5".format(save_path, name, prefix),
+													  dtype, append=rows is not None)
+			else:
+				writers[name+prefix] = NpyAppendWriter("{}{}{}.npy".format(save_path, name, prefix),
+													   dtype, append=rows is not None)
+
+	# Drop anything written after the last manifest checkpoint
+	if rows is not None:
+		for name, writer in writers.items():
+			writer.truncate(rows.get(name, 0))
+
+	return writers
+
+def save_data(chunk, splits, writers):
+
+	# Each chunk is appended to the output files exactly once, so peak memory
+	# is bounded by one chunk of save_interval scans. Every subject goes as a
+	# whole to the split it was assigned, so no patient is in both sets.
+	# writers: the output files of each size, in the order of the subjects' levels
+	for name, levels, index in chunk:
+
+		prefix = splits[name]
+		for (imgs, msks, subject), level_writers in zip(levels, writers):
+
+			subjects = level_writers["subjects"+prefix]
+			index["subject"] = subjects.rows
+			entry = subject.copy()
+			entry["start"] = level_writers["imgs"+prefix].rows
+			entry["stop"] = entry["start"] + len(imgs)
+
+			level_writers["imgs"+prefix].append(imgs)
+			level_writers["msks"+prefix].append(msks)
+			level_writers["index"+prefix].append(index)
+			subjects.append(entry)
+
+	# Keep the files loadable after every chunk
+	for level_writers in writers:
+		for writer in level_writers.values():
+			writer.flush()
+
+def split_subjects(names, split, seed=816, volumes=None, strata=4):
+
+	# Assigns whole subjects to "_train" or "_test". Subjects are shuffled with
+	# a fixed seed, and with tumor volumes given, each volume quantile
+	# (stratum) is split separately so both sets see small and large tumors.
+	order = np.argsort(names, kind="mergesort")
+	if volumes is not None:
+		order = order[np.argsort(np.asarray(volumes)[order], kind="mergesort")]
+		groups = np.array_split(order, min(strata, len(order)) or 1)
+	else:
+		groups = [order]
+
+	# The test set is sized over all the subjects, not per stratum, so small
+	# strata cannot round it away; it takes the same share of every stratum by
+	# ordering subjects on their relative position in their shuffled stratum
+	rng = np.random.RandomState(seed)
+	shuffled, positions = [], []
+	for group in groups:
+		shuffled.append(group[rng.permutation(len(group))])
+		positions.append((np.arange(len(group)) + 0.5) / len(group))
+	order = np.concatenate(shuffled)[np.argsort(np.concatenate(positions), kind="mergesort")]
+
+	train_size = int(round(len(order)*split))
+	if len(order) >= 2:
+		train_size = min(train_size, len(order) - 1)
 
+	return {names[subject]: "_train" if position < train_size else "_test"
+			for position, subject in enumerate(order)}
+
+def tumor_volume(subject):
+
+	subdir, files = subject
+	for file in files:
+		if file.endswith('seg.nii.gz'):
+			return int(np.count_nonzero(read_volume(os.path.join(subdir,file), "seg")))
+
+	return 0
+
+img_modes = ["t1","t2","flair","t1ce"]
+
+def find_subjects(root_dir):
+
+	# Walk once up front so serial and parallel runs see the same subject order
+	subjects = []
+	for subdir, dir, files in os.walk(root_dir):
+
+		# Ensure all necessary files are present
+		file_root = subdir.split('/')[-1] + "_"
+		extension = ".nii.gz"
+		need_file = [file_root + mode + extension for mode in img_modes]
+		all_there = [(reqd in files) for reqd in need_file]
+		if all(all_there):
+			subjects.append((subdir, files))
+
+	return subjects
+
+def select_slices(name, imgs_empty, tumor, drop_empty=False, tumor_free_ratio=1.0, seed=816):
+
+	# Returns a boolean mask of the slices to keep. The tumor-free slices kept are
+	# drawn from a generator seeded by the subject name, so the selection is the
+	# same for every run and worker ordering.
+	keep = ~imgs_empty if drop_empty else np.ones(len(tumor), dtype=bool)
+
+	tumor_free = np.flatnonzero(keep & ~tumor)
+	if tumor_free_ratio < 1.0:
+		rng = np.random.RandomState((seed + zlib.crc32(name.encode("utf-8"))) % 2**32)
+		dropped = rng.choice(tumor_free, len(tumor_free) - int(round(tumor_free_ratio*len(tumor_free))),
+							 replace=False)
+		keep[dropped] = False
+
+	return keep
+
+def process_subject(subject, img_dtype=img_dtype, msk_format=msk_format,
+					drop_empty=False, tumor_free_ratio=1.0, seed=816, normalize=normalize,
+					sizes=None, resample=resample, msk_resample=msk_resample):
+
+	# sizes: the output sizes, [resize] by default. Returns one (imgs, msks,
+	# subject) entry per size, all built from the same slices. Each size is
+	# normalized by the statistics of its own whole volume, before any slices
+	# are dropped, as serve.py normalizes the volumes it segments.
+	if sizes is None:
+		sizes = [resize]
+
+	# With "crop" the slice selection uses the cropped volume, otherwise the
+	# whole volume that every size is resampled from
+	if resample == "crop":
+		prepare = lambda volume: resize_data(volume, sizes[0])
+	else:
+		prepare = lambda volume: volume
+
+	subdir, files = subject
+	mode_track = {mode:[] for mode in img_modes}
+	labels = []
+
+	# The volumes are views of the read buffers and the resampled volumes, masks
+	# and image slab are built in reusable buffers too; only the kept slices are
+	# copied out in the storage format
+	for file in files:
+
+		path = os.path.join(subdir,file)
+		if file.endswith('seg.nii.gz'):
+			labels = prepare(parse_images(read_volume(path, "seg")))
+			header = nib.load(path).header
+
+		for mode in img_modes:
+			if file.endswith(mode+'.nii.gz'):
+				mode_track[mode] = prepare(parse_images(read_volume(path, mode)))
+
+	name = os.path.basename(subdir)
+	depth = len(labels)
+
+	# Per-slice entries for the dataset index; the subject id is assigned when saving
+	index = np.zeros(depth, dtype=INDEX_DTYPE)
+	index["subject"] = -1
+	index["z"] = np.arange(depth)
+	index["voxels"] = np.stack([np.count_nonzero(labels == label, axis=(1,2))
+								for label in TUMOR_LABELS], axis=-1)
+
+	# Drop slices before they are normalized and stored
+	imgs_empty = np.ones(depth, dtype=bool)
+	for mode in img_modes:
+		imgs_empty &= ~mode_track[mode].any(axis=(1,2))
+	tumor = index["voxels"].sum(axis=1) > 0
+	keep = select_slices(name, imgs_empty, tumor, drop_empty, tumor_free_ratio, seed)
+	index = index[keep]
+
+	# The subjects table records what was dropped; rows are filled in when saving
+	subject = np.zeros(1, dtype=SUBJECT_DTYPE)
+	subject["name"] = name
+	subject["depth"] = depth
+	subject["dropped_empty"] = np.count_nonzero(imgs_empty) if drop_empty else 0
+	subject["dropped_tumor_free"] = depth - subject["dropped_empty"] - len(index)
+
+	# Convert to the storage format here so less data is sent back from the workers
+	levels = []
+	for size in sizes:
+
+		if resample == "crop":
+			seg, level_track = labels, mode_track
+		else:
+			seg = resize_data(resample_volume(labels, size, msk_resample), 0)
+			level_track = {mode: resize_data(resample_volume(mode_track[mode], size, resample, "resampled_"+mode), 0)
+						   for mode in img_modes}
+
+		# Statistics of the whole volume at this size, before any slices are dropped
+		stats = [volume_stats(level_track[mode]) for mode in img_modes]
+		level_subject = subject.copy()
+		level_subject["voxel_count"] = stats[0].count
+		level_subject["mean"] = [s.mean for s in stats]
+		level_subject["std"] = [s.std for s in stats]
+		level_subject["spacing"] = stored_spacing(header.get_zooms(), header.get_data_shape(), size, resample)
+
+		msks = parse_segments(seg, reusable_array("mask", seg.shape + (4,), np.uint8))[keep]
+		imgs = stack_img_slices(level_track,img_modes,
+								stats if normalize == "subject" else None, keep, dtype=img_dtype)
+		if msk_format == "packed":
+			msks = pack_masks(msks)
+		levels.append((imgs, msks, level_subject))
+
+	return name, levels, index
+
+def convert(root_dir, save_path, workers=1, img_dtype=img_dtype, msk_format=msk_format,
+			incremental=False, drop_empty=False, tumor_free_ratio=1.0, seed=816,
+			normalize=normalize, split=train_test_split, stratify=False, container=container,
+			sizes=None, resample=resample, msk_resample=msk_resample):
+
+	if normalize == "global" and np.dtype(img_dtype) == np.float16:
+		raise ValueError("Raw intensities do not fit float16; use float32 images with global normalization")
+
+	# Several sizes are written in one pass, each to its own subdirectory
+	if sizes is None:
+		sizes = [resize]
+	if resample == "crop" and len(sizes) > 1:
+		raise ValueError("Only one size can be cropped; resample to write several sizes")
+	if len(sizes) == 1:
+		level_paths = [save_path]
+	else:
+		level_paths = [os.path.join(save_path, str(size), "") for size in sizes]
+		for path in level_paths:
+			if not os.path.isdir(path):
+				os.makedirs(path)
+
+	# Every subject is recorded in the manifest once its slices are committed,
+	# so an incremental run only converts subjects that are not there yet
+	options = {"img_dtype": np.dtype(img_dtype).name, "msk_format": msk_format,
+			   "resize": sizes, "resample": resample, "msk_resample": msk_resample, "rotate": rotate, "train_test_split": split,
+			   "drop_empty": drop_empty, "tumor_free_ratio": tumor_free_ratio, "seed": seed,
+			   "normalize": normalize, "stratify": stratify, "container": container}
+	manifest = load_manifest(save_path) if incremental else None
+	if manifest is None:
+		manifest = {"options": options, "completed": [], "rows": None,
+					"stats": [[RunningStats().state() for mode in img_modes] for path in level_paths],
+					"splits": {}}
+	elif manifest["options"] != options:
+		raise ValueError("Existing output in {} was converted with {}, not {}. "
+						 "Convert without --incremental to start over.".format(save_path, manifest["options"], options))
+
+	completed = set(manifest["completed"])
+	subjects = [subject for subject in find_subjects(root_dir)
+				if os.path.basename(subject[0]) not in completed]
+	if len(completed) > 0:
+		print("Skipping {} converted subjects, {} new".format(len(completed), len(subjects)))
+
+	writers = [open_writers(path, img_dtype, msk_format,
+							manifest["rows"][level] if manifest["rows"] else None,
+							normalize, container)
+			   for level, path in enumerate(level_paths)]
+	process = functools.partial(process_subject, img_dtype=img_dtype, msk_format=msk_format,
+								drop_empty=drop_empty, tumor_free_ratio=tumor_free_ratio, seed=seed,
+								normalize=normalize, sizes=sizes, resample=resample,
+								msk_resample=msk_resample)
+
+	# Dataset statistics of each size per modality, merged from each subject's statistics
+	stats = [[RunningStats(**state) for state in level_stats] for level_stats in manifest["stats"]]
+
+	# imap hands results back in submission order, so the output is identical
+	# to a serial run no matter which worker finishes first
+	pool = None
+	if workers > 1:
+		pool = multiprocessing.Pool(workers)
+		imap = pool.imap
 	else:
-		
-		np.save("{}imgs_train.npy".format(save_path), new_imgs_train)
-		np.save("{}msks_train.npy".format(save_path), new_msks_train)
-		np.save("{}imgs_test.npy".format(save_path), new_imgs_test)
-		np.save("{}msks_test.npy".format(save_path), new_msks_test)
-
-imgs_all = []
-msks_all = []
-scan_count = 0
-
-for subdir, dir, files in tqdm(os.walk(root_dir)):
-
-	# Ensure all necessary files are present
-	file_root = subdir.split('/')[-1] + "_"
-	extension = ".nii.gz"
-	img_modes = ["t1","t2","flair","t1ce"]
-	need_file = [file_root + mode + extension for mode in img_modes]
-	all_there = [(reqd in files) for reqd in need_file]
-	if all(all_there):
-
-		mode_track = {mode:[] for mode in img_modes}
-		
-		for file in files:
-
-			if file.endswith('seg.nii.gz'):
-				path = os.path.join(subdir,file)
-				msk = np.array(nib.load(path).dataobj)
-				parsed = resize_data(parse_segments(msk), resize)
-				msks_all.extend(parsed)
-
-			if file.endswith('t1.nii.gz'):
-				path = os.path.join(subdir,file)
-				img = np.array(nib.load(path).dataobj)
-				mode_track['t1'] = resize_data(parse_images(img), resize)
-
-			if file.endswith('t2.nii.gz'):
-				path = os.path.join(subdir,file)
-				img = np.array(nib.load(path).dataobj)
-				mode_track['t2'] = resize_data(parse_images(img), resize)
-
-			if file.endswith('t1ce.nii.gz'):
-				path = os.path.join(subdir,file)
-				img = np.array(nib.load(path).dataobj)
-				mode_track['t1ce'] = resize_data(parse_images(img), resize)
-
-			if file.endswith('flair.nii.gz'):
-				path = os.path.join(subdir,file)
-				img = np.array(nib.load(path).dataobj)
-				mode_track['flair'] = resize_data(parse_images(img), resize)
-
-		scan_count += 1
-		imgs_all.extend(np.asarray(stack_img_slices(mode_track,img_modes)))
-
-	if (scan_count%save_interval == 0) & (scan_count != 0):
-		print("Total scans processed: {}".format(scan_count))
-		save_data(imgs_all, msks_all, train_test_split, save_path)
-		imgs_all = []
-		msks_all = []
-
-# Save any leftover files - may miss a few at the end if the dataset size changes, this will catch those
-if len(imgs_all) > 0:
-	save_data(imgs_all, msks_all, train_test_split, save_path)
+		imap = lambda func, items: (func(item) for item in items)
+
+	# Assign every new subject to a split before anything is converted. A
+	# resumed run keeps the splits already saved, so its output matches a
+	# clean run; only subjects added since then are split among themselves.
+	unsplit = [subject for subject in subjects
+			   if os.path.basename(subject[0]) not in manifest["splits"]]
+	if len(unsplit) > 0:
+		names = [os.path.basename(subject[0]) for subject in unsplit]
+		volumes = None
+		if stratify:
+			print("Measuring tumor volumes for stratification")
+			volumes = list(tqdm(imap(tumor_volume, unsplit), total=len(unsplit)))
+		manifest["splits"].update(split_subjects(names, split, seed, volumes))
+		save_manifest(save_path, manifest)
+
+	def checkpoint(chunk):
+		save_data(chunk, manifest["splits"], writers)
+		for name, levels, index in chunk:
+			for (imgs, msks, subject), level_stats in zip(levels, stats):
+				for channel in range(len(img_modes)):
+					level_stats[channel].merge(RunningStats(subject["voxel_count"][0], subject["mean"][0,channel],
+															subject["voxel_count"][0] * subject["std"][0,channel]**2))
+		for path, level_stats in zip(level_paths, stats):
+			save_normalization(path, normalize, img_modes, level_stats)
+		manifest["completed"].extend(result[0] for result in chunk)
+		manifest["rows"] = [{name: writer.rows for name, writer in level_writers.items()}
+							for level_writers in writers]
+		manifest["stats"] = [[s.state() for s in level_stats] for level_stats in stats]
+		save_manifest(save_path, manifest)
+
+	chunk = []
+	scan_count = 0
+
+	try:
+		for result in tqdm(imap(process, subjects), total=len(subjects)):
+
+			scan_count += 1
+			chunk.append(result)
+
+			if scan_count%save_interval == 0:
+				print("Total scans processed: {}".format(scan_count))
+				checkpoint(chunk)
+				chunk = []
+	finally:
+		if pool is not None:
+			pool.close()
+			pool.join()
+
+	# Save any leftover files - may miss a few at the end if the dataset size changes, this will catch those
+	if len(chunk) > 0:
+		checkpoint(chunk)
+
+	for level_writers in writers:
+		for writer in level_writers.values():
+			writer.close()
+	save_manifest(save_path, manifest)
+
 	print("Total scans processed: {}\nDone.".format(scan_count))
+
+if __name__ == "__main__":
+
+	parser = argparse.ArgumentParser()
+	parser.add_argument("--root_dir", default=root_dir,
+						help="the BraTS data directory")
+	parser.add_argument("--save_path", default=save_path,
+						help="the directory to write the .npy files to")
+	parser.add_argument("--workers", type=int, default=1,
+						help="the number of processes used to convert subjects")
+	parser.add_argument("--img_dtype", default=img_dtype,
+						choices=["float16", "float32", "float64"],
+						help="the storage type of the normalized images")
+	parser.add_argument("--msk_format", default=msk_format,
+						choices=["uint8", "packed"],
+						help="store masks as uint8 channels or bit-packed into one byte")
+	parser.add_argument("--incremental", action="store_true", default=False,
+						help="resume an interrupted conversion and append only new subjects")
+	parser.add_argument("--drop_empty", action="store_true", default=False,
+						help="skip slices that are zero in every image modality")
+	parser.add_argument("--tumor_free_ratio", type=float, default=1.0,
+						help="the fraction of tumor-free slices to keep")
+	parser.add_argument("--seed", type=int, default=816,
+						help="seed for choosing which tumor-free slices are kept")
+	parser.add_argument("--normalize", default=normalize, choices=["subject", "global"],
+						help="normalize each subject's modalities, or store raw images and "
+						"normalize by the dataset statistics when loading")
+	parser.add_argument("--train_test_split", type=float, default=train_test_split,
+						help="the fraction of subjects assigned to the training set")
+	parser.add_argument("--stratify", action="store_true", default=False,
+						help="balance tumor volumes between the training and test subjects")
+	parser.add_argument("--resize", type=int, nargs="+", default=[resize],
+						help="the output size of the slices; several sizes (e.g. 64 128 240) "
+						"are written in one pass to a subdirectory each")
+	parser.add_argument("--resample", default=resample, choices=["area", "bilinear", "crop"],
+						help="resize images by area averaging or bilinear interpolation, "
+						"or crop the center of the slices")
+	parser.add_argument("--msk_resample", default=msk_resample, choices=["majority", "nearest"],
+						help="resize masks to the majority or the nearest label")
+	parser.add_argument("--container", default=container, choices=["npy", "hdf5"],
+						help="store images and masks as .npy files or chunked, compressed "
+						"HDF5 files (Blosc/LZ4 with hdf5plugin installed, gzip otherwise)")
+	args = parser.parse_args()
+
+	convert(args.root_dir, args.save_path, args.workers,
+			args.img_dtype, args.msk_format, args.incremental,
+			args.drop_empty, args.tumor_free_ratio, args.seed, args.normalize,
+			args.train_test_split, args.stratify, args.container,
+			args.resize, args.resample, args.msk_resample)
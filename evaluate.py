@@ -0,0 +1,302 @@
+'''
+
+Per-subject 3D evaluation of a trained U-Net on the test split, the way
+BraTS reports it. Predictions are streamed batch by batch, either straight
+from the model or from an .npy file saved by inference.py, and placed into
+the volume of the subject they belong to using the index and subjects
+tables written by converter.py. Once the stream has passed a subject's last
+slice, its Dice, sensitivity and 95th percentile Hausdorff distance are
+computed and its volumes are released, so only the subjects in progress are
+held in memory.
+
+Each region is the tumor labels a MODE's masks are made of (whole tumor for
+MODE 1, enhancing tumor for MODE 2, labels 2 and 4 for MODE 3), predicted by
+the model trained for that MODE.
+
+Usage: python evaluate.py --data_path <OUT_PATH> --region 1 [--region 2=msks_pred_mode2.npy]
+
+'''
+
+import os
+import csv
+import collections
+import numpy as np
+from preprocess import DatasetIndex, MODE_CHANNELS, TUMOR_LABELS
+
+REGION_NAMES = {(1, 2, 4): "whole tumor", (1, 4): "tumor core", (4,): "enhancing tumor"}
+
+def region_labels(mode):
+	"""
+	Returns the tumor labels in the masks of a MODE.
+	"""
+
+	msk_channels = MODE_CHANNELS.get(mode, ([], [0,1,2,3]))[1]
+	return tuple(TUMOR_LABELS[channel - 1] for channel in msk_channels if channel > 0)
+
+def region_name(mode):
+
+	labels = region_labels(mode)
+	return REGION_NAMES.get(labels, "labels " + "+".join(str(label) for label in labels))
+
+def surface(mask):
+	"""
+	Returns the voxels of a 3D mask with a 6-connected neighbour outside it;
+	voxels on the border of the volume are surface voxels too.
+	"""
+
+	padded = np.pad(mask, 1, mode="constant")
+	interior = mask.copy()
+	for axis in range(3):
+		for shift in (-1, 1):
+			interior &= np.roll(padded, shift, axis=axis)[1:-1, 1:-1, 1:-1]
+
+	return mask & ~interior
+
+def surface_distances(from_mask, to_mask, spacing, block=2048):
+	"""
+	Returns the distance in mm from every surface voxel of from_mask to the
+	nearest surface voxel of to_mask.
+	"""
+
+	from_surface, to_surface = surface(from_mask), surface(to_mask)
+	try:
+		from scipy import ndimage
+	except ImportError:
+		# Nearest neighbours by brute force, a block of voxels at a time
+		to_points = np.argwhere(to_surface) * spacing
+		distances = []
+		for points in np.array_split(np.argwhere(from_surface) * spacing,
+									 max(1, int(np.count_nonzero(from_surface)) // block)):
+			squared = np.full(len(points), np.inf)
+			for start in range(0, len(to_points), block):
+				delta = points[:, np.newaxis] - to_points[np.newaxis, start:start+block]
+				squared = np.minimum(squared, (delta**2).sum(axis=-1).min(axis=1))
+			distances.append(np.sqrt(squared))
+		return np.concatenate(distances)
+
+	return ndimage.distance_transform_edt(~to_surface, sampling=spacing)[from_surface]
+
+def region_metrics(pred, true, spacing):
+	"""
+	Returns the Dice, sensitivity and 95th percentile Hausdorff distance (in
+	mm) of a predicted 3D mask against the ground truth, with the voxel counts.
+	---
+	spacing: the (z, y, x) voxel size in mm
+
+	As in BraTS, two empty masks score a Dice of 1 and a distance of 0, and a
+	mask that is empty while the other is not gets the diagonal of the volume
+	as its distance. Sensitivity is NaN without ground truth voxels.
+	"""
+
+	true_voxels, pred_voxels = int(np.count_nonzero(true)), int(np.count_nonzero(pred))
+	overlap = int(np.count_nonzero(pred & true))
+
+	if true_voxels == 0 and pred_voxels == 0:
+		dice, hd95 = 1.0, 0.0
+	else:
+		dice = 2.0 * overlap / (true_voxels + pred_voxels)
+		if true_voxels == 0 or pred_voxels == 0:
+			hd95 = float(np.sqrt(((np.asarray(pred.shape) * spacing)**2).sum()))
+		else:
+			hd95 = float(max(np.percentile(surface_distances(pred, true, spacing), 95),
+							 np.percentile(surface_distances(true, pred, spacing), 95)))
+
+	return collections.OrderedDict([
+		("dice", dice),
+		("sensitivity", overlap / float(true_voxels) if true_voxels else float("nan")),
+		("hd95", hd95),
+		("true_voxels", true_voxels),
+		("pred_voxels", pred_voxels)])
+
+class SubjectEvaluator(object):
+	"""
+	Reassembles streamed slice predictions and ground truth into per-subject
+	volumes and scores each subject once all its slices have arrived.
+	---
+	index: the DatasetIndex of the split, whose rows the slices arrive in order of
+	spacing: the (z, y, x) voxel size in mm, or None for the size the
+	converter recorded for each subject
+	threshold: the probability above which a voxel is predicted as tumor
+
+	Slices the converter dropped (--drop_empty, --tumor_free_ratio) are
+	tumor-free, and are counted as predicted tumor-free too.
+	"""
+
+	def __init__(self, index, spacing, threshold=0.5):
+
+		self.index = index
+		self.spacing = None if spacing is None else np.asarray(spacing, dtype=np.float64)
+		if spacing is None and "spacing" not in index.subjects.dtype.names:
+			raise ValueError("The dataset was converted without the voxel sizes of its subjects; "
+							 "give the spacing or convert it again")
+		self.threshold = threshold
+		self.row = 0
+		self._open = collections.OrderedDict()
+
+		# A subject is complete once the stream passes the last of its rows
+		self._last_row = {}
+		for entry in index.subjects:
+			self._last_row[entry["name"]] = max(self._last_row.get(entry["name"], 0), int(entry["stop"]))
+
+	def add(self, pred, true):
+		"""
+		Adds the next (N, H, W) predicted probabilities and ground truth masks
+		of the stream and returns the [(subject, metrics)] it completed.
+		"""
+
+		rows = slice(self.row, self.row + len(pred))
+		names, z = self.index.slice_subjects(rows)
+		pred = np.asarray(pred) > self.threshold
+		true = np.asarray(true) > 0.5
+		self.row = rows.stop
+
+		for name in np.unique(names):
+			if name not in self._open:
+				depth = int(self.index.subjects["depth"][self.index.subjects["name"] == name][0])
+				self._open[name] = (np.zeros((depth,) + pred.shape[1:], dtype=bool),
+									np.zeros((depth,) + true.shape[1:], dtype=bool))
+			in_subject = names == name
+			self._open[name][0][z[in_subject]] = pred[in_subject]
+			self._open[name][1][z[in_subject]] = true[in_subject]
+
+		return [self._score(name) for name in list(self._open) if self._last_row[name] <= self.row]
+
+	def finish(self):
+		"""
+		Returns the [(subject, metrics)] of the subjects still open, for streams
+		that end early.
+		"""
+
+		return [self._score(name) for name in list(self._open)]
+
+	def _score(self, name):
+
+		pred, true = self._open.pop(name)
+		spacing = self.spacing
+		if spacing is None:
+			spacing = self.index.subjects["spacing"][self.index.subjects["name"] == name][0]
+		return name, region_metrics(pred, true, spacing)
+
+def slice_blocks(array, block_size=256):
+
+	for start in range(0, len(array), block_size):
+		yield np.asarray(array[start:start+block_size])
+
+def first_channel(block, channels_first=False):
+	"""
+	Returns channel 0 of a block of model outputs as (N, H, W) slices.
+	"""
+
+	if channels_first:
+		block = np.swapaxes(block, -1, -3)
+	return block[..., 0]
+
+def evaluate_region(index, predictions, msks, spacing, channels_first=False, threshold=0.5):
+	"""
+	Yields (subject, metrics) for each subject of a region, in the order the
+	subjects are completed.
+	---
+	predictions: an iterable of blocks of model outputs, in row order
+	msks: the row-indexed ground truth of the region (from load_mode_data)
+	"""
+
+	evaluator = SubjectEvaluator(index, spacing, threshold)
+	for pred in predictions:
+		true = msks[evaluator.row:evaluator.row + len(pred)]
+		for result in evaluator.add(first_channel(pred, channels_first), first_channel(true, channels_first)):
+			yield result
+	for result in evaluator.finish():
+		yield result
+
+def print_summary(results):
+	"""
+	Prints the mean, median and worst case of each metric per region.
+	---
+	results: {region: [metrics, ...]}
+	"""
+
+	width = max([22] + [len(region) for region in results])
+	print("{:<{}} {:>8} {:>12} {:>12} {:>12} {:>12}".format("region", width, "subjects", "metric",
+		  "mean", "median", "worst"))
+	for region, metrics in results.items():
+		for metric, worst in (("dice", np.nanmin), ("sensitivity", np.nanmin), ("hd95", np.nanmax)):
+			values = np.array([entry[metric] for entry in metrics], dtype=np.float64)
+			if np.isnan(values).all():
+				continue
+			print("{:<{}} {:>8} {:>12} {:>12.4f} {:>12.4f} {:>12.4f}".format(region, width, len(values), metric,
+				  np.nanmean(values), np.nanmedian(values), worst(values)))
+
+if __name__ == "__main__":
+
+	import argparse
+	import settings
+
+	parser = argparse.ArgumentParser()
+	parser.add_argument("--data_path", default=settings.OUT_PATH,
+						help="the directory of the converted dataset and the trained model")
+	parser.add_argument("--region", action="append", default=None,
+						help="MODE[=SOURCE]: evaluate the region of a MODE with the predictions of an .npy "
+							 "file from inference.py, or of a model's weights (default: the --weights model); "
+							 "repeat for several regions (default: {})".format(settings.MODE))
+	parser.add_argument("--model_json", default=None,
+						help="the model architecture (default: <data_path>/<MODEL_FN>.json)")
+	parser.add_argument("--weights", default=None,
+						help="the model weights (default: <data_path>/<MODEL_FN>_transposed.hdf5)")
+	parser.add_argument("--use_upsampling", action="store_true", default=False,
+						help="default to the _upsampling.hdf5 weights")
+	parser.add_argument("--channels_first", action="store_true", default=False,
+						help="the model was trained with channels first data")
+	parser.add_argument("--threshold", type=float, default=0.5,
+						help="the probability above which a voxel is predicted as tumor")
+	parser.add_argument("--spacing", default=None,
+						help="the z,y,x voxel size in mm (default: the size the converter recorded for each subject)")
+	parser.add_argument("--max_batch", type=int, default=64,
+						help="the largest micro-batch when predicting")
+	parser.add_argument("--output", default="subject_metrics.csv",
+						help="the CSV file the metrics of every subject and region are written to")
+	args = parser.parse_args()
+
+	from preprocess import load_mode_data
+
+	model_json = args.model_json or os.path.join(args.data_path, settings.MODEL_FN + ".json")
+	weights = args.weights or os.path.join(args.data_path, settings.MODEL_FN +
+		("_upsampling.hdf5" if args.use_upsampling else "_transposed.hdf5"))
+
+	index = DatasetIndex(args.data_path, "_test")
+	columns = ["subject", "region", "dice", "sensitivity", "hd95", "true_voxels", "pred_voxels"]
+	results = collections.OrderedDict()
+
+	with open(args.output, "w") as f:
+		writer = csv.writer(f)
+		writer.writerow(columns)
+
+		for region in args.region or [str(settings.MODE)]:
+			mode, _, source = region.partition("=")
+			mode = int(mode)
+			imgs, msks = load_mode_data(args.data_path, "_test", settings.IN_CHANNEL_NO,
+										settings.OUT_CHANNEL_NO, mode, args.channels_first)
+			spacing = [float(value) for value in args.spacing.split(",")] if args.spacing else None
+
+			engine = None
+			if source.endswith(".npy"):
+				predictions = slice_blocks(np.load(source, mmap_mode="r"))
+			else:
+				from inference import InferenceEngine
+				engine = InferenceEngine(model_json, source or weights, max_batch=args.max_batch)
+				predictions = engine.micro_batches(slice_blocks(imgs, 1024))
+
+			# A region evaluated more than once, e.g. of two models, is told apart by its source
+			name = region_name(mode)
+			if source:
+				name = "{} ({})".format(name, os.path.basename(source))
+			print("Evaluating the {} of {} subjects...".format(name, len(index.subject_names())))
+			metrics_of_region = results.setdefault(name, [])
+			for subject, metrics in evaluate_region(index, predictions, msks, spacing,
+													args.channels_first, args.threshold):
+				writer.writerow([subject, name] + list(metrics.values()))
+				metrics_of_region.append(metrics)
+			if engine is not None:
+				engine.close()
+
+	print_summary(results)
+	print("Saved the metrics of every subject to: {}".format(args.output))
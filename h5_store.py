@@ -0,0 +1,206 @@
+'''
+
+Chunked, compressed HDF5 storage for converted arrays, an alternative to the
+plain .npy files. Each array lives in its own file (e.g. imgs_train.h5) as a
+dataset named "data" that is chunked along the slice axis, so any slice can be
+read by decompressing only its own chunk.
+
+Requires h5py. Blosc/LZ4 compression is used when hdf5plugin is installed,
+zlib (gzip) otherwise.
+
+'''
+
+import os
+import numpy as np
+
+DATASET = "data"
+
+def compression_options(codec="auto"):
+	"""
+	Returns the create_dataset keyword arguments for a codec.
+	---
+	codec: "blosc" (Blosc/LZ4 with byte shuffle, needs hdf5plugin), "gzip",
+	"none", or "auto" for blosc when available and gzip otherwise
+	"""
+
+	if codec in ("auto", "blosc"):
+		try:
+			import hdf5plugin
+			return dict(hdf5plugin.Blosc(cname="lz4", clevel=5, shuffle=hdf5plugin.Blosc.SHUFFLE))
+		except ImportError:
+			if codec == "blosc":
+				raise
+		codec = "gzip"
+
+	if codec == "gzip":
+		return {"compression": "gzip", "compression_opts": 4, "shuffle": True}
+
+	return {}
+
+class H5AppendWriter(object):
+	"""
+	Same interface as npy_writer.NpyAppendWriter, writing to a resizable HDF5
+	dataset with chunk_slices slices per chunk.
+	"""
+
+	def __init__(self, filename, dtype=None, append=False, chunk_slices=1, codec="auto"):
+
+		import h5py
+
+		self.filename = filename
+		self.dtype = np.dtype(dtype) if dtype is not None else None
+		self.chunk_slices = chunk_slices
+		self.codec = codec
+		self.rows = 0
+		self._file = None
+		self._data = None
+
+		if append and os.path.isfile(filename):
+			self._file = h5py.File(filename, "r+")
+			self._data = self._file[DATASET]
+			if self.dtype is not None and self._data.dtype != self.dtype:
+				raise ValueError("{} holds {} data, expected {}".format(filename, self._data.dtype, self.dtype))
+			self.dtype = self._data.dtype
+			self.rows = self._data.shape[0]
+
+	@property
+	def shape(self):
+		return (self.rows,) + (self._data.shape[1:] if self._data is not None else ())
+
+	def _create(self, chunk):
+
+		import h5py
+
+		if self.dtype is None:
+			self.dtype = chunk.dtype
+		row_shape = chunk.shape[1:]
+		self._file = h5py.File(self.filename, "w")
+		self._data = self._file.create_dataset(DATASET, shape=(0,) + row_shape,
+											   maxshape=(None,) + row_shape,
+											   chunks=(self.chunk_slices,) + row_shape,
+											   dtype=self.dtype, **compression_options(self.codec))
+
+	def truncate(self, rows):
+
+		if rows > self.rows:
+			raise ValueError("{} has {} rows, cannot keep {}".format(self.filename, self.rows, rows))
+
+		self.rows = rows
+		if self._data is not None:
+			self._data.resize(rows, axis=0)
+			self.flush()
+
+	def append(self, chunk):
+
+		chunk = np.asarray(chunk)
+		if self._data is None:
+			self._create(chunk)
+
+		if chunk.shape[1:] != self._data.shape[1:]:
+			raise ValueError("Chunk rows have shape {}, expected {}".format(chunk.shape[1:], self._data.shape[1:]))
+
+		self._data.resize(self.rows + chunk.shape[0], axis=0)
+		self._data[self.rows:] = chunk.astype(self.dtype, copy=False)
+		self.rows += chunk.shape[0]
+
+	def flush(self):
+
+		if self._file is not None:
+			self._file.flush()
+
+	def close(self):
+
+		if self._file is not None:
+			self._file.close()
+			self._file = None
+			self._data = None
+
+	def __enter__(self):
+		return self
+
+	def __exit__(self, *exc):
+		self.close()
+
+class ChunkedArray(object):
+	"""
+	Read-only, row-indexable view of an HDF5 array written by H5AppendWriter.
+	Row lists and arrays may be unsorted or repeated (as for shuffled batches):
+	the distinct rows are read in increasing order, as HDF5 requires, and
+	returned in the requested order.
+
+	h5py handles cannot be shared between processes, so a process forked
+	after the file was opened (e.g. a pipeline.SharedBatchLoader worker)
+	opens its own handle the first time it reads.
+	"""
+
+	def __init__(self, filename):
+
+		self.filename = filename
+		self._open()
+		self.shape = self._data.shape
+		self.ndim = self._data.ndim
+		self.dtype = self._data.dtype
+
+	def _open(self):
+
+		import h5py
+		try:
+			# Registers the Blosc filter needed to decompress blosc files
+			import hdf5plugin
+		except ImportError:
+			pass
+
+		self._pid = os.getpid()
+		self._file = h5py.File(self.filename, "r")
+		self._data = self._file[DATASET]
+
+	@property
+	def data(self):
+
+		if self._pid != os.getpid():
+			self._open()
+		return self._data
+
+	def __len__(self):
+		return self.shape[0]
+
+	def _read_rows(self, rows):
+
+		data = self.data
+		if isinstance(rows, slice) or np.ndim(rows) == 0:
+			return data[rows]
+
+		rows = np.asarray(rows)
+		if rows.dtype == bool:
+			rows = np.flatnonzero(rows)
+		rows = np.where(rows < 0, rows + self.shape[0], rows)
+		unique, inverse = np.unique(rows, return_inverse=True)
+
+		# h5py list selections are slow, so read each run of consecutive rows
+		# as one slice straight into the output
+		out = np.empty((len(unique),) + self.shape[1:], dtype=self.dtype)
+		breaks = np.flatnonzero(np.diff(unique) != 1) + 1
+		for run_start, run_stop in zip(np.r_[0, breaks], np.r_[breaks, len(unique)]):
+			if run_stop > run_start:
+				data.read_direct(out, np.s_[unique[run_start]:unique[run_stop-1]+1],
+									  np.s_[run_start:run_stop])
+
+		return out[inverse.ravel()].reshape(rows.shape + self.shape[1:])
+
+	def __getitem__(self, index):
+
+		if not isinstance(index, tuple):
+			return self._read_rows(index)
+
+		rows = self._read_rows(index[0])
+		if np.ndim(index[0]) == 0 and not isinstance(index[0], slice):
+			return rows[index[1:]]
+		return rows[(slice(None),) + index[1:]]
+
+	def __getstate__(self):
+
+		# Spawned worker processes reopen the file too
+		return {"filename": self.filename}
+
+	def __setstate__(self, state):
+		self.__init__(state["filename"])
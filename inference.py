@@ -0,0 +1,258 @@
+'''
+
+Standalone batched inference with a trained U-Net. InferenceEngine loads the
+model JSON and HDF5 weights saved by train.py once, into a session of its
+own with the threading tuned for the host, and keeps it warm. Slices are
+streamed through it in micro-batches whose size adapts to a latency target,
+and predictions are written to an .npy file chunk by chunk, so neither the
+inputs nor the predictions have to fit in memory. Per-slice latency
+percentiles and throughput are counted as it runs.
+
+Usage: python inference.py --data_path <OUT_PATH> --output msks_pred.npy
+
+'''
+
+import os
+import time
+import threading
+import collections
+import numpy as np
+from npy_writer import NpyAppendWriter
+
+class LatencyStats(object):
+	"""
+	Thread-safe counters of the slices predicted: the latency of each slice,
+	from being taken from its stream to its prediction (the last window of
+	them), and the slices and seconds spent predicting in total.
+	"""
+
+	def __init__(self, window=100000):
+
+		self._latencies = collections.deque(maxlen=window)
+		self._lock = threading.Lock()
+		self.slices = 0
+		self.batches = 0
+		self.busy_seconds = 0.0
+		self.start_time = time.time()
+
+	def add(self, latencies, batch_seconds):
+
+		with self._lock:
+			self._latencies.extend(latencies)
+			self.slices += len(latencies)
+			self.batches += 1
+			self.busy_seconds += batch_seconds
+
+	def summary(self):
+		"""
+		Returns p50/p99 per-slice latency in ms, images/sec while predicting
+		and images/sec since the counters started.
+		"""
+
+		with self._lock:
+			latencies = np.asarray(self._latencies) * 1000
+			slices, batches, busy = self.slices, self.batches, self.busy_seconds
+
+		return collections.OrderedDict([
+			("slices", slices),
+			("batches", batches),
+			("p50_ms", float(np.percentile(latencies, 50)) if len(latencies) else 0.0),
+			("p99_ms", float(np.percentile(latencies, 99)) if len(latencies) else 0.0),
+			("images_per_sec", slices / busy if busy else 0.0),
+			("wall_images_per_sec", slices / (time.time() - self.start_time))])
+
+class InferenceEngine(object):
+	"""
+	A trained model loaded once into a warm session.
+	---
+	model_json, weights: the files saved by train.py (<fn>.json and
+	<fn>_transposed.hdf5 or <fn>_upsampling.hdf5)
+	num_threads, num_inter_threads: the session threads; the autotune.py
+	settings of this host, or the physical cores and 2, by default
+	max_batch: the largest micro-batch
+	latency_target: micro-batches are halved when one takes longer than this
+	many seconds and doubled when a full one takes under half of it
+	"""
+
+	def __init__(self, model_json, weights, num_threads=None, num_inter_threads=None,
+				 max_batch=64, latency_target=0.1):
+
+		from tf_compat import tf_v1
+		import tensorflow as tf
+		tf1 = tf_v1()
+
+		if num_threads is None or num_inter_threads is None:
+			from autotune import load_config
+			import psutil
+			tuned = load_config() or {}
+			num_threads = num_threads or tuned.get("num_threads") or psutil.cpu_count(logical=False)
+			num_inter_threads = num_inter_threads or tuned.get("num_inter_threads", 2)
+
+		config = tf1.ConfigProto(intra_op_parallelism_threads=num_threads,
+								 inter_op_parallelism_threads=num_inter_threads)
+		self.graph = tf1.Graph()
+		self.session = tf1.Session(graph=self.graph, config=config)
+		with self.graph.as_default(), self.session.as_default():
+			tf1.keras.backend.set_session(self.session)
+			with open(model_json) as f:
+				self.model = tf.keras.models.model_from_json(f.read())
+			self.model.load_weights(weights)
+
+			self._input = self.model.inputs[0]
+			self._output = self.model.outputs[0]
+			self._feed = {}
+			if getattr(self.model, "uses_learning_phase", False):
+				self._feed[tf.keras.backend.learning_phase()] = 0
+
+		self.input_shape = tuple(int(dim) for dim in self._input.shape[1:])
+		self.output_shape = tuple(int(dim) for dim in self._output.shape[1:])
+		self.max_batch = max_batch
+		self.latency_target = latency_target
+		self.batch_size = max(1, max_batch // 4)
+		self.stats = LatencyStats()
+		self._buffer = np.empty((max_batch,) + self.input_shape, dtype=np.float32)
+
+		# The first run builds the kernels and allocates their buffers
+		self.predict(np.zeros((1,) + self.input_shape, dtype=np.float32))
+		self.stats = LatencyStats()
+
+	def predict(self, batch):
+		"""
+		Returns the float32 predictions of a batch of slices, counted as one
+		micro-batch of slices taken just now.
+		"""
+
+		start_time = time.time()
+		feed = dict(self._feed)
+		feed[self._input] = batch
+		pred = self.session.run(self._output, feed_dict=feed)
+		seconds = time.time() - start_time
+		self.stats.add([seconds] * len(batch), seconds)
+
+		return pred
+
+	def _slices(self, items):
+
+		# Items are single slices or stacks of them (whole volumes, batches)
+		for item in items:
+			item = np.asarray(item)
+			if item.shape == self.input_shape:
+				yield item
+			elif item.shape[1:] == self.input_shape:
+				for row in item:
+					yield row
+			else:
+				raise ValueError("Expected slices of shape {}, got an item of shape {}".format(
+								 self.input_shape, item.shape))
+
+	def _adapt(self, count, seconds):
+
+		if seconds > self.latency_target and self.batch_size > 1:
+			self.batch_size = max(1, self.batch_size // 2)
+		elif seconds < self.latency_target / 2 and count == self.batch_size:
+			self.batch_size = min(self.max_batch, self.batch_size * 2)
+
+	def micro_batches(self, items):
+		"""
+		Yields the predictions of a stream of slices or volumes, one array per
+		adaptive micro-batch. Not for concurrent use; predict() is.
+		"""
+
+		slices = self._slices(items)
+		taken = np.empty(self.max_batch)
+		while True:
+			count = 0
+			for row in slices:
+				taken[count] = time.time()
+				self._buffer[count] = row
+				count += 1
+				if count == self.batch_size:
+					break
+			if count == 0:
+				return
+
+			start_time = time.time()
+			feed = dict(self._feed)
+			feed[self._input] = self._buffer[:count]
+			pred = self.session.run(self._output, feed_dict=feed)
+			done = time.time()
+			self.stats.add(done - taken[:count], done - start_time)
+			self._adapt(count, done - start_time)
+
+			yield pred
+
+	def predict_to_file(self, items, filename, dtype=np.float32):
+		"""
+		Predicts a stream of slices or volumes into an .npy file, appended one
+		micro-batch at a time, and returns it memory mapped.
+		"""
+
+		with NpyAppendWriter(filename, dtype) as writer:
+			for pred in self.micro_batches(items):
+				writer.append(pred)
+
+		return np.load(filename, mmap_mode="r")
+
+	def close(self):
+		self.session.close()
+
+	def __enter__(self):
+		return self
+
+	def __exit__(self, *exc):
+		self.close()
+
+if __name__ == "__main__":
+
+	import argparse
+	import settings
+
+	parser = argparse.ArgumentParser()
+	parser.add_argument("--data_path", default=settings.OUT_PATH,
+						help="the directory of the converted dataset and the trained model")
+	parser.add_argument("--mode", type=int, default=settings.MODE,
+						help="the MODE the model was trained for")
+	parser.add_argument("--model_json", default=None,
+						help="the model architecture (default: <data_path>/<MODEL_FN>.json)")
+	parser.add_argument("--weights", default=None,
+						help="the model weights (default: <data_path>/<MODEL_FN>_transposed.hdf5)")
+	parser.add_argument("--use_upsampling", action="store_true", default=False,
+						help="default to the _upsampling.hdf5 weights")
+	parser.add_argument("--channels_first", action="store_true", default=False,
+						help="the model was trained with channels first data")
+	parser.add_argument("--input", default=None,
+						help="an .npy array of slices to predict instead of the test set")
+	parser.add_argument("--output", default="msks_pred.npy",
+						help="the .npy file the predictions are written to")
+	parser.add_argument("--float16", action="store_true", default=False,
+						help="store the predictions as float16")
+	parser.add_argument("--num_threads", type=int, default=None,
+						help="the intra-op threads (default: autotuned or the physical cores)")
+	parser.add_argument("--num_inter_threads", type=int, default=None,
+						help="the inter-op threads (default: autotuned or 2)")
+	parser.add_argument("--max_batch", type=int, default=64,
+						help="the largest micro-batch")
+	parser.add_argument("--latency_target", type=float, default=0.1,
+						help="the target seconds per micro-batch")
+	args = parser.parse_args()
+
+	from preprocess import load_mode_data
+
+	model_json = args.model_json or os.path.join(args.data_path, settings.MODEL_FN + ".json")
+	weights = args.weights or os.path.join(args.data_path, settings.MODEL_FN +
+		("_upsampling.hdf5" if args.use_upsampling else "_transposed.hdf5"))
+
+	if args.input is not None:
+		imgs = np.load(args.input, mmap_mode="r")
+	else:
+		imgs = load_mode_data(args.data_path, "_test", settings.IN_CHANNEL_NO,
+							  settings.OUT_CHANNEL_NO, args.mode, args.channels_first)[0]
+
+	with InferenceEngine(model_json, weights, args.num_threads, args.num_inter_threads,
+						 args.max_batch, args.latency_target) as engine:
+		# Reading in blocks keeps memory-mapped reads sequential
+		blocks = (imgs[start:start+1024] for start in range(0, len(imgs), 1024))
+		engine.predict_to_file(blocks, args.output, np.float16 if args.float16 else np.float32)
+		print("Saved {} predictions to: {}".format(len(imgs), args.output))
+		for name, value in engine.stats.summary().items():
+			print("{:>20}: {}".format(name, round(value, 2)))
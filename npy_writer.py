@@ -0,0 +1,140 @@
+import os
+import struct
+import numpy as np
+
+# Largest row count the header has room for. Reserving the space up front means
+# the shape can grow without ever moving the data that follows it.
+MAX_ROWS = 10**15
+
+def _header_dict(dtype, shape):
+
+	return "{{'descr': {!r}, 'fortran_order': False, 'shape': {!r}, }}".format(
+				np.lib.format.dtype_to_descr(dtype), tuple(int(x) for x in shape))
+
+def _header_len(dtype, row_shape):
+
+	# Total header size (magic, length field and padded dict) for any row
+	# count up to MAX_ROWS, aligned to 64 bytes like np.save
+	prefix_len = len(np.lib.format.magic(1, 0)) + 2
+	needed = prefix_len + len(_header_dict(dtype, (MAX_ROWS,) + tuple(row_shape))) + 1
+	return (needed + 63) // 64 * 64
+
+def _header_bytes(dtype, shape, header_len):
+
+	header = _header_dict(dtype, shape)
+	prefix_len = len(np.lib.format.magic(1, 0)) + 2
+	pad = header_len - prefix_len - len(header) - 1
+	if pad < 0:
+		raise ValueError("Shape {} does not fit in a {} byte .npy header".format(shape, header_len))
+	header = (header + " "*pad + "\n").encode("latin1")
+
+	return np.lib.format.magic(1, 0) + struct.pack("<H", len(header)) + header
+
+class NpyAppendWriter(object):
+	"""
+	Writes a standard .npy file one chunk at a time. Each chunk is written to
+	disk exactly once and the header is rewritten in place with the new row
+	count, so memory use is bounded by a single chunk and the file can be
+	opened with np.load(..., mmap_mode="r") at any flush point.
+	---
+	filename: path of the .npy file
+	dtype: storage dtype, taken from the first chunk if None
+	append: keep the rows of an existing file written by NpyAppendWriter
+	instead of overwriting it
+	"""
+
+	def __init__(self, filename, dtype=None, append=False):
+
+		self.filename = filename
+		self.dtype = np.dtype(dtype) if dtype is not None else None
+		self.row_shape = None
+		self.rows = 0
+		self._fp = None
+
+		if append and os.path.isfile(filename):
+			self._open_existing()
+
+	@property
+	def shape(self):
+		return (self.rows,) + tuple(self.row_shape or ())
+
+	def _create(self, chunk):
+
+		if self.dtype is None:
+			self.dtype = chunk.dtype
+		self.row_shape = chunk.shape[1:]
+		self._header_len = _header_len(self.dtype, self.row_shape)
+		self._fp = open(self.filename, "wb")
+		self._fp.write(_header_bytes(self.dtype, self.shape, self._header_len))
+
+	def _open_existing(self):
+
+		self._fp = open(self.filename, "r+b")
+		version = np.lib.format.read_magic(self._fp)
+		if version != (1, 0):
+			raise ValueError("{} was not written by NpyAppendWriter".format(self.filename))
+		shape, fortran_order, dtype = np.lib.format.read_array_header_1_0(self._fp)
+		self._header_len = self._fp.tell()
+		if self._header_len < _header_len(dtype, shape[1:]) or fortran_order:
+			raise ValueError("{} was not written by NpyAppendWriter".format(self.filename))
+		if self.dtype is not None and dtype != self.dtype:
+			raise ValueError("{} holds {} data, expected {}".format(self.filename, dtype, self.dtype))
+
+		self.dtype = dtype
+		self.row_shape = shape[1:]
+		self.rows = shape[0]
+
+		# Anything past the rows recorded in the header was never committed
+		self.truncate(self.rows)
+
+	def truncate(self, rows):
+		"""
+		Drops every row after the first rows, e.g. data appended after the
+		last checkpoint of an interrupted run.
+		"""
+
+		if rows > self.rows:
+			raise ValueError("{} has {} rows, cannot keep {}".format(self.filename, self.rows, rows))
+
+		self.rows = rows
+		if self._fp is not None:
+			row_bytes = self.dtype.itemsize * int(np.prod(self.row_shape))
+			self._fp.truncate(self._header_len + rows*row_bytes)
+			self.flush()
+
+	def append(self, chunk):
+
+		chunk = np.asarray(chunk)
+		if self._fp is None:
+			self._create(chunk)
+
+		if chunk.shape[1:] != self.row_shape:
+			raise ValueError("Chunk rows have shape {}, expected {}".format(chunk.shape[1:], self.row_shape))
+
+		np.ascontiguousarray(chunk, dtype=self.dtype).tofile(self._fp)
+		self.rows += chunk.shape[0]
+
+	def flush(self):
+
+		if self._fp is None:
+			return
+
+		# Rewrite the header with the current row count, then return to the end
+		self._fp.flush()
+		self._fp.seek(0)
+		self._fp.write(_header_bytes(self.dtype, self.shape, self._header_len))
+		self._fp.seek(0, os.SEEK_END)
+		self._fp.flush()
+
+	def close(self):
+
+		self.flush()
+		if self._fp is not None:
+			self._fp.close()
+			self._fp = None
+
+	def __enter__(self):
+		return self
+
+	def __exit__(self, *exc):
+		self.close()
@@ -0,0 +1,238 @@
+'''
+
+Input pipelines that stream (imgs, msks) training batches from the converted
+arrays (memory mapped .npy, HDF5 ChunkedArrays or the lazy views built on
+them in preprocess.py) instead of holding the dataset in memory. All of them
+yield batches forever, a fresh shuffle every epoch, as fit_generator expects.
+
+'''
+
+import os
+import collections
+import multiprocessing
+import traceback
+import numpy as np
+
+def steps_per_epoch(rows, batch_size):
+	return (rows + batch_size - 1) // batch_size
+
+def read_batch(imgs, msks, rows, augment=None, seq=None):
+
+	# Reading the rows in increasing order keeps memory-mapped and chunked
+	# reads sequential; the order within a batch does not matter for training
+	rows = np.sort(rows)
+	batch_imgs = np.asarray(imgs[rows], dtype=np.float32)
+	batch_msks = np.asarray(msks[rows], dtype=np.float32)
+	if augment is not None:
+		batch_imgs, batch_msks = augment(batch_imgs, batch_msks, seq)
+
+	return batch_imgs, batch_msks
+
+def numpy_batches(imgs, msks, batch_size, shuffle=True, augment=None):
+	"""
+	Reads each batch on the calling thread, like model.fit slicing arrays.
+	---
+	augment: e.g. an augment.Augmenter applied to every batch
+	"""
+
+	seq = 0
+	while True:
+		order = np.random.permutation(len(imgs)) if shuffle else np.arange(len(imgs))
+		for start in range(0, len(order), batch_size):
+			yield read_batch(imgs, msks, order[start:start+batch_size], augment, seq)
+			seq += 1
+
+def tfdata_batches(imgs, msks, batch_size, shuffle=True, num_parallel_calls=4,
+				   prefetch=2, session=None, augment=None):
+	"""
+	Reads batches through a tf.data pipeline: the dataset is shuffled as an
+	index of row numbers, batches are read (and their channels selected) by
+	num_parallel_calls parallel map calls, and prefetch batches are kept
+	ready in the background while the model trains on the current one.
+	---
+	session: the tf.Session that runs the pipeline, a new one if None
+	augment: e.g. an augment.Augmenter, applied in the map calls
+	"""
+
+	import tensorflow as tf
+	from tf_compat import tf_v1
+	tf1 = tf_v1()
+
+	def read(rows, seq):
+		return read_batch(imgs, msks, rows, augment, int(seq))
+
+	def read_op(rows, seq):
+		# Stateful: augmentations draw random numbers and count their time
+		batch_imgs, batch_msks = tf1.py_func(read, [rows, seq], [tf.float32, tf.float32], stateful=True)
+		batch_imgs.set_shape((None,) + tuple(imgs.shape[1:]))
+		batch_msks.set_shape((None,) + tuple(msks.shape[1:]))
+		return batch_imgs, batch_msks
+
+	if session is None:
+		session = tf1.Session()
+
+	# Keras may first run the generator on another thread, whose default
+	# graph is not the session's
+	with session.graph.as_default():
+		dataset = tf.data.Dataset.range(len(imgs))
+		if shuffle:
+			dataset = dataset.shuffle(len(imgs))
+		dataset = dataset.batch(batch_size).repeat()
+
+		# Number the batches, so each is augmented the same way whichever
+		# parallel map call reads it
+		dataset = tf.data.Dataset.zip((dataset, tf.data.Dataset.range(np.iinfo(np.int64).max)))
+		dataset = dataset.map(read_op, num_parallel_calls=num_parallel_calls)
+		dataset = dataset.prefetch(prefetch)
+		if hasattr(tf1.data, "make_one_shot_iterator"):
+			batch = tf1.data.make_one_shot_iterator(dataset).get_next()
+		else:
+			batch = dataset.make_one_shot_iterator().get_next()
+
+	while True:
+		yield session.run(batch)
+
+def numa_node_cpus(node):
+	"""
+	Returns the CPU ids of a NUMA node, read from sysfs (Linux only).
+	"""
+
+	with open("/sys/devices/system/node/node{}/cpulist".format(node)) as f:
+		cpulist = f.read().strip()
+
+	cpus = []
+	for part in cpulist.split(","):
+		first, _, last = part.partition("-")
+		cpus.extend(range(int(first), int(last or first) + 1))
+
+	return cpus
+
+def _loader_worker(imgs, msks, slots, tasks, done, cpus, augment):
+
+	if cpus and hasattr(os, "sched_setaffinity"):
+		os.sched_setaffinity(0, cpus)
+
+	for task in iter(tasks.get, None):
+		seq, slot, rows = task
+		try:
+			batch_imgs, batch_msks = slots[slot]
+			count = len(rows)
+			rows = np.sort(rows)
+			batch_imgs[:count] = imgs[rows]
+			batch_msks[:count] = msks[rows]
+			seconds = 0.0
+			if augment is not None:
+				seconds = augment.seconds
+				batch_imgs[:count], batch_msks[:count] = augment(batch_imgs[:count], batch_msks[:count], seq)
+				seconds = augment.seconds - seconds
+			done.put((seq, slot, count, seconds))
+		except Exception:
+			done.put((seq, slot, traceback.format_exc(), 0.0))
+
+class SharedBatchLoader(object):
+	"""
+	Assembles (imgs, msks) batches in worker processes, so reading, channel
+	selection and the float32 conversion run outside the training process.
+	Workers write each batch into one slot of a fixed pool of shared-memory
+	buffers and the batches are yielded in order as arrays viewing the slot,
+	without a copy. At most slots batches are in flight, which bounds the
+	memory used and how far the workers run ahead.
+	---
+	imgs, msks: row-indexable arrays, e.g. from load_mode_data or update_channels;
+	HDF5 ChunkedArrays open the file again in each worker
+	workers: the number of worker processes
+	slots: the number of shared batch buffers, workers + hold + 1 by default
+	hold: a yielded batch stays valid until this many more batches are taken
+	cpus: the CPU ids to pin the workers to (e.g. numa_node_cpus(1)), None
+	to leave them unpinned
+	augment: e.g. an augment.Augmenter, applied by the workers; the time
+	they spend in it is added to its seconds and batches
+	"""
+
+	def __init__(self, imgs, msks, batch_size, workers=4, shuffle=True, slots=None,
+				 hold=1, cpus=None, augment=None):
+
+		self.imgs = imgs
+		self.msks = msks
+		self.batch_size = batch_size
+		self.shuffle = shuffle
+		self.hold = hold
+		self.augment = augment
+		if slots is None:
+			slots = workers + hold + 1
+		if slots <= hold:
+			raise ValueError("The loader needs more than hold={} slots".format(hold))
+
+		self._shapes = [(batch_size,) + tuple(imgs.shape[1:]), (batch_size,) + tuple(msks.shape[1:])]
+		buffers = [[multiprocessing.RawArray("f", int(np.prod(shape))) for shape in self._shapes]
+				   for slot in range(slots)]
+		self._slots = [[np.frombuffer(buf, dtype=np.float32).reshape(shape)
+						for buf, shape in zip(slot, self._shapes)] for slot in buffers]
+
+		self._tasks = multiprocessing.Queue()
+		self._done = multiprocessing.Queue()
+		self._workers = [multiprocessing.Process(target=_loader_worker,
+												 args=(imgs, msks, self._slots, self._tasks,
+													   self._done, cpus, augment))
+						 for worker in range(workers)]
+		for worker in self._workers:
+			worker.daemon = True
+			worker.start()
+
+	def __len__(self):
+		return (len(self.imgs) + self.batch_size - 1) // self.batch_size
+
+	def _row_batches(self):
+
+		while True:
+			order = np.random.permutation(len(self.imgs)) if self.shuffle else np.arange(len(self.imgs))
+			for start in range(0, len(order), self.batch_size):
+				yield order[start:start+self.batch_size]
+
+	def __iter__(self):
+
+		row_batches = self._row_batches()
+		free = list(range(len(self._slots)))
+		held = collections.deque()
+		finished = {}
+		sent = taken = 0
+
+		while True:
+			# Keep every free slot busy
+			while free:
+				self._tasks.put((sent, free.pop(), next(row_batches)))
+				sent += 1
+
+			# Batches finish in any order but are yielded in the order they were sent
+			while taken not in finished:
+				seq, slot, count, seconds = self._done.get()
+				finished[seq] = (slot, count, seconds)
+			slot, count, seconds = finished.pop(taken)
+			taken += 1
+			if not isinstance(count, int):
+				raise RuntimeError("Batch loader worker failed:\n" + count)
+			if self.augment is not None:
+				self.augment.record(seconds)
+
+			held.append(slot)
+			if len(held) > self.hold:
+				free.append(held.popleft())
+
+			batch_imgs, batch_msks = self._slots[slot]
+			yield batch_imgs[:count], batch_msks[:count]
+
+	def close(self):
+
+		for worker in self._workers:
+			self._tasks.put(None)
+		for worker in self._workers:
+			worker.join(1)
+			if worker.is_alive():
+				worker.terminate()
+		self._workers = []
+
+	def __enter__(self):
+		return self
+
+	def __exit__(self, *exc):
+		self.close()
@@ -0,0 +1,118 @@
+'''
+
+Reduced precision training of the U-Net on CPUs with bfloat16 support
+(AVX-512 BF16 or AMX). The reduced precision modes keep the weights in float32
+and compute the final sigmoid and the Dice loss in float32:
+
+fp32:  everything in float32, as before
+bf16:  the Keras "mixed_bfloat16" policy: every layer computes in bfloat16
+from float32 weights, except the output layer, built with dtype="float32"
+mixed: TensorFlow's oneDNN auto mixed precision graph rewrite, which moves
+only the ops on its allow list (convolutions, matmuls and their neighbours)
+to bfloat16 and leaves the model code untouched
+
+bfloat16 has the exponent range of float32, so gradients do not underflow
+and neither mode needs loss scaling.
+
+'''
+
+import os
+import json
+import time
+
+PRECISIONS = ["fp32", "bf16", "mixed"]
+
+def configure_precision(precision, config):
+	"""
+	Sets up a precision mode; call it before the model is built.
+	---
+	config: the tf.ConfigProto of the training session, which the mixed
+	mode turns the graph rewrite on in
+	"""
+
+	import tensorflow as tf
+
+	if precision == "bf16":
+		mixed_precision = getattr(tf.keras, "mixed_precision", None)
+		if hasattr(mixed_precision, "set_global_policy"):
+			mixed_precision.set_global_policy("mixed_bfloat16")
+		elif hasattr(getattr(mixed_precision, "experimental", None), "set_policy"):
+			mixed_precision.experimental.set_policy("mixed_bfloat16")
+		else:
+			raise ValueError("--precision bf16 needs a TensorFlow with Keras mixed precision "
+							 "policies (1.15 or later)")
+
+	elif precision == "mixed":
+		from tensorflow.core.protobuf import rewriter_config_pb2
+
+		rewrite_options = config.graph_options.rewrite_options
+		for option in ("auto_mixed_precision_onednn_bfloat16", "auto_mixed_precision_mkl"):
+			if rewrite_options.DESCRIPTOR.fields_by_name.get(option) is not None:
+				setattr(rewrite_options, option, rewriter_config_pb2.RewriterConfig.ON)
+				break
+		else:
+			raise ValueError("--precision mixed needs a TensorFlow with the oneDNN auto mixed "
+							 "precision rewrite (2.3 or later, built with oneDNN)")
+
+	elif precision != "fp32":
+		raise ValueError("Unknown precision {}, expected one of {}".format(precision, PRECISIONS))
+
+# The options of train.py and train_dist.py that change the images/sec or the
+# Dice of a run; the others (output files, cluster addresses) do not
+SETUP_OPTIONS = ["seed", "batch_size", "epochs", "learningrate", "const_learningrate", "decay_steps",
+				 "lr_fraction", "use_upsampling", "channels_first", "keras_api", "no_cache", "pipeline",
+				 "pipeline_threads", "loader_workers", "loader_numa_node", "augment", "augment_seed",
+				 "num_threads", "num_inter_threads", "blocktime", "kmp_affinity", "profile_steps"]
+
+def run_setup(args, data_path, mode, img_rows, img_cols, **settings):
+	"""
+	Returns the setup of a training run that record_run compares runs by:
+	the options in SETUP_OPTIONS the script has, the MODE, the image size and
+	the converted dataset, identified by its path and the size and
+	modification time of its files.
+	---
+	settings: any further settings of the run, e.g. the number of workers
+	"""
+
+	from preprocess import array_files, DATASET_INFO, NORMALIZATION
+
+	files = list(array_files(data_path, "_train")) + list(array_files(data_path, "_test")) + \
+			[os.path.join(data_path, DATASET_INFO), os.path.join(data_path, NORMALIZATION)]
+	dataset = {"path": os.path.abspath(data_path)}
+	for filename in files:
+		if os.path.isfile(filename):
+			stat = os.stat(filename)
+			dataset[os.path.basename(filename)] = [stat.st_size, int(stat.st_mtime)]
+
+	setup = dict((option, getattr(args, option)) for option in SETUP_OPTIONS if hasattr(args, option))
+	setup.update(settings)
+	setup.update({"mode": mode, "img_rows": int(img_rows), "img_cols": int(img_cols), "dataset": dataset})
+
+	return setup
+
+def record_run(filename, precision, setup, images_per_sec, dice):
+	"""
+	Adds a run to the results file and prints how it compares with the
+	fp32 run of the same setup, if any.
+	---
+	setup: a dict of the settings the runs to compare must share, see
+	run_setup
+	"""
+
+	results = {}
+	if os.path.isfile(filename):
+		with open(filename) as f:
+			results = json.load(f)
+
+	key = json.dumps(setup, sort_keys=True)
+	runs = results.setdefault(key, {})
+	runs[precision] = {"images_per_sec": images_per_sec, "dice": dice,
+					   "date": time.strftime("%Y-%m-%d %H:%M:%S")}
+	with open(filename, "w") as f:
+		json.dump(results, f, indent=2, sort_keys=True)
+
+	print("Precision {}: {:.1f} images/sec, test Dice {:.4f}".format(precision, images_per_sec, dice))
+	baseline = runs.get("fp32")
+	if baseline is not None and precision != "fp32":
+		print("Against fp32 ({}): {:.2f}x images/sec, Dice {:+.4f}".format(baseline["date"],
+			  images_per_sec / baseline["images_per_sec"], dice - baseline["dice"]))
@@ -1,45 +1,433 @@
-
 import os
+import glob
+import json
+import hashlib
 import numpy as np
+from npy_writer import NpyAppendWriter
+
+DATASET_INFO = "dataset_info.json"
+
+def save_dataset_info(data_path, info):
+	"""
+	Writes the storage format of a converted dataset next to its .npy files.
+	"""
+
+	with open(os.path.join(data_path, DATASET_INFO), "w") as f:
+		json.dump(info, f, indent=2, sort_keys=True)
+
+def load_dataset_info(data_path):
+	"""
+	Returns the storage format of a converted dataset. Datasets written before
+	the format was recorded hold plain one-hot masks.
+	"""
+
+	fn = os.path.join(data_path, DATASET_INFO)
+	if not os.path.isfile(fn):
+		return {"msk_format": "uint8"}
+
+	with open(fn) as f:
+		return json.load(f)
+
+# Tumor labels counted per slice in the dataset index, in mask channel order 1-3
+TUMOR_LABELS = (1, 2, 4)
+
+# One entry per stored slice: the row in the subjects table it came from, its
+# axial position in the original volume and its tumor voxels per label
+INDEX_DTYPE = np.dtype([("subject", np.int32), ("z", np.int16),
+						("voxels", np.int32, (len(TUMOR_LABELS),))])
+
+# One entry per subject: its BraTS ID, the [start, stop) rows it occupies, the
+# number of slices in its volume, how many of them the converter dropped, the
+# per-modality statistics of its volume at the stored size and the (z, y, x)
+# size in mm of the stored voxels
+SUBJECT_DTYPE = np.dtype([("name", "U64"), ("start", np.int64), ("stop", np.int64),
+						  ("depth", np.int16), ("dropped_empty", np.int16),
+						  ("dropped_tumor_free", np.int16), ("voxel_count", np.int64),
+						  ("mean", np.float64, (4,)), ("std", np.float64, (4,)),
+						  ("spacing", np.float64, (3,))])
+
+def pack_masks(msks):
+	"""
+	Packs one-hot (..., channels) masks into a single uint8 per pixel,
+	channel c stored in bit c.
+	---
+	msks: array of 0/1 values with at most 8 channels
+	"""
+
+	shifts = np.arange(msks.shape[-1], dtype=np.uint8)
+	return np.bitwise_or.reduce(np.left_shift(msks.astype(np.uint8), shifts), axis=-1)
+
+def unpack_masks(packed, channels):
+	"""
+	Inverse of pack_masks: expands each byte into (..., channels) 0/1 values.
+	"""
+
+	shifts = np.arange(channels, dtype=np.uint8)
+	return np.bitwise_and(np.right_shift(packed[...,np.newaxis], shifts), 1)
+
+def _index_rows(read_rows, index):
+
+	# Row-indexed views only materialize the rows selected by the first index;
+	# any remaining indices are applied to that (small) result
+	if not isinstance(index, tuple):
+		return read_rows(index)
+
+	rows = read_rows(index[0])
+	if np.ndim(index[0]) == 0 and not isinstance(index[0], slice):
+		return rows[index[1:]]
+	return rows[(slice(None),) + index[1:]]
+
+class PackedMasks(object):
+	"""
+	Read-only array view of bit-packed masks. Only the rows being indexed are
+	unpacked, so the underlying memmap is never expanded as a whole.
+	"""
+
+	def __init__(self, packed, channels):
+
+		self.packed = packed
+		self.channels = channels
+		self.shape = tuple(packed.shape) + (channels,)
+		self.ndim = len(self.shape)
+		self.dtype = np.dtype(np.uint8)
+
+	def __len__(self):
+		return self.shape[0]
+
+	def _unpack(self, rows):
+		return unpack_masks(self.packed[rows], self.channels)
+
+	def __getitem__(self, index):
+		return _index_rows(self._unpack, index)
+
+NORMALIZATION = "normalization.json"
+
+class RunningStats(object):
+	"""
+	Single-pass mean and variance (Welford's algorithm, with Chan's update for
+	merging whole blocks), so statistics can be accumulated block by block and
+	across subjects without keeping the data around.
+	"""
+
+	def __init__(self, count=0, mean=0.0, m2=0.0):
+
+		self.count = count
+		self.mean = mean
+		self.m2 = m2
+
+	@property
+	def std(self):
+		return np.sqrt(self.m2 / self.count) if self.count > 0 else 0.0
+
+	def merge(self, other):
+
+		if other.count == 0:
+			return self
+
+		count = self.count + other.count
+		delta = other.mean - self.mean
+		self.mean += delta * other.count / count
+		self.m2 += other.m2 + delta * delta * self.count * other.count / count
+		self.count = count
+
+		return self
+
+	def update(self, values):
+
+		values = np.asarray(values)
+		if values.size == 0:
+			return self
+
+		mean = values.mean(dtype=np.float64)
+		m2 = np.square(values - mean).sum(dtype=np.float64)
+
+		return self.merge(RunningStats(values.size, mean, m2))
+
+	def state(self):
+		return {"count": int(self.count), "mean": float(self.mean), "m2": float(self.m2)}
+
+def save_normalization(data_path, normalize, modes, stats):
+	"""
+	Writes the per-modality statistics of a converted dataset, so inference
+	can normalize new volumes exactly like the training data.
+	---
+	normalize: "subject" (each volume by its own statistics, the dataset
+	statistics are informational) or "global" (every volume by the dataset statistics)
+	modes: modality names in channel order
+	stats: RunningStats per modality
+	"""
+
+	with open(os.path.join(data_path, NORMALIZATION), "w") as f:
+		json.dump({"normalize": normalize, "modes": modes,
+				   "mean": [s.mean for s in stats], "std": [s.std for s in stats],
+				   "state": [s.state() for s in stats]}, f, indent=2, sort_keys=True)
+
+def load_normalization(data_path):
+
+	with open(os.path.join(data_path, NORMALIZATION)) as f:
+		return json.load(f)
+
+def normalize_images(imgs, normalization=None):
+	"""
+	Normalizes raw (..., channels) images per channel, with the dataset
+	statistics for global normalization or their own statistics otherwise.
+	Returns float32.
+	"""
+
+	imgs = np.asarray(imgs, dtype=np.float32)
+	if normalization is not None and normalization["normalize"] == "global":
+		mean = np.asarray(normalization["mean"], dtype=np.float32)
+		std = np.asarray(normalization["std"], dtype=np.float32)
+	else:
+		stats = [RunningStats().update(imgs[...,c]) for c in range(imgs.shape[-1])]
+		mean = np.array([s.mean for s in stats], dtype=np.float32)
+		std = np.array([s.std for s in stats], dtype=np.float32)
+
+	return (imgs - mean) / np.where(std > 0, std, 1)
+
+class NormalizedImages(object):
+	"""
+	Read-only array view of raw images stored with global normalization.
+	The dataset statistics are applied only to the rows being indexed.
+	"""
+
+	def __init__(self, imgs, normalization):
+
+		self.imgs = imgs
+		self.normalization = normalization
+		self.shape = imgs.shape
+		self.ndim = imgs.ndim
+		self.dtype = np.dtype(np.float32)
+
+	def __len__(self):
+		return self.shape[0]
+
+	def _normalize(self, rows):
+		return normalize_images(self.imgs[rows], self.normalization)
+
+	def __getitem__(self, index):
+		return _index_rows(self._normalize, index)
+
+# File extension of the image and mask arrays in each container format. The
+# index and subjects tables are always .npy.
+CONTAINER_EXTENSIONS = {"npy": ".npy", "hdf5": ".h5"}
+
+def array_files(data_path, prefix="_train", info=None):
+	"""
+	Returns the paths of the (imgs, msks) arrays of a converted dataset.
+	"""
+
+	if info is None:
+		info = load_dataset_info(data_path)
+	extension = CONTAINER_EXTENSIONS[info.get("container", "npy")]
+
+	return tuple(os.path.join(data_path, name+prefix+extension) for name in ["imgs", "msks"])
+
+def open_array(filename):
+	"""
+	Opens a converted array for row-indexed reads: .npy files are memory
+	mapped, HDF5 files are read one slice-aligned chunk at a time.
+	"""
+
+	if filename.endswith(CONTAINER_EXTENSIONS["hdf5"]):
+		from h5_store import ChunkedArray
+		return ChunkedArray(filename)
+
+	return np.load(filename, mmap_mode="r", allow_pickle=False)
 
 def load_data(data_path, prefix = "_train"):
-	imgs_train = np.load(os.path.join(data_path, "imgs"+prefix+".npy"),
-						 mmap_mode="r", allow_pickle=False)
-	msks_train = np.load(os.path.join(data_path, "msks"+prefix+".npy"),
-						 mmap_mode="r", allow_pickle=False)
+	info = load_dataset_info(data_path)
+	imgs_train, msks_train = [open_array(fn) for fn in array_files(data_path, prefix, info)]
+
+	if info["msk_format"] == "packed":
+		msks_train = PackedMasks(msks_train, info["msk_channels"])
+	if info.get("normalize") == "global":
+		imgs_train = NormalizedImages(imgs_train, load_normalization(data_path))
 
 	return imgs_train, msks_train
 
-def update_channels(imgs, msks, input_no=3, output_no=3, mode=1):
+# Source channels summed into output channel 0 for each mode: (images, masks).
+# Any other mode trains on blank images against the full tumor mask.
+MODE_CHANNELS = {1: ([2], [0,1,2,3]),
+				 2: ([0], [3]),
+				 3: ([1], [0,2,3])}
+
+class ChannelView(object):
+	"""
+	Lazy view of a converted array after channel selection. Indexing reads only
+	the requested rows from the (memory mapped) source and returns them as
+	float32 with channel 0 set to the sum of the selected source channels, so
+	training and evaluation stream from disk with O(batch) memory.
+	"""
+
+	def __init__(self, source, channels, channel_no, channels_first=False):
+
+		self.source = source
+		self.channels = channels
+		self.channel_no = channel_no
+		self.channels_first = channels_first
+		rows, height, width = source.shape[:3]
+		if channels_first:
+			self.shape = (rows, channel_no, width, height)
+		else:
+			self.shape = (rows, height, width, channel_no)
+		self.ndim = 4
+		self.dtype = np.dtype(np.float32)
+
+	def __len__(self):
+		return self.shape[0]
+
+	def _select(self, rows):
+
+		src = self.source[rows]
+		out = np.zeros(src.shape[:-1] + (self.channel_no,), dtype=np.float32)
+		for channel in self.channels:
+			out[...,0] += src[...,channel]
+
+		# Same layout as swapping the first and last data axes
+		if self.channels_first:
+			out = np.swapaxes(out, -1, -3)
+
+		return out
+
+	def __getitem__(self, index):
+		return _index_rows(self._select, index)
+
+def update_channels(imgs, msks, input_no=3, output_no=3, mode=1, channels_first=False):
 	"""
 	changes the order or which channels are used to allow full testing. Uses both
 	Imgs and msks as input since different things may be done to both
 	---
 	mode: int between 1-3
+	channels_first: return batches with the channel and last data axes swapped
+
+	Returns lazy ChannelViews; nothing is read from disk until they are indexed.
 	"""
 
-	imgs = imgs.astype("float32")
-	msks = msks.astype("float32")
+	img_channels, msk_channels = MODE_CHANNELS.get(mode, ([], [0,1,2,3]))
 
-	shp = imgs.shape
-	new_imgs = np.zeros((shp[0],shp[1],shp[2],input_no))
-	new_msks = np.zeros((shp[0],shp[1],shp[2],output_no))
+	return (ChannelView(imgs, img_channels, input_no, channels_first),
+			ChannelView(msks, msk_channels, output_no, channels_first))
 
-	if mode == 1:
-		new_imgs[:,:,:,0] = imgs[:,:,:,2]
-		new_msks[:,:,:,0] = msks[:,:,:,0]+msks[:,:,:,1]+msks[:,:,:,2]+msks[:,:,:,3]
+def file_fingerprint(filename, samples=16, block_size=1<<20):
+	"""
+	Cheap content fingerprint of a (large) file: its size, modification time
+	and a hash of evenly spaced blocks, including the header and the tail.
+	Hashing every byte of a tens-of-GB array would cost more than the cache saves.
+	"""
 
-	elif mode == 2:
+	stat = os.stat(filename)
+	digest = hashlib.sha1("{}:{}".format(stat.st_size, stat.st_mtime).encode("utf-8"))
+	with open(filename, "rb") as f:
+		for offset in np.linspace(0, max(stat.st_size - block_size, 0), samples).astype(np.int64):
+			f.seek(int(offset))
+			digest.update(f.read(block_size))
 
-		new_imgs[:,:,:,0] = imgs[:,:,:,0]
-		new_msks[:,:,:,0] = msks[:,:,:,3]
+	return digest.hexdigest()
 
-	elif mode == 3:
+def load_mode_data(data_path, prefix="_train", input_no=3, output_no=3, mode=1,
+				   channels_first=False, cache_dir=None, chunk_size=1024):
+	"""
+	Memory maps the mode-specific (imgs, msks) pair derived by update_channels.
+	The derived arrays are written to cache_dir (default data_path/cache) once
+	and reused by later runs until the source arrays change.
+	---
+	chunk_size: rows read from the source per write while building the cache
+	"""
 
-		new_imgs[:,:,:,0] = imgs[:,:,:,1]
-		new_msks[:,:,:,0] = msks[:,:,:,0]+msks[:,:,:,2]+msks[:,:,:,3]
+	if cache_dir is None:
+		cache_dir = os.path.join(data_path, "cache")
+	if not os.path.isdir(cache_dir):
+		os.makedirs(cache_dir)
 
-	else:
-		new_msks[:,:,:,0] = msks[:,:,:,0]+msks[:,:,:,1]+msks[:,:,:,2]+msks[:,:,:,3]
+	info = load_dataset_info(data_path)
+	sources = array_files(data_path, prefix, info)
+	key = hashlib.sha1(json.dumps([info] +
+								  [file_fingerprint(fn) for fn in sources],
+								  sort_keys=True).encode("utf-8")).hexdigest()[:16]
+	stem = os.path.join(cache_dir, "mode{}_in{}_out{}_{}{}_".format(mode, input_no, output_no,
+						"channels_first" if channels_first else "channels_last", prefix))
+	cached = [stem + key + name for name in ["_imgs.npy", "_msks.npy"]]
+
+	if not all(os.path.isfile(fn) for fn in cached):
+
+		# Drop caches built from an older version of the source files
+		for fn in glob.glob(stem + "*"):
+			os.remove(fn)
+
+		imgs, msks = update_channels(*load_data(data_path, prefix), input_no=input_no,
+									 output_no=output_no, mode=mode,
+									 channels_first=channels_first)
+
+		# float16 images stay compact, masks are small integer sums
+		img_dtype = np.float16 if imgs.source.dtype == np.float16 else np.float32
+		for view, dtype, fn in [(imgs, img_dtype, cached[0]), (msks, np.uint8, cached[1])]:
+			with NpyAppendWriter(fn + ".tmp", dtype) as writer:
+				for start in range(0, len(view), chunk_size):
+					writer.append(view[start:start+chunk_size])
+			os.rename(fn + ".tmp", fn)
+
+	return tuple(np.load(fn, mmap_mode="r", allow_pickle=False) for fn in cached)
+
+class DatasetIndex(object):
+	"""
+	Slice and subject lookups for a converted split, backed by the index and
+	subjects files written by converter.py.
+	---
+	data_path: directory holding index{prefix}.npy and subjects{prefix}.npy
+	prefix: "_train" or "_test"
+	"""
+
+	def __init__(self, data_path, prefix="_train"):
+
+		self.rows = np.load(os.path.join(data_path, "index"+prefix+".npy"), allow_pickle=False)
+		self.subjects = np.load(os.path.join(data_path, "subjects"+prefix+".npy"), allow_pickle=False)
+		self._by_name = {}
+		for subject_id, name in enumerate(self.subjects["name"]):
+			self._by_name.setdefault(name, []).append(subject_id)
+
+		# Rows ordered by tumor size: per label, and summed over all labels (last)
+		counts = np.column_stack((self.rows["voxels"], self.rows["voxels"].sum(axis=1))).T
+		self._order = [np.argsort(column, kind="mergesort") for column in counts]
+		self._sorted = [column[order] for column, order in zip(counts, self._order)]
+
+	def __len__(self):
+		return len(self.rows)
+
+	def subject_names(self):
+		return sorted(self._by_name)
+
+	def subject_rows(self, name):
+		"""
+		Returns the row ranges holding a subject's slices as a list of slices
+		(more than one only if the subject was split across files).
+		"""
+
+		return [slice(int(self.subjects["start"][i]), int(self.subjects["stop"][i]))
+				for i in self._by_name.get(name, [])]
+
+	def slice_subjects(self, rows):
+		"""
+		Returns the subject names and axial positions of the given rows.
+		"""
+
+		entries = self.rows[rows]
+		return self.subjects["name"][entries["subject"]], entries["z"]
+
+	def tumor_rows(self, label=None, min_voxels=1):
+		"""
+		Returns the rows with at least min_voxels voxels of the given label
+		(any of TUMOR_LABELS if None), smallest tumors first.
+		"""
+
+		column = len(TUMOR_LABELS) if label is None else TUMOR_LABELS.index(label)
+		first = np.searchsorted(self._sorted[column], min_voxels)
+		return self._order[column][first:]
+
+	def tumor_free_rows(self):
+		"""
+		Returns the rows without any tumor voxels.
+		"""
 
-	return new_imgs, new_msks
+		column = len(TUMOR_LABELS)
+		return self._order[column][:np.searchsorted(self._sorted[column], 1)]
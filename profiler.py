@@ -0,0 +1,161 @@
+'''
+
+Sampled TensorFlow profiling. Tracing every step (RunOptions.FULL_TRACE)
+slows training down and keeps only the last step's trace, so StepProfiler
+turns tracing on for a window of steps only (e.g. --profile_steps 50-55),
+writes one Chrome trace per sampled step (with its step_stats alongside,
+for timeline_report.py) and adds up the time of every op over the samples.
+All the other steps run untraced.
+
+'''
+
+import collections
+
+def parse_steps(spec):
+	"""
+	Returns the sorted step numbers of a window spec such as "50-55", "100"
+	or "50-55,200-205" (ranges are inclusive), an empty list for None or "".
+	"""
+
+	steps = set()
+	for part in (spec or "").split(","):
+		if part.strip():
+			first, _, last = part.partition("-")
+			steps.update(range(int(first), int(last or first) + 1))
+
+	return sorted(steps)
+
+def op_type(node):
+
+	# The timeline label of a node is "name = OpType(inputs)"
+	label = node.timeline_label.split(" = ", 1)[-1]
+	return label.split("(", 1)[0] or node.node_name
+
+def step_op_times(step_stats):
+	"""
+	Returns {(device, node name, op type): microseconds} of one traced step.
+	"""
+
+	times = collections.defaultdict(int)
+	for dev_stats in step_stats.dev_stats:
+		for node in dev_stats.node_stats:
+			times[(dev_stats.device, node.node_name, op_type(node))] += node.all_end_rel_micros
+
+	return times
+
+class StepProfiler(object):
+	"""
+	Traces the sampled steps of a training run. Call begin() before and end()
+	after every step (the step counter is kept here); the run_options and
+	run_metadata must be those the step runs with, e.g. the ones passed to
+	model.compile. For Keras, pass the model's train_function to begin() and
+	end() too: since TensorFlow 1.8 it copies the run options into a cached
+	callable on its first call, so it is rebuilt whenever tracing turns on or off.
+	---
+	steps: the step numbers to trace, counted from 0 over all epochs
+	trace_prefix: each sampled step is saved to <trace_prefix>_step<N>.json,
+	and its serialized step_stats to <trace_prefix>_step<N>.pb
+	"""
+
+	def __init__(self, run_options, run_metadata, steps, trace_prefix="timeline"):
+
+		import tensorflow as tf
+		from tf_compat import tf_v1
+		tf1 = tf_v1()
+
+		self.run_options = run_options
+		self.run_metadata = run_metadata
+		self.steps = set(steps)
+		self.trace_prefix = trace_prefix
+		self.step = 0
+		self.sampled = []
+		self.op_times = collections.defaultdict(int)
+		self._trace_levels = (tf1.RunOptions.NO_TRACE, tf1.RunOptions.FULL_TRACE)
+		self.run_options.trace_level = self._trace_levels[0]
+
+	def tracing(self):
+		return self.step in self.steps
+
+	def _set_trace_level(self, trace_level, function):
+
+		if self.run_options.trace_level != trace_level:
+			self.run_options.trace_level = trace_level
+			# Keras functions make their callable again when it is None
+			if getattr(function, "_callable_fn", None) is not None:
+				function._callable_fn = None
+
+	def begin(self, function=None):
+		"""
+		function: the Keras backend function running the step, if any
+		"""
+
+		if self.tracing():
+			self.run_metadata.Clear()
+			self._set_trace_level(self._trace_levels[1], function)
+
+	def end(self, function=None):
+
+		if self.tracing():
+			from tensorflow.python.client import timeline
+
+			step_stats = self.run_metadata.step_stats
+			if len(step_stats.dev_stats) == 0:
+				print("Warning: step {} was not traced, the session ignored the trace options; "
+					  "no trace saved".format(self.step))
+				self.step += 1
+				return
+			trace_filename = "{}_step{}.json".format(self.trace_prefix, self.step)
+			with open(trace_filename, "w") as f:
+				f.write(timeline.Timeline(step_stats).generate_chrome_trace_format(show_memory=True))
+			with open("{}_step{}.pb".format(self.trace_prefix, self.step), "wb") as f:
+				f.write(step_stats.SerializeToString())
+			print("Saved Tensorflow trace of step {} to: {}".format(self.step, trace_filename))
+
+			for key, micros in step_op_times(step_stats).items():
+				self.op_times[key] += micros
+			self.sampled.append(self.step)
+
+		self.step += 1
+		if not self.tracing():
+			self._set_trace_level(self._trace_levels[0], function)
+
+	def op_table(self, by="op"):
+		"""
+		Returns (name, mean ms per sampled step, share of the traced time)
+		rows, slowest first, adding up the ops by op type ("op"), node name
+		("node") or device ("device").
+		"""
+
+		column = {"device": 0, "node": 1, "op": 2}[by]
+		totals = collections.defaultdict(int)
+		for key, micros in self.op_times.items():
+			totals[key[column]] += micros
+
+		samples = max(len(self.sampled), 1)
+		everything = max(sum(totals.values()), 1)
+		return [(name, micros / 1000.0 / samples, float(micros) / everything)
+				for name, micros in sorted(totals.items(), key=lambda item: -item[1])]
+
+	def report(self, filename=None, top=20):
+		"""
+		Prints the slowest op types and nodes over the sampled steps and,
+		given a filename, writes the whole per-node table to it as CSV.
+		"""
+
+		if not self.sampled:
+			return
+
+		print("Op time over {} sampled steps ({})".format(len(self.sampled),
+			  ", ".join(str(step) for step in self.sampled)))
+		for by in ("op", "node"):
+			print("{:>48} {:>14} {:>8}".format(by, "ms per step", "share"))
+			for name, ms, share in self.op_table(by)[:top]:
+				print("{:>48} {:>14.2f} {:>7.1f}%".format(name[-48:], ms, 100*share))
+
+		if filename is not None:
+			samples = len(self.sampled)
+			with open(filename, "w") as f:
+				f.write("device,node,op,ms_per_step\n")
+				for (device, node, op), micros in sorted(self.op_times.items(), key=lambda item: -item[1]):
+					f.write("{},{},{},{:.3f}\n".format(device, node, op, micros / 1000.0 / samples))
+			print("Saved the op times of the sampled steps to: {}".format(filename))
@@ -0,0 +1,222 @@
+'''
+
+Post-training INT8 quantization of a trained U-Net for CPU inference. Loads
+the model saved by train.py (<OUT_PATH>/<MODEL_FN>_transposed.hdf5 or
+_upsampling.hdf5), calibrates the activation ranges on a sample of the test
+slices of a MODE and converts it to an INT8 TensorFlow Lite model with float
+inputs and outputs. Both models then predict the remaining test slices,
+and the script reports the INT8 speedup and the change in Dice. The export
+is refused (exit status 1) if Dice drops by more than --max_dice_drop.
+Results are kept per MODE in quantization_report.json.
+
+Usage: python quantize.py --mode 1 [--use_upsampling] [--max_dice_drop 0.01]
+
+'''
+
+import os
+import sys
+import json
+import time
+import shutil
+import argparse
+import tempfile
+import numpy as np
+
+def dice(msks_pred, msks, threshold=0.5, smooth=1.0):
+	"""
+	Returns the Dice coefficient of the thresholded predictions over all the slices.
+	"""
+
+	pred = np.asarray(msks_pred) > threshold
+	true = np.asarray(msks) > 0.5
+	return float((2.0 * np.count_nonzero(pred & true) + smooth) /
+				 (np.count_nonzero(pred) + np.count_nonzero(true) + smooth))
+
+def split_rows(rows, calibration_slices, eval_slices, seed=816):
+	"""
+	Returns disjoint, sorted calibration and evaluation row samples; all the
+	remaining rows are evaluated if eval_slices is 0.
+	"""
+
+	order = np.random.RandomState(seed).permutation(rows)
+	calibration = order[:calibration_slices]
+	evaluation = order[calibration_slices:]
+	if eval_slices:
+		evaluation = evaluation[:eval_slices]
+
+	return np.sort(calibration), np.sort(evaluation)
+
+def convert_int8(model, calibration_imgs):
+	"""
+	Returns the INT8 TensorFlow Lite flatbuffer of a Keras model, with the
+	activation ranges calibrated on calibration_imgs.
+	"""
+
+	import tensorflow as tf
+
+	def representative_dataset():
+		for img in calibration_imgs:
+			yield [img[np.newaxis].astype(np.float32)]
+
+	tmp_dir = None
+	if hasattr(tf.lite.TFLiteConverter, "from_keras_model"):
+		converter = tf.lite.TFLiteConverter.from_keras_model(model)
+	else:
+		# Older converters read a model file; save the model without its
+		# training configuration so the custom loss is not needed to load it
+		tmp_dir = tempfile.mkdtemp()
+		model_filename = os.path.join(tmp_dir, "model.hdf5")
+		model.save(model_filename, include_optimizer=False)
+		converter = tf.lite.TFLiteConverter.from_keras_model_file(model_filename)
+
+	try:
+		converter.optimizations = [tf.lite.Optimize.DEFAULT]
+		converter.representative_dataset = representative_dataset
+		converter.target_spec.supported_ops = [tf.lite.OpsSet.TFLITE_BUILTINS_INT8]
+		return converter.convert()
+	finally:
+		if tmp_dir is not None:
+			shutil.rmtree(tmp_dir)
+
+def tflite_predict(tflite_model, imgs, batch_size, num_threads=None):
+	"""
+	Returns the predictions of a TensorFlow Lite model and the seconds they took.
+	"""
+
+	import tensorflow as tf
+
+	try:
+		interpreter = tf.lite.Interpreter(model_content=tflite_model, num_threads=num_threads)
+	except TypeError:
+		interpreter = tf.lite.Interpreter(model_content=tflite_model)
+	input_index = interpreter.get_input_details()[0]["index"]
+	output_index = interpreter.get_output_details()[0]["index"]
+
+	def run(batch):
+		if tuple(interpreter.get_input_details()[0]["shape"]) != batch.shape:
+			interpreter.resize_tensor_input(input_index, batch.shape)
+			interpreter.allocate_tensors()
+		interpreter.set_tensor(input_index, batch)
+		interpreter.invoke()
+		return interpreter.get_tensor(output_index)
+
+	run(np.asarray(imgs[:batch_size], dtype=np.float32))  # warm up outside the timing
+	start_time = time.time()
+	preds = [run(np.asarray(imgs[start:start+batch_size], dtype=np.float32))
+			 for start in range(0, len(imgs), batch_size)]
+
+	return np.concatenate(preds), time.time() - start_time
+
+def keras_predict(model, imgs, batch_size):
+	"""
+	Returns the float32 predictions of a Keras model and the seconds they took.
+	"""
+
+	model.predict(imgs[:batch_size], batch_size=batch_size, verbose=0)  # warm up outside the timing
+	start_time = time.time()
+	preds = model.predict(imgs, batch_size=batch_size, verbose=0)
+
+	return preds, time.time() - start_time
+
+def record_result(report_filename, mode, result):
+	"""
+	Stores the result of a MODE in the report and prints all the MODEs.
+	"""
+
+	report = {}
+	if os.path.isfile(report_filename):
+		with open(report_filename) as f:
+			report = json.load(f)
+	report[str(mode)] = result
+
+	# Write a new file, then move it over the old one, so a failed write
+	# never loses the results of the other MODEs
+	with open(report_filename + ".tmp", "w") as f:
+		json.dump(report, f, indent=2, sort_keys=True)
+	getattr(os, "replace", os.rename)(report_filename + ".tmp", report_filename)
+
+	print("{:>5} {:>12} {:>12} {:>9} {:>10} {:>10} {:>9}  {}".format("MODE", "fp32 img/s", "int8 img/s",
+		  "speedup", "fp32 Dice", "int8 Dice", "exported", "model"))
+	for mode in sorted(report):
+		entry = report[mode]
+		print("{:>5} {:>12.1f} {:>12.1f} {:>8.2f}x {:>10.4f} {:>10.4f} {:>9}  {}".format(mode,
+			  entry["fp32_images_per_sec"], entry["int8_images_per_sec"], entry["speedup"],
+			  entry["fp32_dice"], entry["int8_dice"], "yes" if entry["exported"] else "NO",
+			  os.path.basename(entry["model"])))
+
+if __name__ == "__main__":
+
+	import settings
+
+	parser = argparse.ArgumentParser()
+	parser.add_argument("--data_path", default=settings.OUT_PATH,
+						help="the directory of the converted dataset and the trained models")
+	parser.add_argument("--mode", type=int, default=settings.MODE,
+						help="the MODE the model was trained for")
+	parser.add_argument("--model", default=None,
+						help="the trained model (default: <data_path>/<MODEL_FN>_transposed.hdf5)")
+	parser.add_argument("--use_upsampling", action="store_true", default=False,
+						help="default to the _upsampling.hdf5 model")
+	parser.add_argument("--channels_first", action="store_true", default=False,
+						help="the model was trained with channels first data")
+	parser.add_argument("--calibration_slices", type=int, default=256,
+						help="the test slices the activation ranges are calibrated on")
+	parser.add_argument("--eval_slices", type=int, default=2048,
+						help="the other test slices the models are compared on, 0 for all")
+	parser.add_argument("--batch_size", type=int, default=16,
+						help="the inference batch size")
+	parser.add_argument("--num_threads", type=int, default=None,
+						help="the INT8 interpreter threads (default: TensorFlow Lite's choice)")
+	parser.add_argument("--max_dice_drop", type=float, default=0.01,
+						help="refuse the export if Dice drops by more than this")
+	parser.add_argument("--output", default=None,
+						help="the INT8 model file (default: the model file with an _int8.tflite suffix)")
+	parser.add_argument("--report", default="quantization_report.json",
+						help="the file the per-MODE results are kept in")
+	args = parser.parse_args()
+
+	import tf_compat  # loads train.py's Keras 2 models on TensorFlow 2.16 and later
+	import tensorflow as tf
+	from preprocess import load_mode_data
+
+	model_filename = args.model or os.path.join(args.data_path, settings.MODEL_FN +
+		("_upsampling.hdf5" if args.use_upsampling else "_transposed.hdf5"))
+	output_filename = args.output or os.path.splitext(model_filename)[0] + "_int8.tflite"
+
+	imgs_test, msks_test = load_mode_data(args.data_path, "_test", settings.IN_CHANNEL_NO,
+										  settings.OUT_CHANNEL_NO, args.mode, args.channels_first)
+	calibration_rows, eval_rows = split_rows(len(imgs_test), args.calibration_slices, args.eval_slices)
+	eval_imgs = np.asarray(imgs_test[eval_rows], dtype=np.float32)
+	eval_msks = np.asarray(msks_test[eval_rows])
+
+	# The training loss is only needed to resume training, not to predict
+	model = tf.keras.models.load_model(model_filename, compile=False)
+
+	print("Calibrating on {} slices...".format(len(calibration_rows)))
+	tflite_model = convert_int8(model, np.asarray(imgs_test[calibration_rows], dtype=np.float32))
+
+	print("Predicting {} slices...".format(len(eval_rows)))
+	fp32_pred, fp32_seconds = keras_predict(model, eval_imgs, args.batch_size)
+	int8_pred, int8_seconds = tflite_predict(tflite_model, eval_imgs, args.batch_size, args.num_threads)
+
+	result = {"model": model_filename, "slices": len(eval_rows),
+			  "fp32_images_per_sec": len(eval_rows) / fp32_seconds,
+			  "int8_images_per_sec": len(eval_rows) / int8_seconds,
+			  "speedup": fp32_seconds / int8_seconds,
+			  "fp32_dice": dice(fp32_pred, eval_msks), "int8_dice": dice(int8_pred, eval_msks),
+			  "max_dice_drop": args.max_dice_drop}
+	result["exported"] = bool(result["fp32_dice"] - result["int8_dice"] <= args.max_dice_drop)
+	if result["exported"]:
+		result["output"] = output_filename
+
+	# The model is only exported once its result has been recorded
+	record_result(args.report, args.mode, result)
+	if result["exported"]:
+		with open(output_filename, "wb") as f:
+			f.write(tflite_model)
+
+	if not result["exported"]:
+		print("Not exported: INT8 Dice is {:.4f} below fp32, more than --max_dice_drop {}".format(
+			  result["fp32_dice"] - result["int8_dice"], args.max_dice_drop))
+		sys.exit(1)
+	print("Saved the INT8 model to: {}".format(output_filename))
@@ -0,0 +1,371 @@
+'''
+
+Local segmentation service for the trained U-Net, built on the standard
+library HTTP server. Concurrent requests are coalesced into dynamic batches:
+the batcher thread collects the slices of waiting requests until a batch is
+full or the oldest request has waited --max_wait seconds, runs them through
+the InferenceEngine as one batch and hands each request its own masks.
+
+POST /slices: the body is an .npy array of (N, H, W, C), (N, H, W) or
+(H, W) slices, normalized like the converted dataset. Returns an .npy array
+of uint8 masks, or of float16 probabilities with ?probabilities=1.
+
+POST /volume: the body is a NIfTI volume (.nii or .nii.gz) of the MODE's
+modality (FLAIR for MODE 1, T1 for 2, T2 for 3). It is resampled, rotated
+and normalized like converter.py did for training, and the mask is returned
+as a .nii.gz label volume with the geometry of the input.
+
+GET /stats: JSON latency percentiles and batch counters.
+
+Usage: python serve.py --data_path <OUT_PATH> [--port 8500] [--max_batch 32] [--max_wait 0.01]
+
+'''
+
+import io
+import os
+import gzip
+import json
+import time
+import threading
+import numpy as np
+from inference import InferenceEngine, LatencyStats
+
+try:
+	from http.server import BaseHTTPRequestHandler, HTTPServer
+	from socketserver import ThreadingMixIn
+	from urllib.parse import urlparse, parse_qs
+	import queue
+except ImportError:
+	from BaseHTTPServer import BaseHTTPRequestHandler, HTTPServer
+	from SocketServer import ThreadingMixIn
+	from urlparse import urlparse, parse_qs
+	import Queue as queue
+
+class _Request(object):
+
+	def __init__(self, slices):
+
+		self.slices = slices
+		self.out = None
+		self.pending = 0
+		self.error = None
+		self.done = threading.Event()
+
+class DynamicBatcher(object):
+	"""
+	Coalesces the slices of concurrent predict() calls into batches of up to
+	max_batch slices. A batch runs once it is full or max_wait seconds after
+	its oldest slices arrived. Requests larger than max_batch are split
+	across batches.
+	---
+	stats: a LatencyStats of the request latencies, arrival to prediction
+	"""
+
+	def __init__(self, engine, max_batch=32, max_wait=0.01):
+
+		self.engine = engine
+		self.max_batch = max_batch
+		self.max_wait = max_wait
+		self.stats = LatencyStats()
+		self._queue = queue.Queue()
+		self._thread = threading.Thread(target=self._run)
+		self._thread.daemon = True
+		self._thread.start()
+
+	def predict(self, slices):
+		"""
+		Returns the predictions of an (N, ...) array of slices.
+		"""
+
+		request = _Request(np.asarray(slices, dtype=np.float32))
+		pieces = range(0, len(request.slices), self.max_batch)
+		request.pending = len(pieces)
+		if not request.pending:
+			return np.empty((0,) + self.engine.output_shape, dtype=np.float32)
+
+		arrival = time.time()
+		for start in pieces:
+			self._queue.put((request, start, min(start + self.max_batch, len(request.slices)), arrival))
+		request.done.wait()
+		if request.error is not None:
+			raise request.error
+
+		return request.out
+
+	def _run(self):
+
+		carry = None
+		while True:
+			piece = carry or self._queue.get()
+			carry = None
+			pieces = [piece]
+			count = piece[2] - piece[1]
+			deadline = piece[3] + self.max_wait
+			while count < self.max_batch:
+				try:
+					piece = self._queue.get(timeout=max(deadline - time.time(), 0))
+				except queue.Empty:
+					break
+				if count + piece[2] - piece[1] > self.max_batch:
+					carry = piece
+					break
+				pieces.append(piece)
+				count += piece[2] - piece[1]
+
+			self._predict(pieces)
+
+	def _predict(self, pieces):
+
+		start_time = time.time()
+		try:
+			pred = self.engine.predict(np.concatenate([request.slices[start:stop]
+													   for request, start, stop, arrival in pieces]))
+		except Exception as error:
+			for request, start, stop, arrival in pieces:
+				request.error = error
+				request.done.set()
+			return
+		done = time.time()
+
+		latencies = []
+		offset = 0
+		for request, start, stop, arrival in pieces:
+			if request.out is None:
+				request.out = np.empty((len(request.slices),) + pred.shape[1:], dtype=pred.dtype)
+			request.out[start:stop] = pred[offset:offset + stop - start]
+			offset += stop - start
+			latencies.extend([done - arrival] * (stop - start))
+			request.pending -= 1
+			if request.pending == 0:
+				request.done.set()
+		self.stats.add(latencies, done - start_time)
+
+class VolumePreprocessor(object):
+	"""
+	Turns a raw single-modality (H, W, slices) volume into model input slices
+	the way converter.py converted the training data, and predicted slices
+	back into a mask volume of the original geometry.
+	---
+	data_path: the converted dataset, for its conversion options and
+	normalization statistics (converter defaults if they are missing)
+	"""
+
+	def __init__(self, data_path, mode, size, channels_first=False):
+
+		import converter
+		from preprocess import MODE_CHANNELS, load_normalization, NORMALIZATION
+
+		self.converter = converter
+		self.size = size
+		self.channels_first = channels_first
+
+		# Multi-size conversions keep the manifest one directory up
+		manifest = None
+		for path in (data_path, os.path.dirname(os.path.normpath(data_path))):
+			manifest = manifest or converter.load_manifest(os.path.join(path, ""))
+		options = manifest["options"] if manifest else {}
+		self.resample = options.get("resample", converter.resample)
+		self.rotate = options.get("rotate", converter.rotate)
+
+		# Global normalization uses the dataset statistics of the MODE's modality
+		self.mean = self.std = None
+		if os.path.isfile(os.path.join(data_path, NORMALIZATION)):
+			normalization = load_normalization(data_path)
+			if normalization["normalize"] == "global":
+				channel = MODE_CHANNELS[mode][0][0]
+				self.mean, self.std = normalization["mean"][channel], normalization["std"][channel]
+
+	def slices(self, volume):
+
+		volume = self.converter.parse_images(np.asarray(volume, dtype=np.float64))
+		if self.resample == "crop":
+			# The center crop of converter.resize_data
+			start = max(volume.shape[1] - self.size, 0) // 2
+			volume = volume[:, start:volume.shape[1]-start, start:volume.shape[1]-start]
+		else:
+			volume = self.converter.resample_volume(volume, self.size, self.resample)
+
+		# Like the converter, normalize by the statistics of the volume at the model's size
+		mean, std = self.mean, self.std
+		if mean is None:
+			stats = self.converter.volume_stats(volume)
+			mean, std = stats.mean, stats.std
+
+		volume = np.rot90(volume, self.rotate, axes=(1,2))
+		slices = ((volume - mean) / (std or 1.0)).astype(np.float32)[..., np.newaxis]
+
+		return np.swapaxes(slices, 1, -1) if self.channels_first else slices
+
+	def volume(self, pred, shape, threshold=0.5):
+		"""
+		Returns the uint8 (H, W, slices) mask of the predicted slices of a
+		volume of the given shape.
+		"""
+
+		pred = np.swapaxes(pred, 1, -1) if self.channels_first else pred
+		pred = np.rot90(pred[..., 0].astype(np.float64), -self.rotate, axes=(1,2))
+		height, width = shape[:2]
+
+		if self.resample == "crop":
+			full = np.zeros((len(pred), height, width))
+			start = max(height - self.size, 0) // 2
+			full[:, start:start+pred.shape[1], start:start+pred.shape[2]] = pred
+		else:
+			rows = self.converter.resample_weights(pred.shape[1], height, "bilinear")
+			cols = self.converter.resample_weights(pred.shape[2], width, "bilinear")
+			full = np.matmul(np.matmul(rows, pred), cols.T)
+
+		return np.transpose(full > threshold, (1,2,0)).astype(np.uint8)
+
+def gzip_bytes(data):
+
+	out = io.BytesIO()
+	with gzip.GzipFile(fileobj=out, mode="wb") as f:
+		f.write(data)
+	return out.getvalue()
+
+def read_nifti(body):
+
+	import nibabel as nib
+
+	if body[:2] == b"\x1f\x8b":
+		body = gzip.GzipFile(fileobj=io.BytesIO(body)).read()
+	return nib.Nifti1Image.from_bytes(body)
+
+class SegmentationHandler(BaseHTTPRequestHandler):
+
+	def _reply(self, status, body, content_type="application/octet-stream"):
+
+		self.send_response(status)
+		self.send_header("Content-Type", content_type)
+		self.send_header("Content-Length", str(len(body)))
+		self.end_headers()
+		self.wfile.write(body)
+
+	def _error(self, status, message):
+		self._reply(status, json.dumps({"error": message}).encode("utf-8"), "application/json")
+
+	def log_message(self, format, *args):
+		if self.server.verbose:
+			BaseHTTPRequestHandler.log_message(self, format, *args)
+
+	def do_GET(self):
+
+		if urlparse(self.path).path == "/stats":
+			stats = {"requests": self.server.batcher.stats.summary(),
+					 "batches": self.server.batcher.engine.stats.summary()}
+			self._reply(200, json.dumps(stats).encode("utf-8"), "application/json")
+		else:
+			self._error(404, "Unknown path {}".format(self.path))
+
+	def do_POST(self):
+
+		url = urlparse(self.path)
+		body = self.rfile.read(int(self.headers.get("Content-Length", 0)))
+		engine = self.server.batcher.engine
+		try:
+			if url.path == "/slices":
+				slices = np.load(io.BytesIO(body), allow_pickle=False)
+				if slices.shape in (engine.input_shape, engine.input_shape[:-1]):
+					slices = slices[np.newaxis]  # a single slice
+				if slices.shape[1:] == engine.input_shape[:-1]:
+					slices = slices[..., np.newaxis]  # slices without the channel axis
+				if slices.shape[1:] != engine.input_shape:
+					raise ValueError("Expected slices of shape {}, got {}".format(engine.input_shape, slices.shape))
+				pred = self.server.batcher.predict(slices)
+				if parse_qs(url.query).get("probabilities", ["0"])[0] not in ("0", "false"):
+					pred = pred.astype(np.float16)
+				else:
+					pred = (pred > 0.5).astype(np.uint8)
+				out = io.BytesIO()
+				np.save(out, pred)
+				self._reply(200, out.getvalue())
+
+			elif url.path == "/volume":
+				import nibabel as nib
+
+				if self.server.preprocessor is None:
+					raise ValueError("Volumes need nibabel and the converter installed")
+				image = read_nifti(body)
+				volume = np.asanyarray(image.dataobj)
+				mask = self.server.preprocessor.volume(
+					self.server.batcher.predict(self.server.preprocessor.slices(volume)), volume.shape)
+				header = image.header.copy()
+				header.set_data_dtype(np.uint8)
+				header.set_slope_inter(1, 0)
+				self._reply(200, gzip_bytes(nib.Nifti1Image(mask, image.affine, header).to_bytes()))
+
+			else:
+				self._error(404, "Unknown path {}".format(self.path))
+
+		except ValueError as error:
+			self._error(400, str(error))
+		except Exception as error:
+			self._error(500, repr(error))
+
+class SegmentationServer(ThreadingMixIn, HTTPServer):
+
+	daemon_threads = True
+	request_queue_size = 128  # the default of 5 drops connections under concurrent load
+
+	def __init__(self, address, batcher, preprocessor=None, verbose=False):
+
+		HTTPServer.__init__(self, address, SegmentationHandler)
+		self.batcher = batcher
+		self.preprocessor = preprocessor
+		self.verbose = verbose
+
+if __name__ == "__main__":
+
+	import argparse
+	import settings
+
+	parser = argparse.ArgumentParser()
+	parser.add_argument("--data_path", default=settings.OUT_PATH,
+						help="the directory of the trained model and its converted dataset")
+	parser.add_argument("--mode", type=int, default=settings.MODE,
+						help="the MODE the model was trained for")
+	parser.add_argument("--model_json", default=None,
+						help="the model architecture (default: <data_path>/<MODEL_FN>.json)")
+	parser.add_argument("--weights", default=None,
+						help="the model weights (default: <data_path>/<MODEL_FN>_transposed.hdf5)")
+	parser.add_argument("--use_upsampling", action="store_true", default=False,
+						help="default to the _upsampling.hdf5 weights")
+	parser.add_argument("--channels_first", action="store_true", default=False,
+						help="the model was trained with channels first data")
+	parser.add_argument("--host", default="127.0.0.1",
+						help="the address to listen on")
+	parser.add_argument("--port", type=int, default=8500,
+						help="the port to listen on")
+	parser.add_argument("--max_batch", type=int, default=32,
+						help="the most slices predicted in one batch")
+	parser.add_argument("--max_wait", type=float, default=0.01,
+						help="the longest a request waits for others to share its batch, in seconds")
+	parser.add_argument("--num_threads", type=int, default=None,
+						help="the intra-op threads (default: autotuned or the physical cores)")
+	parser.add_argument("--num_inter_threads", type=int, default=None,
+						help="the inter-op threads (default: autotuned or 2)")
+	parser.add_argument("--verbose", action="store_true", default=False,
+						help="log every request")
+	args = parser.parse_args()
+
+	model_json = args.model_json or os.path.join(args.data_path, settings.MODEL_FN + ".json")
+	weights = args.weights or os.path.join(args.data_path, settings.MODEL_FN +
+		("_upsampling.hdf5" if args.use_upsampling else "_transposed.hdf5"))
+
+	engine = InferenceEngine(model_json, weights, args.num_threads, args.num_inter_threads,
+							 max_batch=args.max_batch)
+	size = engine.input_shape[-1] if args.channels_first else engine.input_shape[0]
+	try:
+		preprocessor = VolumePreprocessor(args.data_path, args.mode, size, args.channels_first)
+	except ImportError as error:
+		print("Serving slices only, volumes need {}".format(error))
+		preprocessor = None
+	server = SegmentationServer((args.host, args.port), DynamicBatcher(engine, args.max_batch, args.max_wait),
+								preprocessor, args.verbose)
+	print("Serving {} on http://{}:{}".format(os.path.basename(weights), args.host, args.port))
+	try:
+		server.serve_forever()
+	except KeyboardInterrupt:
+		pass
+	engine.close()
@@ -0,0 +1,32 @@
+import os
+import sys
+import numpy as np
+import pytest
+
+# The modules live at the top of the repository
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+
+# Selects the Keras 2 package, if installed, before any test imports TensorFlow
+import tf_compat
+
+@pytest.fixture(scope="session")
+def saved_model(tmpdir_factory):
+	"""
+	A tiny segmentation model saved the way train.py saves the U-Net.
+	"""
+
+	tf = pytest.importorskip("tensorflow")
+	from tf_compat import tf_v1
+
+	tf1 = tf_v1()
+	directory = tmpdir_factory.mktemp("model")
+	with tf1.Graph().as_default(), tf1.Session().as_default():
+		inputs = tf.keras.layers.Input((16, 16, 1))
+		outputs = tf.keras.layers.Conv2D(1, (3, 3), padding="same", activation="sigmoid")(inputs)
+		model = tf.keras.models.Model(inputs=[inputs], outputs=[outputs])
+		with open(str(directory.join("model.json")), "w") as f:
+			f.write(model.to_json())
+		model.save_weights(str(directory.join("model.hdf5")))
+		expected = model.predict(np.ones((2, 16, 16, 1), dtype=np.float32))
+
+	return str(directory.join("model.json")), str(directory.join("model.hdf5")), expected
@@ -0,0 +1,41 @@
+import pickle
+import numpy as np
+
+from augment import Augmenter
+
+def batch(seed=816):
+
+	rng = np.random.RandomState(seed)
+	return rng.rand(4, 16, 16, 2).astype(np.float32), (rng.rand(4, 16, 16, 1) > 0.7).astype(np.float32)
+
+def test_numbered_batches_do_not_depend_on_the_worker():
+
+	imgs, msks = batch()
+	first = Augmenter(seed=3)(imgs, msks, 5)
+
+	# Another worker, which has augmented other batches before
+	other = pickle.loads(pickle.dumps(Augmenter(seed=3)))
+	other(imgs, msks, 4)
+	other(imgs, msks)
+	second = other(imgs, msks, 5)
+
+	for a, b in zip(first, second):
+		assert np.array_equal(a, b)
+	assert not np.array_equal(first[0], Augmenter(seed=3)(imgs, msks, 6)[0])
+	assert not np.array_equal(first[0], Augmenter(seed=4)(imgs, msks, 5)[0])
+
+def test_unnumbered_batches_follow_the_seed():
+
+	imgs, msks = batch()
+	a, b = Augmenter(seed=3), Augmenter(seed=3)
+	assert np.array_equal(a(imgs, msks)[0], b(imgs, msks)[0])
+	assert not np.array_equal(a(imgs, msks)[0], b(imgs, msks, 0)[0])
+
+def test_masks_keep_their_labels_and_layout():
+
+	imgs, msks = batch()
+	augmenter = Augmenter(seed=3, channels_first=True)
+	out_imgs, out_msks = augmenter(np.swapaxes(imgs, 1, -1), np.swapaxes(msks, 1, -1), 1)
+	assert out_imgs.shape == (4, 2, 16, 16) and out_msks.shape == (4, 1, 16, 16)
+	assert set(np.unique(out_msks)) <= {0.0, 1.0}
+	assert augmenter.batches == 1
@@ -0,0 +1,162 @@
+import os
+import json
+import numpy as np
+import pytest
+
+import converter
+from preprocess import MODE_CHANNELS
+
+def write_subjects(root, count, shape=(24, 24, 6), zooms=(1.0, 1.0, 1.0), seed=816):
+	"""
+	Writes count BraTS-like subjects of random intensities and labels, of
+	voxels of the given size in mm, to root and returns the raw volumes of
+	each, by name and modality.
+	"""
+
+	import nibabel as nib
+
+	rng = np.random.RandomState(seed)
+	volumes = {}
+	for number in range(count):
+		name = "BraTS_{}".format(number)
+		directory = root.mkdir(name)
+		volumes[name] = {}
+		for mode in converter.img_modes + ["seg"]:
+			if mode == "seg":
+				volume = np.array([0, 0, 1, 2, 4], dtype=np.uint8)[rng.randint(5, size=shape)]
+			else:
+				volume = rng.randint(1, 1000, size=shape).astype(np.int16)
+			nib.save(nib.Nifti1Image(volume, np.diag(list(zooms) + [1.0])),
+					 str(directory.join("{}_{}.nii.gz".format(name, mode))))
+			volumes[name][mode] = volume
+
+	return volumes
+
+def stored_subjects(path):
+	"""
+	Returns the stored images of each converted subject, by name.
+	"""
+
+	subjects = {}
+	for prefix in ["_train", "_test"]:
+		imgs = np.load(os.path.join(path, "imgs" + prefix + ".npy"))
+		for subject in np.load(os.path.join(path, "subjects" + prefix + ".npy")):
+			subjects[str(subject["name"])] = imgs[subject["start"]:subject["stop"]]
+
+	return subjects
+
+@pytest.fixture
+def brats(tmpdir):
+
+	root = tmpdir.mkdir("brats")
+	return root, write_subjects(root, 3)
+
+def test_each_size_normalized_by_its_own_statistics(tmpdir, brats):
+
+	root, volumes = brats
+	save_path = str(tmpdir.mkdir("out")) + os.sep
+	converter.convert(str(root), save_path, resample="area", sizes=[8, 16], split=0.5)
+
+	import serve
+
+	channel = MODE_CHANNELS[1][0][0]
+	for size in [8, 16]:
+		path = os.path.join(save_path, str(size), "")
+		preprocessor = serve.VolumePreprocessor(path, 1, size)
+		for name, imgs in stored_subjects(path).items():
+			assert imgs.shape == (6, size, size, len(converter.img_modes))
+			assert np.allclose(imgs.mean(axis=(0,1,2)), 0, atol=1e-5)
+			assert np.allclose(imgs.std(axis=(0,1,2)), 1, atol=1e-5)
+
+			# Serving a raw volume gives the slices the model was trained on
+			served = preprocessor.slices(volumes[name][converter.img_modes[channel]])
+			assert np.allclose(served[..., 0], imgs[..., channel], atol=1e-5)
+
+def test_global_statistics_of_the_stored_arrays(tmpdir, brats):
+
+	root, volumes = brats
+	save_path = str(tmpdir.mkdir("out")) + os.sep
+	converter.convert(str(root), save_path, resample="area", sizes=[8, 16], split=0.5, normalize="global")
+
+	for size in [8, 16]:
+		path = os.path.join(save_path, str(size), "")
+		imgs = np.concatenate(list(stored_subjects(path).values())).astype(np.float64)
+		with open(os.path.join(path, "normalization.json")) as f:
+			normalization = json.load(f)
+		assert np.allclose(normalization["mean"], imgs.mean(axis=(0,1,2)))
+		assert np.allclose(normalization["std"], imgs.std(axis=(0,1,2)))
+
+@pytest.mark.parametrize("resample, size, spacing", [("area", 8, (2.0, 3.0, 1.5)),
+													("crop", 16, (2.0, 1.0, 0.5))])
+def test_stored_voxel_size(tmpdir, resample, size, spacing):
+
+	root = tmpdir.mkdir("brats")
+	write_subjects(root, 2, zooms=(0.5, 1.0, 2.0))
+	save_path = str(tmpdir.mkdir("out")) + os.sep
+	converter.convert(str(root), save_path, resample=resample, sizes=[size], split=0.5)
+
+	# The converter rotates the slices by 270 degrees, swapping the in-plane axes
+	for prefix in ["_train", "_test"]:
+		subjects = np.load(os.path.join(save_path, "subjects" + prefix + ".npy"))
+		assert np.allclose(subjects["spacing"], spacing)
+
+def test_stratified_split():
+
+	names = ["S{:02d}".format(number) for number in range(20)]
+	volumes = list(np.random.RandomState(816).permutation(20) * 100)
+	splits = converter.split_subjects(names, 0.75, 816, volumes)
+
+	# The same split whatever order the subjects are found in
+	assert converter.split_subjects(names[::-1], 0.75, 816, volumes[::-1]) == splits
+	assert sorted(splits.values()).count("_test") == 5
+	by_volume = [names[subject] for subject in np.argsort(volumes)]
+	for stratum in np.array_split(by_volume, 4):
+		assert "_test" in [splits[name] for name in stratum]
+
+	# Small datasets still get a test subject
+	assert "_test" in converter.split_subjects(names[:3], 0.85, 816, volumes[:3]).values()
+	assert converter.split_subjects(names, 0.75, 816) == converter.split_subjects(names, 0.75, 816)
+
+def converted_files(path):
+
+	files = {}
+	for name in sorted(os.listdir(path)):
+		with open(os.path.join(path, name), "rb") as f:
+			files[name] = f.read()
+
+	return files
+
+def test_parallel_and_resumed_conversions_match_a_serial_one(tmpdir, monkeypatch):
+
+	root = tmpdir.mkdir("brats")
+	write_subjects(root, 7)
+	monkeypatch.setattr(converter, "save_interval", 2)
+	options = dict(resample="crop", sizes=[16], split=0.6, stratify=True, drop_empty=True,
+				   tumor_free_ratio=0.5)
+
+	serial = str(tmpdir.mkdir("serial")) + os.sep
+	converter.convert(str(root), serial, **options)
+
+	parallel = str(tmpdir.mkdir("parallel")) + os.sep
+	converter.convert(str(root), parallel, workers=2, **options)
+
+	# A run that fails on its fifth subject, after two checkpoints, then resumes
+	resumed = str(tmpdir.mkdir("resumed")) + os.sep
+	process_subject = converter.process_subject
+	calls = []
+	def failing(*args, **kwargs):
+		calls.append(1)
+		if len(calls) == 5:
+			raise RuntimeError("interrupted")
+		return process_subject(*args, **kwargs)
+	monkeypatch.setattr(converter, "process_subject", failing)
+	with pytest.raises(RuntimeError):
+		converter.convert(str(root), resumed, **options)
+	monkeypatch.setattr(converter, "process_subject", process_subject)
+	assert len(converter.load_manifest(resumed)["completed"]) == 4
+	converter.convert(str(root), resumed, incremental=True, **options)
+
+	expected = converted_files(serial)
+	assert "imgs_test.npy" in expected and "subjects_train.npy" in expected
+	assert converted_files(parallel) == expected
+	assert converted_files(resumed) == expected
@@ -0,0 +1,111 @@
+import numpy as np
+import pytest
+
+from preprocess import INDEX_DTYPE, SUBJECT_DTYPE, DatasetIndex
+from evaluate import region_metrics, surface_distances, evaluate_region
+
+def write_index(path, depths, keep_from=2, spacings=None):
+	"""
+	Writes index_test.npy and subjects_test.npy for subjects of the given
+	depths (and voxel sizes), each with its first keep_from slices dropped
+	like the converter drops tumor-free slices.
+	"""
+
+	subjects, index, row = [], [], 0
+	for number, depth in enumerate(depths):
+		z = np.arange(keep_from, depth)
+		subject = np.zeros(1, dtype=SUBJECT_DTYPE)
+		subject["name"], subject["depth"] = "S{}".format(number), depth
+		subject["start"], subject["stop"] = row, row + len(z)
+		subject["spacing"] = spacings[number] if spacings else (1.0, 1.0, 1.0)
+		entries = np.zeros(len(z), dtype=INDEX_DTYPE)
+		entries["subject"], entries["z"] = number, z
+		subjects.append(subject)
+		index.append(entries)
+		row += len(z)
+	np.save(str(path.join("subjects_test.npy")), np.concatenate(subjects))
+	np.save(str(path.join("index_test.npy")), np.concatenate(index))
+
+	return DatasetIndex(str(path), "_test")
+
+def ball(depth, size, center, radius):
+
+	z, y, x = np.mgrid[:depth, :size, :size]
+	return ((z - center[0])**2 + (y - center[1])**2 + (x - center[2])**2) < radius**2
+
+@pytest.fixture
+def subjects(tmpdir):
+
+	depths = [12, 9, 15]
+	index = write_index(tmpdir, depths)
+	preds = [ball(depth, 16, (depth // 2 + 1, 8, 9), 4) for depth in depths]
+	trues = [ball(depth, 16, (depth // 2 + 1, 8, 8), 4) for depth in depths]
+
+	return index, preds, trues
+
+def test_streamed_subjects_match_whole_volumes(subjects):
+
+	index, preds, trues = subjects
+	rows = lambda volumes: np.concatenate([volume[2:] for volume in volumes])[..., np.newaxis]
+	pred, true = rows(preds).astype(np.float32), rows(trues).astype(np.uint8)
+
+	# Blocks that end in the middle of subjects
+	blocks = (pred[start:start+5] for start in range(0, len(pred), 5))
+	results = list(evaluate_region(index, blocks, true, (1.0, 1.0, 1.0)))
+
+	assert [name for name, metrics in results] == ["S0", "S1", "S2"]
+	for (name, metrics), p, t in zip(results, preds, trues):
+		assert metrics["dice"] == pytest.approx(2.0 * np.count_nonzero(p & t) / (p.sum() + t.sum()))
+		assert metrics["true_voxels"] == np.count_nonzero(t)
+		assert metrics["hd95"] == pytest.approx(1.0)
+
+def test_spacing_of_each_subject(tmpdir):
+
+	depths, spacings = [12, 9], [(1.0, 0.5, 0.5), (2.0, 1.0, 3.0)]
+	index = write_index(tmpdir, depths, spacings=spacings)
+	preds = [ball(depth, 16, (depth // 2 + 1, 8, 9), 4) for depth in depths]
+	trues = [ball(depth, 16, (depth // 2 + 1, 8, 8), 4) for depth in depths]
+	pred = np.concatenate([volume[2:] for volume in preds])[..., np.newaxis].astype(np.float32)
+	true = np.concatenate([volume[2:] for volume in trues])[..., np.newaxis].astype(np.uint8)
+
+	results = list(evaluate_region(index, [pred], true, None))
+	for (name, metrics), p, t, spacing in zip(results, preds, trues, spacings):
+		assert metrics["hd95"] == pytest.approx(region_metrics(p, t, np.array(spacing))["hd95"])
+
+def test_empty_masks_follow_brats():
+
+	empty, full = np.zeros((4, 4, 4), dtype=bool), np.ones((4, 4, 4), dtype=bool)
+	both_empty = region_metrics(empty, empty, np.ones(3))
+	assert both_empty["dice"] == 1.0 and both_empty["hd95"] == 0.0 and np.isnan(both_empty["sensitivity"])
+	missed = region_metrics(empty, full, np.array([1.0, 2.0, 2.0]))
+	assert missed["dice"] == 0.0 and missed["sensitivity"] == 0.0
+	assert missed["hd95"] == pytest.approx(np.sqrt(4**2 + 8**2 + 8**2))
+
+def test_surface_distances_without_scipy(monkeypatch):
+
+	rng = np.random.RandomState(0)
+	a, b = rng.rand(6, 12, 12) > 0.7, rng.rand(6, 12, 12) > 0.8
+	spacing = np.array([1.0, 1.5, 1.5])
+	pytest.importorskip("scipy")
+	with_scipy = surface_distances(a, b, spacing)
+
+	import sys
+	monkeypatch.setitem(sys.modules, "scipy", None)
+	np.testing.assert_allclose(np.sort(surface_distances(a, b, spacing)), np.sort(with_scipy))
+
+def test_engine_predictions_stream_into_subjects(tmpdir, saved_model):
+
+	pytest.importorskip("tensorflow")
+	from inference import InferenceEngine
+
+	index = write_index(tmpdir, [6, 8])
+	imgs = np.random.RandomState(2).normal(size=(len(index), 16, 16, 1)).astype(np.float32)
+	model_json, weights, expected = saved_model
+	with InferenceEngine(model_json, weights, num_threads=1, num_inter_threads=1, max_batch=4) as engine:
+		truth = (engine.predict(imgs) > 0.5).astype(np.uint8)
+		results = dict(evaluate_region(index, engine.micro_batches([imgs]), truth, (1.0, 1.0, 1.0)))
+
+	# The model scored against its own thresholded predictions
+	assert sorted(results) == ["S0", "S1"]
+	for metrics in results.values():
+		assert metrics["dice"] == 1.0 and metrics["hd95"] == 0.0
@@ -0,0 +1,44 @@
+import pickle
+import numpy as np
+import pytest
+
+pytest.importorskip("h5py")
+
+from h5_store import H5AppendWriter, ChunkedArray
+
+@pytest.fixture
+def stored(tmpdir):
+
+	filename = str(tmpdir.join("imgs.h5"))
+	array = np.random.RandomState(816).rand(12, 5, 4, 2).astype(np.float32)
+	with H5AppendWriter(filename, chunk_slices=1) as writer:
+		writer.append(array[:5])
+		writer.append(array[5:])
+
+	return filename, array
+
+def test_append_resume_and_truncate(stored):
+
+	filename, array = stored
+	with H5AppendWriter(filename, append=True) as writer:
+		assert writer.shape == array.shape
+		writer.truncate(9)
+		writer.append(array[9:])
+	assert np.array_equal(ChunkedArray(filename)[:], array)
+
+	with pytest.raises(ValueError):
+		H5AppendWriter(filename, dtype=np.float64, append=True)
+
+@pytest.mark.parametrize("index", [3, -1, slice(2, 9), [7, 2, 7, 0], np.array([[11, 1], [1, 4]]),
+								   np.arange(12) % 3 == 0, (5, 2), ([4, 0], slice(None), 1), (slice(1, 4), 0, 2)])
+def test_indexing_matches_numpy(stored, index):
+
+	filename, array = stored
+	assert np.array_equal(ChunkedArray(filename)[index], array[index])
+
+def test_pickled_arrays_reopen_the_file(stored):
+
+	filename, array = stored
+	chunked = pickle.loads(pickle.dumps(ChunkedArray(filename)))
+	assert chunked.shape == array.shape and chunked.dtype == array.dtype
+	assert np.array_equal(chunked[[1, 0]], array[[1, 0]])
@@ -0,0 +1,21 @@
+import numpy as np
+import pytest
+
+tf = pytest.importorskip("tensorflow")
+
+from inference import InferenceEngine
+
+def test_engine_predicts(saved_model, tmpdir):
+
+	model_json, weights, expected = saved_model
+	with InferenceEngine(model_json, weights, num_threads=1, num_inter_threads=1, max_batch=4) as engine:
+		assert engine.input_shape == (16, 16, 1)
+		np.testing.assert_allclose(engine.predict(np.ones((2, 16, 16, 1), dtype=np.float32)), expected, rtol=1e-5)
+
+		# A stream of single slices and volumes comes out in order, batch by batch
+		items = [np.ones((16, 16, 1), dtype=np.float32), np.ones((5, 16, 16, 1), dtype=np.float32)]
+		filename = str(tmpdir.join("pred.npy"))
+		pred = engine.predict_to_file(items, filename)
+		assert pred.shape == (6, 16, 16, 1)
+		np.testing.assert_allclose(pred, np.repeat(expected[:1], 6, axis=0), rtol=1e-5)
+		assert engine.stats.summary()["slices"] == 8
@@ -0,0 +1,46 @@
+import numpy as np
+import pytest
+
+from npy_writer import NpyAppendWriter
+
+def test_chunks_load_as_one_array(tmpdir):
+
+	filename = str(tmpdir.join("imgs.npy"))
+	chunks = [np.random.RandomState(seed).rand(rows, 3, 2) for seed, rows in enumerate([4, 1, 7])]
+	with NpyAppendWriter(filename, dtype=np.float32) as writer:
+		for chunk in chunks:
+			writer.append(chunk)
+			writer.flush()
+			assert np.load(filename, mmap_mode="r").shape == writer.shape
+
+	assert np.array_equal(np.load(filename), np.concatenate(chunks).astype(np.float32))
+
+def test_append_resumes_after_the_last_flush(tmpdir):
+
+	filename = str(tmpdir.join("msks.npy"))
+	rows = np.arange(30, dtype=np.int16).reshape(10, 3)
+	writer = NpyAppendWriter(filename)
+	writer.append(rows[:6])
+	writer.flush()
+	writer.append(rows[6:])  # written but never committed to the header
+	writer._fp.close()
+
+	with NpyAppendWriter(filename, append=True) as writer:
+		assert writer.rows == 6
+		writer.append(rows[6:])
+	assert np.array_equal(np.load(filename), rows)
+
+	with NpyAppendWriter(filename, append=True) as writer:
+		writer.truncate(4)
+	assert np.array_equal(np.load(filename), rows[:4])
+
+def test_mismatched_rows_are_rejected(tmpdir):
+
+	filename = str(tmpdir.join("imgs.npy"))
+	with NpyAppendWriter(filename) as writer:
+		writer.append(np.zeros((2, 3), dtype=np.float32))
+		with pytest.raises(ValueError):
+			writer.append(np.zeros((2, 4), dtype=np.float32))
+
+	with pytest.raises(ValueError):
+		NpyAppendWriter(filename, dtype=np.float64, append=True)
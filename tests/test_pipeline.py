@@ -0,0 +1,47 @@
+import os
+import multiprocessing
+import numpy as np
+import pytest
+
+from pipeline import SharedBatchLoader
+
+def write_h5(path, array):
+
+	from h5_store import H5AppendWriter
+
+	with H5AppendWriter(str(path)) as writer:
+		writer.append(array[:len(array) // 2])
+		writer.append(array[len(array) // 2:])
+
+	return str(path)
+
+def test_loader_workers_open_their_own_hdf5_handles(tmpdir):
+
+	pytest.importorskip("h5py")
+	from h5_store import ChunkedArray
+
+	imgs = np.arange(40 * 4 * 4, dtype=np.float32).reshape(40, 4, 4, 1)
+	msks = (imgs % 3 == 0).astype(np.uint8)
+	chunked_imgs = ChunkedArray(write_h5(tmpdir.join("imgs.h5"), imgs))
+	chunked_msks = ChunkedArray(write_h5(tmpdir.join("msks.h5"), msks))
+
+	# Read in this process before the workers are forked
+	assert np.array_equal(chunked_imgs[[3, 1, 3]], imgs[[3, 1, 3]])
+
+	with SharedBatchLoader(chunked_imgs, chunked_msks, 8, workers=2, shuffle=False) as loader:
+		batches = [(np.copy(batch_imgs), np.copy(batch_msks))
+				   for (batch_imgs, batch_msks), step in zip(loader, range(10))]
+	assert np.array_equal(np.concatenate([batch[0] for batch in batches]), np.concatenate([imgs, imgs]))
+	assert np.array_equal(np.concatenate([batch[1] for batch in batches]), np.concatenate([msks, msks]))
+
+	# A forked process reads through a handle of its own
+	if "fork" in multiprocessing.get_all_start_methods():
+		queue = multiprocessing.get_context("fork").Queue()
+		def child():
+			queue.put((chunked_imgs[5:7].tolist(), chunked_imgs._pid == os.getpid()))
+		process = multiprocessing.get_context("fork").Process(target=child)
+		process.start()
+		rows, reopened = queue.get(timeout=60)
+		process.join()
+		assert np.array_equal(rows, imgs[5:7]) and reopened
+		assert chunked_imgs._pid == os.getpid()
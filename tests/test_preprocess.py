@@ -0,0 +1,64 @@
+import numpy as np
+import pytest
+
+from preprocess import RunningStats, PackedMasks, ChannelView, NormalizedImages, MODE_CHANNELS, \
+	pack_masks, unpack_masks, normalize_images, update_channels
+
+def test_running_stats_match_numpy():
+
+	values = np.random.RandomState(816).normal(3.0, 2.0, 1000) ** 3
+
+	blocks = RunningStats()
+	for block in np.array_split(values, 7):
+		blocks.update(block)
+	blocks.update(np.array([]))
+	assert blocks.count == len(values)
+	assert blocks.mean == pytest.approx(values.mean())
+	assert blocks.std == pytest.approx(values.std())
+
+	# Merging the statistics of two halves, e.g. of two subjects
+	merged = RunningStats().update(values[:300]).merge(RunningStats(**RunningStats().update(values[300:]).state()))
+	assert merged.mean == pytest.approx(values.mean())
+	assert merged.std == pytest.approx(values.std())
+	assert RunningStats().std == 0.0
+
+def test_packed_masks_unpack_only_the_indexed_rows():
+
+	msks = (np.random.RandomState(816).rand(6, 4, 3, 4) > 0.5).astype(np.uint8)
+	packed = pack_masks(msks)
+	assert packed.dtype == np.uint8 and packed.shape == msks.shape[:-1]
+	assert np.array_equal(unpack_masks(packed, 4), msks)
+
+	view = PackedMasks(packed, 4)
+	assert view.shape == msks.shape and len(view) == 6
+	for index in [2, [5, 0, 5], slice(1, 4), (3, 1), ([1, 2], slice(None), 0, 3)]:
+		assert np.array_equal(view[index], msks[index])
+
+@pytest.mark.parametrize("mode", sorted(MODE_CHANNELS))
+@pytest.mark.parametrize("channels_first", [False, True])
+def test_channel_views_sum_the_mode_channels(mode, channels_first):
+
+	rng = np.random.RandomState(mode)
+	imgs, msks = rng.rand(5, 6, 4, 4), (rng.rand(5, 6, 4, 4) > 0.5).astype(np.uint8)
+	view_imgs, view_msks = update_channels(imgs, msks, 1, 1, mode, channels_first)
+
+	for view, source, channels in zip([view_imgs, view_msks], [imgs, msks], MODE_CHANNELS[mode]):
+		expected = source[..., channels].sum(axis=-1, keepdims=True).astype(np.float32)
+		if channels_first:
+			expected = np.swapaxes(expected, 1, -1)
+		assert view.shape == expected.shape and view.dtype == np.float32
+		assert np.allclose(view[[4, 1]], expected[[4, 1]])
+		assert np.allclose(view[2:4, 0], expected[2:4, 0])
+
+	assert ChannelView(imgs, [0, 2], 1)[3].shape == (6, 4, 1)
+
+def test_normalized_images_use_the_dataset_statistics():
+
+	raw = np.random.RandomState(816).randint(0, 1000, (8, 4, 4, 2)).astype(np.float32)
+	normalization = {"normalize": "global", "mean": [400.0, 600.0], "std": [100.0, 0.0]}
+	view = NormalizedImages(raw, normalization)
+
+	expected = (raw - [400.0, 600.0]) / [100.0, 1.0]
+	assert np.allclose(view[[6, 1]], expected[[6, 1]])
+	assert np.allclose(view[2:5, 1, :, 0], expected[2:5, 1, :, 0])
+	assert np.allclose(normalize_images(raw).reshape(-1, 2).std(axis=0), 1, atol=1e-5)
@@ -0,0 +1,83 @@
+import io
+import gzip
+import threading
+import numpy as np
+import pytest
+
+pytest.importorskip("tensorflow")
+
+from inference import InferenceEngine
+from serve import DynamicBatcher, VolumePreprocessor, SegmentationServer
+
+try:
+	from urllib.request import urlopen, Request
+except ImportError:
+	from urllib2 import urlopen, Request
+
+@pytest.fixture(scope="module")
+def server(saved_model):
+
+	model_json, weights, expected = saved_model
+	engine = InferenceEngine(model_json, weights, num_threads=1, num_inter_threads=1, max_batch=8)
+	try:
+		preprocessor = VolumePreprocessor("/nonexistent", 1, 16)
+	except ImportError:
+		preprocessor = None
+	server = SegmentationServer(("127.0.0.1", 0), DynamicBatcher(engine, 8, 0.05), preprocessor)
+	thread = threading.Thread(target=server.serve_forever)
+	thread.daemon = True
+	thread.start()
+
+	yield "http://127.0.0.1:{}".format(server.server_address[1]), engine
+
+	server.shutdown()
+	engine.close()
+
+def post(url, body):
+	return urlopen(Request(url, data=body)).read()
+
+def npy_bytes(array):
+
+	out = io.BytesIO()
+	np.save(out, array)
+	return out.getvalue()
+
+def test_concurrent_slices_are_batched_and_returned_in_order(server):
+
+	url, engine = server
+	rng = np.random.RandomState(0)
+	requests = [rng.normal(size=(3, 16, 16)).astype(np.float32) for client in range(6)]
+	responses = [None] * len(requests)
+
+	def client(number):
+		body = post(url + "/slices?probabilities=1", npy_bytes(requests[number]))
+		responses[number] = np.load(io.BytesIO(body))
+
+	threads = [threading.Thread(target=client, args=(number,)) for number in range(len(requests))]
+	for thread in threads:
+		thread.start()
+	for thread in threads:
+		thread.join()
+
+	for slices, response in zip(requests, responses):
+		assert response.shape == (3, 16, 16, 1) and response.dtype == np.float16
+		np.testing.assert_allclose(response, engine.predict(slices[..., np.newaxis]), atol=1e-3)
+	assert engine.stats.batches < 2 * len(requests)  # some requests shared a batch
+
+def test_bad_slices_are_rejected(server):
+
+	url, engine = server
+	with pytest.raises(Exception) as error:
+		post(url + "/slices", npy_bytes(np.zeros((2, 9, 9), dtype=np.float32)))
+	assert getattr(error.value, "code", None) == 400
+
+def test_volume_mask_keeps_the_input_geometry(server):
+
+	nib = pytest.importorskip("nibabel")
+	url, engine = server
+	volume = np.random.RandomState(1).randint(0, 100, size=(32, 32, 3)).astype(np.int16)
+	body = post(url + "/volume", nib.Nifti1Image(volume, np.diag([2.0, 2.0, 2.0, 1.0])).to_bytes())
+	mask = nib.Nifti1Image.from_bytes(gzip.decompress(body) if body[:2] == b"\x1f\x8b" else body)
+	assert mask.shape == volume.shape
+	np.testing.assert_array_equal(mask.affine, np.diag([2.0, 2.0, 2.0, 1.0]))
+	assert set(np.unique(np.asanyarray(mask.dataobj))) <= set([0, 1])
@@ -0,0 +1,38 @@
+'''
+
+The TensorFlow 1 graph mode API on any TensorFlow. The scripts build their
+sessions, run options and py_funcs with it; TensorFlow 2 keeps it under
+tf.compat.v1 and needs eager execution turned off for it. Models are built
+with tf.keras, which has to be Keras 2: on TensorFlow 2.16 and later that is
+the tf_keras package, selected here (TF_USE_LEGACY_KERAS=1) when installed.
+Import this module before TensorFlow for that to take effect.
+
+'''
+
+import os
+import sys
+
+def _installed(module):
+
+	try:
+		from importlib.util import find_spec
+	except ImportError:
+		from pkgutil import find_loader as find_spec
+	return find_spec(module) is not None
+
+if "tensorflow" not in sys.modules and _installed("tf_keras"):
+	os.environ.setdefault("TF_USE_LEGACY_KERAS", "1")
+
+def tf_v1():
+	"""
+	Returns the TensorFlow 1 API: tf.compat.v1, with eager execution turned
+	off, on TensorFlow 2 (and 1.13 or later), tf itself on older versions.
+	"""
+
+	import tensorflow as tf
+
+	if hasattr(getattr(tf, "compat", None), "v1"):
+		tf.compat.v1.disable_eager_execution()
+		return tf.compat.v1
+
+	return tf
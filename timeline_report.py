@@ -0,0 +1,201 @@
+'''
+
+Hot-path report of TensorFlow step traces: the Chrome traces written by the
+--profile_steps profiler of train.py/train_dist.py (timeline_*_step<N>.json,
+also older timeline_ge_unet_*.json files) or the step_stats saved with them
+(timeline_*_step<N>.pb). Ranks the traced time by layer name (conv1a,
+transConv6, ...), op type, node or kernel library, with the memory the ops
+allocated and the share of the step spent converting tensor layouts, and
+compares two runs, e.g. --use_upsampling against transposed convolutions
+or channels_first against channels_last.
+
+Usage: python timeline_report.py timeline_*_step*.json [--by op] [--diff <other run traces>]
+
+'''
+
+import re
+import json
+import argparse
+import collections
+
+# Ops that only move a tensor between layouts: MKL <-> TensorFlow layout
+# conversions, and transposes between NHWC and NCHW
+LAYOUT_OPS = set(["_MklToTf", "_MklInputConversion", "_MklTfToMkl", "_MklReorder",
+				  "Transpose", "_MklTranspose", "ConjugateTranspose"])
+
+# Name scopes wrapping the layer names of the gradient and optimizer ops
+TRAINING_SCOPES = set(["training", "gradients", "loss", "metrics", "Adam", "SGD", "RMSprop"])
+
+Op = collections.namedtuple("Op", ["device", "node", "op", "micros", "bytes"])
+
+def layer_name(node):
+	"""
+	Returns the layer of a node name, e.g. conv1a for conv1a/Conv2D and for
+	training/Adam/gradients/conv1a/Conv2D_grad/Conv2DBackpropInput.
+	"""
+
+	parts = node.split("/")
+	for part in parts[:-1]:
+		if part not in TRAINING_SCOPES:
+			# Keras numbers layers rebuilt under a taken name (conv1a_1)
+			return re.sub(r"_\d+$", "", part)
+
+	return parts[-1]
+
+def kernel(op):
+	return "MKL" if op.startswith("_Mkl") else "Eigen"
+
+def is_layout_conversion(op):
+	return op.op in LAYOUT_OPS or "LayoutOptimizer" in op.node
+
+def read_chrome_trace(filename):
+	"""
+	Returns the Op records of one Chrome trace written by
+	tensorflow.python.client.timeline (with show_memory for the bytes).
+	"""
+
+	with open(filename) as f:
+		events = json.load(f)["traceEvents"]
+
+	devices = {}
+	allocated = collections.defaultdict(int)
+	for event in events:
+		if event.get("ph") == "M" and event.get("name") == "process_name":
+			devices[event["pid"]] = event["args"]["name"]
+		elif event.get("ph") == "O" and event.get("cat") == "Tensor":
+			# Tensor snapshots hold the bytes requested for each output
+			description = event.get("args", {}).get("snapshot", {}).get("tensor_description", "")
+			match = re.search(r"requested_bytes: (\d+)", description)
+			if match:
+				allocated[re.sub(r":\d+$", "", event["name"])] += int(match.group(1))
+
+	ops = []
+	for event in events:
+		if event.get("ph") == "X" and event.get("cat") == "Op":
+			args = event.get("args", {})
+			node = args.get("name", event["name"])
+			ops.append(Op(devices.get(event["pid"], str(event["pid"])), node,
+						  args.get("op", event["name"]), event.get("dur", 0),
+						  allocated.pop(node, 0)))
+
+	return ops
+
+def read_step_stats(filename):
+	"""
+	Returns the Op records of a serialized StepStats (RunMetadata.step_stats).
+	"""
+
+	from tensorflow.core.framework.step_stats_pb2 import StepStats
+	from profiler import op_type
+
+	step_stats = StepStats()
+	with open(filename, "rb") as f:
+		step_stats.ParseFromString(f.read())
+
+	ops = []
+	for dev_stats in step_stats.dev_stats:
+		for node in dev_stats.node_stats:
+			ops.append(Op(dev_stats.device, node.node_name, op_type(node), node.all_end_rel_micros,
+						  sum(memory.total_bytes for memory in node.memory)))
+
+	return ops
+
+def read_trace(filename):
+	return read_step_stats(filename) if filename.endswith(".pb") else read_chrome_trace(filename)
+
+def group_key(op, by):
+
+	if by == "layer":
+		return layer_name(op.node)
+	if by == "op":
+		return "{} ({})".format(op.op, kernel(op.op))
+	if by == "kernel":
+		return kernel(op.op)
+	return op.node
+
+class Run(object):
+	"""
+	The ops of one or more traced steps of a run, averaged per step.
+	"""
+
+	def __init__(self, filenames):
+
+		self.filenames = filenames
+		self.steps = len(filenames)
+		self.ops = []
+		for filename in filenames:
+			self.ops.extend(read_trace(filename))
+		self.micros = sum(op.micros for op in self.ops)
+
+	def table(self, by="layer"):
+		"""
+		Returns {name: (ms per step, share of the traced time, MB allocated per step)}.
+		"""
+
+		micros = collections.defaultdict(int)
+		nbytes = collections.defaultdict(int)
+		for op in self.ops:
+			key = group_key(op, by)
+			micros[key] += op.micros
+			nbytes[key] += op.bytes
+
+		return dict((key, (micros[key] / 1000.0 / self.steps, float(micros[key]) / max(self.micros, 1),
+						   nbytes[key] / 2.**20 / self.steps)) for key in micros)
+
+	def share(self, ops):
+		return float(sum(op.micros for op in ops)) / max(self.micros, 1)
+
+	def summary(self):
+
+		return collections.OrderedDict([
+			("traced ms per step", self.micros / 1000.0 / self.steps),
+			("layout conversion share", self.share([op for op in self.ops if is_layout_conversion(op)])),
+			("MKL kernel share", self.share([op for op in self.ops if kernel(op.op) == "MKL"])),
+			("MB allocated per step", sum(op.bytes for op in self.ops) / 2.**20 / self.steps)])
+
+def print_report(run, by="layer", top=30):
+
+	for name, value in run.summary().items():
+		print("{:>24}: {:.3f}".format(name, value))
+	print("")
+	print("{:>48} {:>12} {:>8} {:>10}".format(by, "ms/step", "share", "MB/step"))
+	rows = sorted(run.table(by).items(), key=lambda item: -item[1][0])
+	for name, (ms, share, mb) in rows[:top]:
+		print("{:>48} {:>12.3f} {:>7.1f}% {:>10.1f}".format(name[-48:], ms, 100*share, mb))
+
+def print_diff(run, other, by="layer", top=30):
+
+	print("{:>24} {:>12} {:>12}".format("", "run", "diff run"))
+	for (name, value), other_value in zip(run.summary().items(), other.summary().values()):
+		print("{:>24} {:>12.3f} {:>12.3f}".format(name, value, other_value))
+	print("")
+
+	# Largest changes first; names found in only one run show a zero for the other
+	table, other_table = run.table(by), other.table(by)
+	names = sorted(set(table) | set(other_table),
+				   key=lambda name: -abs(other_table.get(name, (0,))[0] - table.get(name, (0,))[0]))
+	print("{:>48} {:>12} {:>12} {:>12} {:>10}".format(by, "run ms", "diff run ms", "change ms", "MB change"))
+	for name in names[:top]:
+		ms, _, mb = table.get(name, (0.0, 0.0, 0.0))
+		other_ms, _, other_mb = other_table.get(name, (0.0, 0.0, 0.0))
+		print("{:>48} {:>12.3f} {:>12.3f} {:>+12.3f} {:>+10.1f}".format(name[-48:], ms, other_ms,
+																		 other_ms - ms, other_mb - mb))
+
+if __name__ == "__main__":
+
+	parser = argparse.ArgumentParser()
+	parser.add_argument("traces", nargs="+",
+						help="the Chrome traces (.json) or step_stats (.pb) of the sampled steps of a run")
+	parser.add_argument("--diff", nargs="+", default=None,
+						help="the traces of a second run to compare against")
+	parser.add_argument("--by", default="layer", choices=["layer", "op", "node", "kernel"],
+						help="rank the time by layer name, op type, node or kernel library")
+	parser.add_argument("--top", type=int, default=30,
+						help="the number of rows shown")
+	args = parser.parse_args()
+
+	run = Run(args.traces)
+	if args.diff:
+		print_diff(run, Run(args.diff), args.by, args.top)
+	else:
+		print_report(run, args.by, args.top)
@@ -36,8 +36,52 @@ parser.add_argument("--channels_first", help="use channels first data format",
 					action="store_true", default=False)
 parser.add_argument("--print_model", help="print the model",
 					action="store_true", default=False)
+parser.add_argument("--no_cache", help="derive the mode channels on the fly instead of caching them on disk",
+					action="store_true", default=False)
+parser.add_argument("--pipeline", default="numpy", choices=["numpy", "tfdata", "loader"],
+					help="feed arrays to model.fit, or stream batches through a tf.data pipeline "
+					"or shared-memory loader processes")
+parser.add_argument("--pipeline_threads", type=int, default=4,
+					help="the parallel batch reads of the tf.data pipeline")
+parser.add_argument("--loader_workers", type=int, default=4,
+					help="the number of batch loader processes")
+parser.add_argument("--loader_numa_node", type=int, default=None,
+					help="pin the batch loader processes to the CPUs of this NUMA node")
+parser.add_argument("--augment", help="augment the training batches in the input pipeline",
+					action="store_true", default=False)
+parser.add_argument("--augment_seed", type=int, default=816,
+					help="the seed of the training batch augmentations")
+parser.add_argument("--profile_steps", "--profile-steps", default=None,
+					help="trace only these training steps, e.g. 50-55 or 50-55,200-205")
+parser.add_argument("--kmp_affinity", default="compact,1,0,granularity=thread",
+					help="the KMP_AFFINITY thread placement")
+parser.add_argument("--burst_steps", type=int, default=0,
+					help="only time this many training steps and exit (used by autotune.py)")
+parser.add_argument("--no_autotune", help="ignore the settings autotune.py saved for this host",
+					action="store_true", default=False)
+parser.add_argument("--autotune_file", default=None,
+					help="the file of the autotuned settings (default: autotune.json)")
+parser.add_argument("--precision", default="fp32", choices=["fp32", "bf16", "mixed"],
+					help="train in float32, with the Keras mixed_bfloat16 policy (bf16) "
+					"or with the oneDNN auto mixed precision rewrite (mixed)")
+parser.add_argument("--seed", type=int, default=816,
+					help="the seed of the weight initialization and the batch shuffling")
+parser.add_argument("--precision_results", default="precision_results.json",
+					help="the file the images/sec and test Dice of each precision are recorded in")
 
 args = parser.parse_args()
+if args.keras_api and args.precision != "fp32":
+	parser.error("--precision {} needs tf.keras".format(args.precision))
+
+# Settings tuned for this host by autotune.py replace the defaults; flags
+# given on the command line still win
+if not args.no_autotune:
+	import autotune
+	tuned = autotune.load_config(args.autotune_file or autotune.AUTOTUNE_FILE)
+	if tuned:
+		parser.set_defaults(**tuned)
+		args = parser.parse_args()
+		print("Using the autotuned defaults {}".format(tuned))
 
 batch_size = args.batch_size
 
@@ -58,7 +102,7 @@ learningrate = args.learningrate
 os.environ["TF_CPP_MIN_LOG_LEVEL"]="2"  # Get rid of the AVX, SSE warnings
 
 os.environ["KMP_BLOCKTIME"] = blocktime
-os.environ["KMP_AFFINITY"]="compact,1,0,granularity=thread"
+os.environ["KMP_AFFINITY"]=args.kmp_affinity
 #os.environ["KMP_AFFINITY"]="compact,1,0,granularity=fine"
 #os.environ["KMP_AFFINITY"]="granularity=fine,proclist=[0-{}],explicit".format(num_threads)
 
@@ -81,26 +125,37 @@ os.environ["MKL_NUM_THREADS"] =str(num_threads)
 
 os.environ["KMP_SETTINGS"] = "0"  # Show the settins at runtime
 
-# The timeline trace for TF is saved to this file.
-# To view it, run this python script, then load the json file by
+# The timeline traces of the --profile_steps steps are saved to files named
+# after this one (timeline_..._step<N>.json).
+# To view one, run this python script, then load the json file by
 # starting Google Chrome browser and pointing the URI to chrome://trace
 # There should be a button at the top left of the graph where
 # you can load in this json file.
 timeline_filename = "timeline_ge_unet_{}_{}_{}.json".format(blocktime, num_threads, num_inter_op_threads)
 
 import time
+import inspect
 
+# The session, the run options the profiler traces with and the oneDNN
+# rewrite of --precision mixed use the TensorFlow 1 graph mode API
+from tf_compat import tf_v1
 import tensorflow as tf
+tf1 = tf_v1()
 
-config = tf.ConfigProto(intra_op_parallelism_threads=num_threads,
-						inter_op_parallelism_threads=num_inter_op_threads)
+config = tf1.ConfigProto(intra_op_parallelism_threads=num_threads,
+						 inter_op_parallelism_threads=num_inter_op_threads)
 
 config.graph_options.optimizer_options.opt_level = -1
 
-sess = tf.Session(config=config)
+from precision import configure_precision, record_run, run_setup
+configure_precision(args.precision, config)
+tf1.set_random_seed(args.seed)
+
+sess = tf1.Session(config=config)
 
-run_options = tf.RunOptions(trace_level=tf.RunOptions.FULL_TRACE)
-run_metadata = tf.RunMetadata()  # For Tensorflow trace
+# Steps run untraced; the profiler turns on FULL_TRACE for the sampled steps
+run_options = tf1.RunOptions(trace_level=tf1.RunOptions.NO_TRACE)
+run_metadata = tf1.RunMetadata()  # For Tensorflow trace
 
 CHANNEL_LAST = not args.channels_first
 if CHANNEL_LAST:
@@ -112,16 +167,24 @@ else:
 	data_format = "channels_first"
 
 print("Data format = " + data_format)
+# Keras runs the model in this session, with its threads and graph rewrites
 if args.keras_api:
 	import keras
+	keras.backend.set_session(sess)
 	keras.backend.set_image_data_format(data_format)
 else:
+	tf1.keras.backend.set_session(sess)
 	tf.keras.backend.set_image_data_format(data_format)
 
 import numpy as np
 import os
 
+np.random.seed(args.seed)
+
 from preprocess import *
+from pipeline import numpy_batches, tfdata_batches, steps_per_epoch, SharedBatchLoader, numa_node_cpus
+from augment import Augmenter
+from profiler import StepProfiler, parse_steps
 import settings
 
 def dice_coef(y_true, y_pred, smooth = 1. ):
@@ -135,8 +198,9 @@ def dice_coef(y_true, y_pred, smooth = 1. ):
 			(keras.backend.sum(y_true_f) + keras.backend.sum(y_pred_f) + smooth)
 
 	else:
-		y_true_f = tf.keras.backend.flatten(y_true)
-		y_pred_f = tf.keras.backend.flatten(y_pred)
+		# The Dice sums are reduced in float32 whatever the model precision
+		y_true_f = tf.keras.backend.flatten(tf.cast(y_true, tf.float32))
+		y_pred_f = tf.keras.backend.flatten(tf.cast(y_pred, tf.float32))
 		intersection = tf.keras.backend.sum(y_true_f * y_pred_f)
 		coef = (2. * intersection + smooth) / \
 			(tf.keras.backend.sum(y_true_f) + tf.keras.backend.sum(y_pred_f) + smooth)
@@ -156,8 +220,8 @@ def dice_coef_loss(y_true, y_pred):
 	else:
 
 		smooth = 1.
-		y_true_f = tf.keras.backend.flatten(y_true)
-		y_pred_f = tf.keras.backend.flatten(y_pred)
+		y_true_f = tf.keras.backend.flatten(tf.cast(y_true, tf.float32))
+		y_pred_f = tf.keras.backend.flatten(tf.cast(y_pred, tf.float32))
 		intersection = tf.keras.backend.sum(y_true_f * y_pred_f)
 		loss = -tf.keras.backend.log(2.0*intersection + smooth) + \
 			tf.keras.backend.log((tf.keras.backend.sum(y_true_f) + tf.keras.backend.sum(y_pred_f) + smooth))
@@ -249,8 +313,9 @@ def unet_model(args=None,
 	conv9 = tf.keras.layers.Conv2D(name="conv9a", filters=32, **params)(up9)
 	conv9 = tf.keras.layers.Conv2D(name="conv9b", filters=32, **params)(conv9)
 
+	# The sigmoid output stays float32 under the bf16 policy
 	conv10 = tf.keras.layers.Conv2D(name="Mask", filters=n_cl_out, kernel_size=(1, 1),
-					data_format=data_format, activation="sigmoid")(conv9)
+					data_format=data_format, activation="sigmoid", dtype="float32")(conv9)
 
 	model = tf.keras.models.Model(inputs=[inputs], outputs=[conv10])
 
@@ -259,7 +324,10 @@ def unet_model(args=None,
 	# else:
 	# 	optimizer = tf.keras.optimizers.SGD(lr=learning_rate, momentum=0.9, decay=0.05)
 
-	optimizer=tf.keras.optimizers.Adam(lr=args.learningrate, beta_1=0.9, beta_2=0.99, epsilon=1e-08, decay=0.00001)
+	# The optimizers of TensorFlow 2.11 and later do not run in graph mode;
+	# their legacy versions do, and keep the lr and decay arguments
+	optimizers = getattr(tf.keras.optimizers, "legacy", tf.keras.optimizers)
+	optimizer=optimizers.Adam(lr=args.learningrate, beta_1=0.9, beta_2=0.99, epsilon=1e-08, decay=0.00001)
 
 	model.compile(optimizer=optimizer,
 		loss=dice_coef_loss,
@@ -384,15 +452,24 @@ def train_and_predict(data_path, img_rows, img_cols, n_epoch,
 	print("Loading and preprocessing train data...")
 	print("-"*30)
 
-	imgs_train, msks_train = load_data(data_path,"_train")
-	imgs_train, msks_train = update_channels(imgs_train, msks_train, input_no, output_no,
-		mode)
+	if args.no_cache:
+		imgs_train, msks_train = load_data(data_path,"_train")
+		imgs_train, msks_train = update_channels(imgs_train, msks_train, input_no, output_no,
+			mode, not CHANNEL_LAST)
+	else:
+		imgs_train, msks_train = load_mode_data(data_path, "_train", input_no, output_no,
+			mode, not CHANNEL_LAST)
 
 	print("-"*30)
 	print("Loading and preprocessing test data...")
 	print("-"*30)
-	imgs_test, msks_test = load_data(data_path,"_test")
-	imgs_test, msks_test = update_channels(imgs_test, msks_test, input_no, output_no, mode)
+	if args.no_cache:
+		imgs_test, msks_test = load_data(data_path,"_test")
+		imgs_test, msks_test = update_channels(imgs_test, msks_test, input_no, output_no,
+			mode, not CHANNEL_LAST)
+	else:
+		imgs_test, msks_test = load_mode_data(data_path, "_test", input_no, output_no,
+			mode, not CHANNEL_LAST)
 
 	print("-"*30)
 	print("Creating and compiling model...")
@@ -407,6 +484,19 @@ def train_and_predict(data_path, img_rows, img_cols, n_epoch,
 						   input_no, output_no,
 						   print_summary=args.print_model)
 
+	if args.burst_steps:
+		# Time training steps alone for autotune.py: one batch, read once, is
+		# trained on repeatedly after two warm-up steps
+		batch_imgs, batch_msks = next(numpy_batches(imgs_train, msks_train, batch_size))
+		for step in range(2):
+			model.train_on_batch(batch_imgs, batch_msks)
+		start_time = time.time()
+		for step in range(args.burst_steps):
+			model.train_on_batch(batch_imgs, batch_msks)
+		print("Burst throughput: {:.1f} images/sec".format(
+			  args.burst_steps * len(batch_imgs) / (time.time() - start_time)))
+		return
+
 	if (args.use_upsampling):
 		model_fn	= os.path.join(data_path, fn+"_upsampling.hdf5")
 	else:
@@ -424,25 +514,33 @@ def train_and_predict(data_path, img_rows, img_cols, n_epoch,
 	directoryName = "unet_block{}_inter{}_intra{}".format(blocktime,
 					num_threads, num_inter_op_threads)
 
+	# TensorBoard profiles a batch of its own since TensorFlow 1.14, which
+	# clashes with the --profile_steps traces
+	tensorboard_class = keras.callbacks.TensorBoard if args.keras_api else tf.keras.callbacks.TensorBoard
+	getargspec = getattr(inspect, "getfullargspec", None) or inspect.getargspec
+	tensorboard_options = {}
+	if "profile_batch" in getargspec(tensorboard_class.__init__).args:
+		tensorboard_options["profile_batch"] = 0
+
 	if (args.use_upsampling):
 
 		if args.keras_api:
 			tensorboard_checkpoint = keras.callbacks.TensorBoard(
 			log_dir="./keras_tensorboard_upsampling_batch{}/{}".format(batch_size, directoryName),
-			write_graph=True, write_images=True)
+			write_graph=True, write_images=True, **tensorboard_options)
 		else:
 			tensorboard_checkpoint = tf.keras.callbacks.TensorBoard(
 				log_dir="./keras_tensorboard_upsampling_batch{}/{}".format(batch_size, directoryName),
-				write_graph=True, write_images=True)
+				write_graph=True, write_images=True, **tensorboard_options)
 	else:
 		if args.keras_api:
 			tensorboard_checkpoint = keras.callbacks.TensorBoard(
 				log_dir="./keras_tensorboard_transposed_batch{}/{}".format(batch_size, directoryName),
-				write_graph=True, write_images=True)
+				write_graph=True, write_images=True, **tensorboard_options)
 		else:
 			tensorboard_checkpoint = tf.keras.callbacks.TensorBoard(
 			log_dir="./keras_tensorboard_transposed_batch{}/{}".format(batch_size, directoryName),
-			write_graph=True, write_images=True)
+			write_graph=True, write_images=True, **tensorboard_options)
 
 	print("-"*30)
 	print("Fitting model...")
@@ -454,32 +552,84 @@ def train_and_predict(data_path, img_rows, img_cols, n_epoch,
 		history = tf.keras.callbacks.History()
 
 	print("Batch size = {}".format(batch_size))
-	if not CHANNEL_LAST:  # Swap first and last axes on data
-		imgs_train = np.swapaxes(imgs_train,1,-1)
-		msks_train = np.swapaxes(msks_train,1,-1)
-		imgs_test  = np.swapaxes(imgs_test,1,-1)
-		msks_test  = np.swapaxes(msks_test,1,-1)
-
-	history = model.fit(imgs_train, msks_train,
-	 	batch_size=batch_size,
-	 	epochs=n_epoch,
-	 	validation_data = (imgs_test, msks_test),
-	 	verbose=1,
-	 	callbacks=[model_checkpoint, tensorboard_checkpoint])
+
+	augmenter = Augmenter(seed=args.augment_seed, channels_first=not CHANNEL_LAST) if args.augment else None
+
+	# Training images per second of each epoch, to compare input pipelines,
+	# and the augmentation time per batch against the time per training step
+	epoch_start = {}
+	epoch_rates = []
+	def log_throughput(epoch, logs):
+		epoch_time = time.time() - epoch_start["time"]
+		epoch_rates.append(len(imgs_train) / epoch_time)
+		print("Epoch {} throughput ({} pipeline): {:.1f} images/sec".format(epoch+1,
+			  args.pipeline, len(imgs_train) / epoch_time))
+		if augmenter is not None:
+			print("Augmentation: {:.1f} ms per batch, {:.1f} ms per training step".format(
+				  1000*augmenter.cost(), 1000*epoch_time / steps_per_epoch(len(imgs_train), batch_size)))
+	callbacks = keras.callbacks if args.keras_api else tf.keras.callbacks
+	throughput_logger = callbacks.LambdaCallback(
+		on_epoch_begin=lambda epoch, logs: epoch_start.update(time=time.time()),
+		on_epoch_end=log_throughput)
+
+	timeline_prefix = os.path.splitext(timeline_filename)[0]
+	profiler = StepProfiler(run_options, run_metadata, parse_steps(args.profile_steps), timeline_prefix)
+	step_profiler = callbacks.LambdaCallback(
+		on_batch_begin=lambda batch, logs: profiler.begin(model.train_function),
+		on_batch_end=lambda batch, logs: profiler.end(model.train_function))
+	fit_callbacks = [model_checkpoint, tensorboard_checkpoint, throughput_logger, step_profiler]
+
+	if args.pipeline == "tfdata":
+		history = model.fit_generator(tfdata_batches(imgs_train, msks_train, batch_size,
+				num_parallel_calls=args.pipeline_threads, session=sess, augment=augmenter),
+			steps_per_epoch=steps_per_epoch(len(imgs_train), batch_size),
+			epochs=n_epoch,
+			validation_data=tfdata_batches(imgs_test, msks_test, batch_size, shuffle=False,
+				num_parallel_calls=args.pipeline_threads, session=sess),
+			validation_steps=steps_per_epoch(len(imgs_test), batch_size),
+			verbose=1,
+			callbacks=fit_callbacks)
+	elif args.pipeline == "loader":
+		# Batches are views of shared buffers, so the loader must not reuse one
+		# while Keras still holds it: max_queue_size queued, one being put and
+		# one training
+		max_queue_size = 2
+		cpus = numa_node_cpus(args.loader_numa_node) if args.loader_numa_node is not None else None
+		with SharedBatchLoader(imgs_train, msks_train, batch_size, args.loader_workers,
+							   hold=max_queue_size+2, cpus=cpus, augment=augmenter) as train_loader, \
+			 SharedBatchLoader(imgs_test, msks_test, batch_size, args.loader_workers, shuffle=False,
+							   hold=max_queue_size+2, cpus=cpus) as test_loader:
+			history = model.fit_generator(iter(train_loader),
+				steps_per_epoch=len(train_loader),
+				epochs=n_epoch,
+				validation_data=iter(test_loader),
+				validation_steps=len(test_loader),
+				max_queue_size=max_queue_size,
+				verbose=1,
+				callbacks=fit_callbacks)
+	elif augmenter is not None:
+		# Augmented batches have to be generated rather than sliced from the arrays
+		history = model.fit_generator(numpy_batches(imgs_train, msks_train, batch_size, augment=augmenter),
+			steps_per_epoch=steps_per_epoch(len(imgs_train), batch_size),
+			epochs=n_epoch,
+			validation_data=(imgs_test, msks_test),
+			verbose=1,
+			callbacks=fit_callbacks)
+	else:
+		history = model.fit(imgs_train, msks_train,
+		 	batch_size=batch_size,
+		 	epochs=n_epoch,
+		 	validation_data = (imgs_test, msks_test),
+		 	verbose=1,
+		 	callbacks=fit_callbacks)
 	json_fn = os.path.join(data_path, fn+".json")
 	with open(json_fn,"w") as f:
 		f.write(model.to_json())
 
 	"""
-	Save the training timeline
+	Summarize the op times of the traced steps
 	"""
-	from tensorflow.python.client import timeline
-
-	fetched_timeline = timeline.Timeline(run_metadata.step_stats)
-	chrome_trace = fetched_timeline.generate_chrome_trace_format()
-	with open(timeline_filename, "w") as f:
-		print("Saved Tensorflow trace to: {}".format(timeline_filename))
-		f.write(chrome_trace)
+	profiler.report(timeline_prefix + "_ops.csv")
 
 	print("-"*30)
 	print("Loading saved weights...")
@@ -502,6 +652,13 @@ def train_and_predict(data_path, img_rows, img_cols, n_epoch,
 	scores = model.evaluate(imgs_test, msks_test, batch_size=batch_size, verbose = 2)
 	print ("Evaluation Scores", scores)
 
+	# Compare with the fp32 run of the same setup; the first epoch, with its
+	# graph optimization and warm-up, is left out when there are others
+	record_run(args.precision_results, args.precision,
+			   run_setup(args, data_path, mode, img_rows, img_cols),
+			   float(np.mean(epoch_rates[1:] or epoch_rates)),
+			   float(scores[model.metrics_names.index("dice_coef")]))
+
 if __name__ == "__main__":
 
 	import datetime
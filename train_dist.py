@@ -7,6 +7,9 @@
 
 from tensorflow.python.ops.control_flow_ops import with_dependencies
 from preprocess import * 
+from augment import Augmenter
+from profiler import StepProfiler, parse_steps
+from precision import configure_precision, record_run, run_setup
 import tensorflow as tf
 from helper import *
 import numpy as np
@@ -31,6 +34,13 @@ parser.add_argument("--learningrate", type=float, default=settings_dist.LEARNING
 parser.add_argument("--const_learningrate", help='decay learning rate',action='store_true',default=False)
 parser.add_argument("--decay_steps", type=int, default=settings_dist.DECAY_STEPS, help="steps taken to decay learningrate by lr_fraction%")
 parser.add_argument("--lr_fraction", type=float, default=settings_dist.LR_FRACTION, help="learningrate's fraction of its original value after decay_steps steps")
+parser.add_argument("--no_cache", help='derive the mode channels on the fly instead of caching them on disk',action='store_true',default=False)
+parser.add_argument("--augment", help='augment the training batches',action='store_true',default=False)
+parser.add_argument("--augment_seed", type=int, default=816, help="the seed of the training batch augmentations")
+parser.add_argument("--profile_steps", "--profile-steps", default=None, help="trace only these training steps, e.g. 50-55 or 50-55,200-205")
+parser.add_argument("--precision", default="fp32", choices=["fp32", "bf16", "mixed"], help="train in float32, with the Keras mixed_bfloat16 policy (bf16) or with the oneDNN auto mixed precision rewrite (mixed)")
+parser.add_argument("--seed", type=int, default=816, help="the seed of the weight initialization and the batch shuffling")
+parser.add_argument("--precision_results", default="precision_results.json", help="the file the images/sec and test Dice of each precision are recorded in")
 
 parser.add_argument("--worker_nodes",type=str, default=settings_dist.WORKER_HOSTS,help="list of the worker node IP addresses")
 parser.add_argument("--ps_nodes",type=str, default=settings_dist.PS_HOSTS,help="list of the parameter server node IP addresses")
@@ -76,8 +86,9 @@ del os.environ['https_proxy']
 # os.environ['PHI_KMP_PLACE_THREADS'] = '60c,3t'
 # os.environ['PHI_OMP_NUM_THREADS'] = str(num_threads)
 
-# The timeline trace for TF is saved to this file.
-# To view it, run this python script, then load the json file by 
+# The timeline traces of the --profile_steps steps are saved to files named
+# after this one (timeline_..._worker<N>_step<N>.json).
+# To view one, run this python script, then load the json file by 
 # starting Google Chrome browser and pointing the URI to chrome://trace
 # There should be a button at the top left of the graph where
 # you can load in this json file.
@@ -111,8 +122,12 @@ img_cols = settings_dist.IMG_COLS/settings_dist.RESCALE_FACTOR
 num_epochs = args.epochs
 
 config = tf.ConfigProto(inter_op_parallelism_threads=num_inter_op_threads,intra_op_parallelism_threads=num_intra_op_threads)
+configure_precision(args.precision, config)
+tf.set_random_seed(args.seed)
+np.random.seed(args.seed)
 
-run_options = tf.RunOptions(trace_level=tf.RunOptions.FULL_TRACE)
+# Steps run untraced; the profiler turns on FULL_TRACE for the sampled steps
+run_options = tf.RunOptions(trace_level=tf.RunOptions.NO_TRACE)
 run_metadata = tf.RunMetadata()  # For Tensorflow trace
 
 CHANNEL_LAST = True
@@ -220,8 +235,9 @@ def model5_MultiLayer(args=None, weights=False,
 	conv9 = tf.keras.layers.Conv2D(name='conv9a', filters=32, **params)(up9)
 	conv9 = tf.keras.layers.Conv2D(name='conv9b', filters=32, **params)(conv9)
 
+	# The sigmoid output stays float32 under the bf16 policy
 	conv10 = tf.keras.layers.Conv2D(name='Mask', filters=n_cl_out, kernel_size=(1, 1), 
-					data_format=data_format, activation='sigmoid')(conv9)
+					data_format=data_format, activation='sigmoid', dtype='float32')(conv9)
 
 	model = tf.keras.models.Model(inputs=[inputs], outputs=[conv10])
 
@@ -244,28 +260,16 @@ def get_epoch(batch_size,imgs_train,msks_train):
 
 	# Assuming imgs_train and msks_train are the same size
 	train_size = imgs_train.shape[0]
-	image_width = imgs_train.shape[1]
-	image_height = imgs_train.shape[2]
-	image_channels = imgs_train.shape[3]
 
 	epoch_length = train_size - train_size%batch_size
-	batch_count = epoch_length/batch_size
+	batch_count = epoch_length//batch_size
 
-	# Shuffle and truncate arrays to equal 1 epoch
-	zipped = zip(imgs_train,msks_train)
-	np.random.shuffle(zipped)
-	data,labels = zip(*zipped)
-	data = np.asarray(data)[:epoch_length]
-	labels = np.asarray(labels)[:epoch_length]
+	# Shuffle and truncate the row indices to equal 1 epoch. The rows themselves
+	# are only read when a batch is consumed, so memory stays O(batch).
+	index = np.random.permutation(train_size)[:epoch_length]
 
-	# Reshape arrays into batch_count batches of length batch_size
-	data = data.reshape((batch_count,batch_size,image_width,image_height,image_channels))
-	labels = labels.reshape((batch_count,batch_size,image_width,image_height,image_channels))
-
-	# Join batches of training examples with batches of labels
-	epoch_of_batches = zip(data,labels)
-
-	return epoch_of_batches
+	# Reshape into batch_count batches of length batch_size
+	return index.reshape((batch_count,batch_size))
 
 def create_done_queue(i):
   """Queue used to signal death for i'th ps shard. Intended to have 
@@ -321,15 +325,21 @@ def main(_):
 		print('-'*30)
 		print('Loading and preprocessing train data...')
 		print('-'*30)
-		imgs_train, msks_train = load_data(settings_dist.OUT_PATH,"_train")
-		imgs_train, msks_train = update_channels(imgs_train, msks_train, settings_dist.IN_CHANNEL_NO, settings_dist.OUT_CHANNEL_NO, settings_dist.MODE)
+		if args.no_cache:
+			imgs_train, msks_train = load_data(settings_dist.OUT_PATH,"_train")
+			imgs_train, msks_train = update_channels(imgs_train, msks_train, settings_dist.IN_CHANNEL_NO, settings_dist.OUT_CHANNEL_NO, settings_dist.MODE)
+		else:
+			imgs_train, msks_train = load_mode_data(settings_dist.OUT_PATH, "_train", settings_dist.IN_CHANNEL_NO, settings_dist.OUT_CHANNEL_NO, settings_dist.MODE)
 
 		# Load test data
 		print('-'*30)
 		print('Loading and preprocessing test data...')
 		print('-'*30)
-		imgs_test, msks_test = load_data(settings_dist.OUT_PATH,"_test")
-		imgs_test, msks_test = update_channels(imgs_test, msks_test, settings_dist.IN_CHANNEL_NO, settings_dist.OUT_CHANNEL_NO, settings_dist.MODE)
+		if args.no_cache:
+			imgs_test, msks_test = load_data(settings_dist.OUT_PATH,"_test")
+			imgs_test, msks_test = update_channels(imgs_test, msks_test, settings_dist.IN_CHANNEL_NO, settings_dist.OUT_CHANNEL_NO, settings_dist.MODE)
+		else:
+			imgs_test, msks_test = load_mode_data(settings_dist.OUT_PATH, "_test", settings_dist.IN_CHANNEL_NO, settings_dist.OUT_CHANNEL_NO, settings_dist.MODE)
 
 		print("Training images shape: {}".format(imgs_train[0].shape))
 		print("Training masks shape: {}".format(msks_train[0].shape))
@@ -414,7 +424,8 @@ def main(_):
 
 			sv = tf.train.Supervisor(is_chief=(task_index == 0),logdir=logdir,init_op=init_op,summary_op=summary_op,saver=saver,global_step=global_step,save_model_secs=60)
 
-			with sv.prepare_or_wait_for_session(server.target) as sess:
+			# The session config carries the mixed precision graph rewrite
+			with sv.prepare_or_wait_for_session(server.target, config=config) as sess:
 			#with sv.managed_session(server.target,config=config) as sess:
 
 				# Write to TensorBoard
@@ -437,6 +448,14 @@ def main(_):
 
 				epoch_track = []
 
+				# Each worker draws its own augmentations of its part of the batch
+				augmenter = None
+				if args.augment:
+					augmenter = Augmenter(seed=args.augment_seed + task_index, channels_first=not CHANNEL_LAST)
+
+				timeline_prefix = '{}_worker{}'.format(os.path.splitext(timeline_filename)[0], task_index)
+				profiler = StepProfiler(run_options, run_metadata, parse_steps(args.profile_steps), timeline_prefix)
+
 				total_start = timeit.default_timer()
 
 				while (step <= num_epochs) and not sv.should_stop():
@@ -455,17 +474,23 @@ def main(_):
 							break   # Exit early since the Supervisor node has requested a stop.
 
 						batch_start = timeit.default_timer()
-						data = batch[0]
-						labels = batch[1]
 
 						# For n workers, break up the batch into n sections
 						# Send each worker a different section of the batch
 						data_range = int(batch_size/len(worker_hosts))
 						start = data_range*task_index
 						end = start + data_range
+						rows = np.sort(batch[start:end])
 
-						feed_dict = {model.inputs[0]:data[start:end],targ:labels[start:end]}
-						loss_value,step_value,learn_rate = sess.run([train_op,global_step,learning_rate],feed_dict = feed_dict)
+						batch_imgs, batch_msks = imgs_train[rows], msks_train[rows]
+						if augmenter is not None:
+							batch_imgs, batch_msks = augmenter(batch_imgs, batch_msks)
+
+						feed_dict = {model.inputs[0]:batch_imgs,targ:batch_msks}
+						profiler.begin()
+						loss_value,step_value,learn_rate = sess.run([train_op,global_step,learning_rate],feed_dict = feed_dict,
+							options=run_options,run_metadata=run_metadata)
+						profiler.end()
 						#sess.run(increment_global_step_op)
 
 						# Report progress
@@ -482,6 +507,8 @@ def main(_):
 
 					epoch_time = timeit.default_timer() - epoch_start
 					print("Epoch time = {0} s\nTraining Dice = {1}".format(int(epoch_time),dice))
+					if augmenter is not None:
+						print("Augmentation: {0:.1f} ms per batch, {1:.1f} ms per step".format(1000*augmenter.cost(), 1000*epoch_time/num_batches))
 					epoch_track.append(epoch_time)
 
 					if (task_index == 0):
@@ -492,6 +519,8 @@ def main(_):
 
 				total_end = timeit.default_timer()
 
+				profiler.report(timeline_prefix + '_ops.csv')
+
 				# Evaluate test accuracy
 				# Break up the test set into smaller sections to avoid segmentation faults
 				# Reduce OMP_NUM_THREADS for inference to 'Resource temporarily unavailable errors'
@@ -520,6 +549,15 @@ def main(_):
 				print("Average time/epoch = {:.0f} s\n".format(np.asarray(epoch_track).mean()))
 				print("Total time to train: {} s".format(round(total_end-total_start)))
 
+				if task_index == 0:
+					# Images/sec of the whole cluster, leaving out the first epoch when there are others
+					epoch_images = num_batches * batch_size
+					record_run(args.precision_results, args.precision,
+						run_setup(args, settings_dist.OUT_PATH, settings_dist.MODE, img_rows, img_cols,
+								  workers=len(worker_hosts), parameter_servers=len(ps_hosts)),
+						float(np.mean([epoch_images / t for t in (epoch_track[1:] or epoch_track)])),
+						float(avg_dice))
+
 				
 				for op in enq_ops:
 					sess.run(op)   # Send the "work completed" signal to the parameter server